@@ -0,0 +1,108 @@
+"""Benchmark the evaluation of the lower-tier expressions of `evt` configs.
+
+Collects the ``expression`` and ``query`` strings of the aggregation
+operations in the ``tests/evt/configs`` files and evaluates each of them the
+way :func:`pygama.evt.utils.get_data_at_channel` does, once per channel, on
+synthetic columns: with the previous string rewriting plus :func:`eval` on
+awkward arrays, and with :func:`pygama.evt.expressions.compile_expression`.
+
+Usage::
+
+    $ python benchmarks/evt_expressions.py --rows 10000 --channels 100
+"""
+
+from __future__ import annotations
+
+import argparse
+import re
+import time
+from pathlib import Path
+
+import awkward as ak
+import numpy as np
+
+from pygama.evt.expressions import compile_expression
+from pygama.utils import load_dict
+
+CONFIG_DIR = Path(__file__).parents[1] / "tests" / "evt" / "configs"
+TIERS = ("dsp", "hit")
+FIELD_RE = re.compile(rf"\b({'|'.join(TIERS)})\.([a-zA-Z_$][\w$]*)")
+
+
+def collect_expressions() -> list[tuple[str, dict]]:
+    """The lower-tier expressions and queries, with their parameters."""
+    found = {}
+    for path in sorted(CONFIG_DIR.glob("*-config.*")):
+        for op in load_dict(str(path)).get("operations", {}).values():
+            mode = op.get("aggregation_mode", "")
+            if not mode or mode == "function":
+                continue
+            for key in ("expression", "query"):
+                expr = op.get(key)
+                if isinstance(expr, str) and FIELD_RE.search(expr):
+                    found[expr] = op.get("parameters", {})
+    return list(found.items())
+
+
+def make_variables(expr: str, n_rows: int, rng) -> dict:
+    """Synthetic columns for the fields in `expr` (negated fields are flags)."""
+    variables = {}
+    for tier, field in FIELD_RE.findall(expr):
+        if re.search(rf"~\s*\(?\s*{tier}\.{field}\b", expr):
+            col = rng.random(n_rows) < 0.5
+        else:
+            col = rng.normal(100, 50, n_rows)
+        variables[f"{tier}_{field}"] = ak.Array(col)
+    return variables
+
+
+def legacy(expr: str, variables: dict):
+    new_expr = expr
+    for name in ("evt", *TIERS):
+        if name == "evt":
+            new_expr = new_expr.replace(f"{name}.", "")
+        else:
+            new_expr = new_expr.replace(f"{name}.", f"{name}_")
+    return eval(new_expr, dict(variables))
+
+
+def compiled(expr: str, variables: dict):
+    return compile_expression(expr, ("evt", *TIERS))(variables)
+
+
+def run(engine, expr, variables, n_channels) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n_channels):
+        res = engine(expr, variables)
+        ak.to_numpy(res, allow_missing=False)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=10_000, help="hits per channel")
+    parser.add_argument("--channels", type=int, default=100)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+
+    print(f"{'expression':<40} {'eval [ms]':>10} {'compiled [ms]':>14} {'speedup':>8}")
+    for expr, parameters in collect_expressions():
+        variables = make_variables(expr, args.rows, rng) | parameters
+        if not np.array_equal(
+            ak.to_numpy(legacy(expr, variables)),
+            ak.to_numpy(compiled(expr, variables)),
+        ):
+            msg = f"engines disagree on '{expr}'"
+            raise RuntimeError(msg)
+
+        t_old = run(legacy, expr, variables, args.channels)
+        t_new = run(compiled, expr, variables, args.channels)
+        print(
+            f"{expr.strip():<40} {1e3 * t_old:>10.1f} {1e3 * t_new:>14.1f} "
+            f"{t_old / t_new:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
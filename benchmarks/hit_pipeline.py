@@ -0,0 +1,114 @@
+"""Benchmark the evaluation of the ``operations`` of `hit` configs.
+
+Evaluates the operations of a hit configuration on synthetic DSP chunks the
+way :func:`pygama.hit.build_hit` does: with the previous loop that calls
+:meth:`lgdo.Table.eval` for every operation of every chunk, and with the
+operations compiled once into a :class:`pygama.hit.build_hit._HitPipeline`.
+
+Usage::
+
+    $ python benchmarks/hit_pipeline.py --rows 1000000 --buffer-len 3200
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import lgdo
+import numpy as np
+
+from pygama.hit.build_hit import _HitPipeline
+
+OPERATIONS = {
+    "cuspEmax_ctc": {
+        "expression": "cuspEmax * (1 + a * dt_eff)",
+        "parameters": {"a": 2.5e-5},
+    },
+    "cuspEmax_ctc_cal": {
+        "expression": "a + b * cuspEmax_ctc + c * cuspEmax_ctc**2",
+        "parameters": {"a": 0.05, "b": 0.15, "c": 1e-9},
+    },
+    "AoE": {"expression": "A_max / cuspEmax_ctc_cal"},
+    "is_valid_0vbb": {
+        "expression": "(cuspEmax_ctc_cal > a) & (cuspEmax_ctc_cal < b)",
+        "parameters": {"a": 1900, "b": 3000},
+    },
+    "is_valid_t0": {
+        "expression": "(tp_0_est > a) & (tp_0_est < b)",
+        "parameters": {"a": 47000, "b": 55000},
+    },
+    "is_valid_baseline": {"expression": "abs(bl_slope) < a", "parameters": {"a": 0.1}},
+}
+
+
+def make_chunks(n_rows: int, buffer_len: int, rng) -> list[lgdo.Table]:
+    """Synthetic DSP chunks with the columns the operations read."""
+    chunks = []
+    for start in range(0, n_rows, buffer_len):
+        n = min(buffer_len, n_rows - start)
+        chunks.append(
+            lgdo.Table(
+                {
+                    "cuspEmax": lgdo.Array(rng.normal(10000, 3000, n)),
+                    "dt_eff": lgdo.Array(rng.normal(500, 100, n)),
+                    "A_max": lgdo.Array(rng.normal(1000, 300, n)),
+                    "tp_0_est": lgdo.Array(rng.normal(48000, 1000, n)),
+                    "bl_slope": lgdo.Array(rng.normal(0, 0.1, n)),
+                }
+            )
+        )
+    return chunks
+
+
+def legacy(chunks: list[lgdo.Table]) -> list[dict]:
+    results = []
+    for chunk in chunks:
+        tbl = lgdo.Table(col_dict=chunk)
+        for name, info in OPERATIONS.items():
+            tbl.add_column(name, tbl.eval(info["expression"], info.get("parameters")))
+        results.append({name: tbl[name].nda.copy() for name in OPERATIONS})
+    return results
+
+
+def compiled(chunks: list[lgdo.Table]) -> list[dict]:
+    pipeline = _HitPipeline(OPERATIONS)
+    results = []
+    for chunk in chunks:
+        tbl = lgdo.Table(col_dict=chunk)
+        pipeline(tbl)
+        # the pipeline reuses its buffers from chunk to chunk
+        results.append({name: tbl[name].nda.copy() for name in OPERATIONS})
+    return results
+
+
+def run(engine, chunks) -> tuple[float, list[dict]]:
+    t0 = time.perf_counter()
+    res = engine(chunks)
+    return time.perf_counter() - t0, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--buffer-len", type=int, default=3200)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.rows, args.buffer_len, np.random.default_rng(0))
+
+    t_old, res_old = run(legacy, chunks)
+    t_new, res_new = run(compiled, chunks)
+    for old, new in zip(res_old, res_new, strict=True):
+        for name in OPERATIONS:
+            if not np.array_equal(old[name], new[name]):
+                msg = f"engines disagree on '{name}'"
+                raise RuntimeError(msg)
+
+    print(f"{'engine':<12} {'time [s]':>9} {'rows/s':>12}")
+    for name, t in (("Table.eval", t_old), ("pipeline", t_new)):
+        print(f"{name:<12} {t:>9.2f} {args.rows / t:>12.3g}")
+    print(f"speedup: {t_old / t_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Benchmark the parallel backends of :mod:`pygama.datatools` queries.
+
+Writes a synthetic `evt` tier and runs the same :func:`pygama.datatools.query_evt`
+selection serially, and in parallel with ``backend="processes"`` and
+``backend="threads"``. A short query (few small runs), where the startup of the
+workers and the pickling of the iterator dominate, and a long one (many larger
+runs), where reading and evaluating the data dominates, are timed.
+
+Usage::
+
+    $ python benchmarks/query_backends.py --workers 4 --runs 200 --rows 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import awkward as ak
+import lh5
+import numpy as np
+from lgdo import Array, Table
+
+from pygama.datatools import query_evt
+
+
+def make_tier(root: Path, n_runs: int, n_rows: int, rng) -> dict:
+    """Synthetic evt files, one per run, and the dataflow config to query them."""
+    for i in range(n_runs):
+        run = f"r{i:03d}"
+        path = root / "evt/phy/p01" / run
+        path.mkdir(parents=True, exist_ok=True)
+        lh5.write(
+            Table(
+                {
+                    "energy": Array(rng.exponential(500, n_rows)),
+                    "aoe": Array(rng.normal(1, 0.1, n_rows)),
+                    "multiplicity": Array(rng.integers(0, 5, n_rows)),
+                }
+            ),
+            "evt",
+            str(path / f"l200-p01-{run}-phy-20230101T000000Z-tier_evt.lh5"),
+            wo_mode="of",
+        )
+    return {
+        "paths": {"tier_evt": str(root / "evt")},
+        "query": {
+            "cycle_def": "experiment-period-run-datatype-starttime",
+            "tiers": ["evt"],
+            "evt_tiers": ["evt"],
+            "tables": {"evt": "evt"},
+            "evt_tables": {"evt": "evt"},
+        },
+    }
+
+
+def run(dataflow_config: dict, workers: int | None, backend: str):
+    t0 = time.perf_counter()
+    res = query_evt(
+        ["energy", "aoe"],
+        None,
+        "(energy > 1000) & (multiplicity == 1) & (abs(aoe - 1) < 0.05)",
+        dataflow_config=dataflow_config,
+        processes=workers,
+        backend=backend,
+        library="ak",
+        progress=False,
+        run_index=False,
+    )
+    return time.perf_counter() - t0, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    workloads = {
+        "short": (min(args.runs, args.workers), args.rows // 100),
+        "long": (args.runs, args.rows),
+    }
+    engines = {
+        "serial": (None, "processes"),
+        "processes": (args.workers, "processes"),
+        "threads": (args.workers, "threads"),
+    }
+
+    print(f"{'workload':<9} {'backend':<10} {'time [s]':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for workload, (n_runs, n_rows) in workloads.items():
+            config = make_tier(Path(tmp, workload), n_runs, n_rows, rng)
+            times = {}
+            for name, (workers, backend) in engines.items():
+                # best of a few repetitions, to leave out the file system cache
+                t, res = min(
+                    (run(config, workers, backend) for _ in range(args.repeat)),
+                    key=lambda x: x[0],
+                )
+                times[name] = t
+                if name == "serial":
+                    ref = res
+                elif ak.to_list(res) != ak.to_list(ref):
+                    msg = f"backend '{name}' disagrees with the serial query"
+                    raise RuntimeError(msg)
+                print(f"{workload:<9} {name:<10} {t:>9.3f}")
+            best = min(times, key=times.get)
+            print(f"{workload:<9} fastest: {best}")
+
+
+if __name__ == "__main__":
+    main()
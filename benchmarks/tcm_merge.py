@@ -0,0 +1,247 @@
+"""Benchmark the TCM merge engine of :func:`pygama.evt.tcm.generate_tcm_cols`.
+
+Compares the compiled k-way merge against the previous awkward-based engine
+(a pure-Python merge loop followed by a full ``ak.concatenate``/``ak.copy`` of
+the pending buffer on every iteration), which is reproduced below. Both are
+fed from in-memory iterators, so that the numbers measure the merge and
+clustering only and not HDF5 decompression.
+
+Usage::
+
+    $ python benchmarks/tcm_merge.py --channels 10 100 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+
+import awkward as ak
+import numpy as np
+from lgdo import Array, Table, VectorOfVectors
+
+from pygama.evt import tcm as ptcm
+
+
+class MemoryIterator:
+    """Minimal stand-in for :class:`lh5.LH5Iterator` over an in-memory column."""
+
+    def __init__(self, timestamps: np.ndarray, buffer_len: int):
+        self.timestamps = timestamps
+        self.buffer_len = buffer_len
+        self.current_i_entry = 0
+        self._next = 0
+        self._buffer = Table(col_dict={"timestamp": Array(np.empty(buffer_len))})
+
+    def __next__(self) -> Table:
+        start = self._next
+        stop = min(start + self.buffer_len, len(self.timestamps))
+        if stop <= start:
+            raise StopIteration
+        # reuse the buffer the way LH5Iterator does
+        self._buffer.resize(stop - start)
+        self._buffer["timestamp"].nda[:] = self.timestamps[start:stop]
+        self.current_i_entry = start
+        self._next = stop
+        return self._buffer
+
+
+def legacy_generate_tcm_cols(iterators, coin_windows, table_keys):
+    """The awkward-based engine that the k-way merge replaced."""
+
+    def _sort_tcm(arr):
+        order = np.lexsort(
+            [
+                ak.to_numpy(arr["table_key"]),
+                *reversed([ak.to_numpy(arr[e.name]) for e in coin_windows]),
+            ]
+        )
+        return arr[order]
+
+    def _get_sort_keys(arr):
+        keys = [ak.to_numpy(arr[e.name]) for e in coin_windows]
+        keys.append(ak.to_numpy(arr["table_key"]))
+        return keys
+
+    def _merge_sorted_tcms(a, b):
+        if a is None or len(a) == 0:
+            return b
+        if b is None or len(b) == 0:
+            return a
+        a_keys = _get_sort_keys(a)
+        b_keys = _get_sort_keys(b)
+        na, nb = len(a), len(b)
+        out_idx = np.empty(na + nb, dtype=np.int64)
+        ia = ib = io = 0
+        while ia < na and ib < nb:
+            take_a = True
+            for ka, kb in zip(a_keys, b_keys, strict=False):
+                if ka[ia] < kb[ib]:
+                    break
+                if ka[ia] > kb[ib]:
+                    take_a = False
+                    break
+            if take_a:
+                out_idx[io] = ia
+                ia += 1
+            else:
+                out_idx[io] = na + ib
+                ib += 1
+            io += 1
+        if ia < na:
+            out_idx[io:] = np.arange(ia, na)
+        else:
+            out_idx[io:] = na + np.arange(ib, nb)
+        return ak.concatenate([a, b], axis=0)[out_idx]
+
+    iterators = np.array(iterators)
+    tcm = None
+    at_end = np.zeros(len(iterators), dtype=bool)
+    skip_mask = np.zeros(len(iterators), dtype=bool)
+    table_keys_np = np.asarray(table_keys, dtype=np.int64)
+    tk_sort = np.argsort(table_keys_np)
+    tk_unsort = np.argsort(tk_sort)
+    table_keys_sorted = table_keys_np[tk_sort]
+
+    while not at_end.all():
+        curr_mask = ~skip_mask & ~at_end
+        arrays = []
+        for ii in np.flatnonzero(curr_mask):
+            it = iterators[ii]
+            try:
+                buffer = it.__next__()
+            except StopIteration:
+                at_end[ii] = True
+                continue
+            buf_len, start = len(buffer), it.current_i_entry
+            if buf_len < it.buffer_len:
+                at_end[ii] = True
+            buf_ak = buffer.view_as("ak")[:buf_len]
+            buf_ak = ak.with_field(
+                buf_ak, np.full(buf_len, table_keys[ii], dtype=int), "table_key"
+            )
+            buf_ak = ak.with_field(
+                buf_ak, np.arange(start, start + buf_len), "row_in_table"
+            )
+            arrays.append(ak.copy(buf_ak))
+
+        if len(arrays) == 0 and tcm is None:
+            continue
+        new_tcm = _sort_tcm(ak.concatenate(arrays)) if arrays else None
+        tcm = ak.copy(new_tcm if tcm is None else _merge_sorted_tcms(tcm, new_tcm))
+        if len(tcm) == 0:
+            continue
+
+        mask = np.zeros(len(tcm) - 1, dtype=bool)
+        for entry in coin_windows:
+            mask |= np.diff(ak.to_numpy(tcm[entry.name])) > entry.window
+
+        table_key_np = ak.to_numpy(tcm["table_key"])
+        last_sorted = np.full(table_keys_sorted.size, -1, dtype=np.int64)
+        np.maximum.at(
+            last_sorted,
+            np.searchsorted(table_keys_sorted, table_key_np),
+            np.arange(table_key_np.size),
+        )
+        last = last_sorted[tk_unsort].astype(float)
+        last[(last < 0) | at_end] = np.inf
+
+        active = np.flatnonzero(~at_end)
+        skip_mask = np.zeros(len(table_keys), dtype=bool)
+        if len(active) > 1:
+            skip_mask = last >= last[active[0]]
+            if skip_mask.all():
+                skip_mask[:] = False
+
+        if at_end.all():
+            write_mask, last_entry = mask, None
+        else:
+            split = np.flatnonzero(mask[: int(np.min(last))])
+            if len(split) == 0:
+                continue
+            last_entry = split[-1] + 1
+            write_mask = mask[:last_entry]
+
+        cumulative_length = np.flatnonzero(write_mask) + 1
+        if at_end.all():
+            cumulative_length = np.append(cumulative_length, len(write_mask) + 1)
+        out_tbl = Table(size=len(cumulative_length))
+        for f in ("table_key", "row_in_table"):
+            out_tbl.add_field(
+                f,
+                VectorOfVectors(
+                    cumulative_length=cumulative_length,
+                    flattened_data=ak.to_numpy(tcm[f])[:last_entry],
+                ),
+            )
+        tcm = None if last_entry is None else tcm[last_entry:]
+        yield out_tbl
+
+
+def make_data(n_channels: int, n_hits: int, seed: int = 0) -> list[np.ndarray]:
+    """Per-channel sorted timestamps, with a common trigger in half the events."""
+    rng = np.random.default_rng(seed)
+    triggers = np.sort(rng.uniform(0, 1e3, n_hits))
+    data = []
+    for _ in range(n_channels):
+        ts = np.where(rng.random(n_hits) < 0.5, triggers, rng.uniform(0, 1e3, n_hits))
+        data.append(np.sort(ts))
+    return data
+
+
+def run(engine, data, buffer_len, window) -> tuple[float, np.ndarray]:
+    iterators = [MemoryIterator(ts, buffer_len) for ts in data]
+    coin_windows = [ptcm.coin_groups("timestamp", window, "last")]
+    table_keys = list(range(len(data)))
+
+    t0 = time.perf_counter()
+    tables = list(engine(iterators, coin_windows=coin_windows, table_keys=table_keys))
+    elapsed = time.perf_counter() - t0
+
+    flat = np.concatenate([t.table_key.flattened_data.nda for t in tables])
+    return elapsed, flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--channels", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--hits", type=int, default=500, help="hits per channel")
+    parser.add_argument("--buffer-len", type=int, default=100)
+    parser.add_argument("--window", type=float, default=1e-6)
+    parser.add_argument(
+        "--skip-legacy",
+        action="store_true",
+        help="only time the k-way merge engine",
+    )
+    args = parser.parse_args()
+
+    # compile the numba kernels outside of the timed region
+    run(ptcm.generate_tcm_cols, make_data(3, 10), 4, args.window)
+
+    print(
+        f"{'channels':>8} {'hits':>9} {'legacy [s]':>11} {'k-way [s]':>10} {'speedup':>8}"
+    )
+    for n_channels in args.channels:
+        data = make_data(n_channels, args.hits)
+        t_new, flat_new = run(
+            ptcm.generate_tcm_cols, data, args.buffer_len, args.window
+        )
+
+        if args.skip_legacy:
+            t_old = float("nan")
+        else:
+            t_old, flat_old = run(
+                legacy_generate_tcm_cols, data, args.buffer_len, args.window
+            )
+            if not np.array_equal(flat_old, flat_new):
+                msg = f"engines disagree at {n_channels} channels"
+                raise RuntimeError(msg)
+
+        print(
+            f"{n_channels:>8} {n_channels * args.hits:>9} {t_old:>11.3f} "
+            f"{t_new:>10.3f} {t_old / t_new:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
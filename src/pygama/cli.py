@@ -11,7 +11,7 @@ from pathlib import Path
 
 import pygama
 import pygama.logging
-from pygama.hit import build_hit
+from pygama.hit import build_hit_batch
 
 
 def pygama_cli():
@@ -123,6 +123,14 @@ def add_build_hit_parser(subparsers):
         help="""Number of waveforms to read from disk at a time. Default is
                 3200""",
     )
+    parser_r2d.add_argument(
+        "--jobs",
+        "-j",
+        default=None,
+        type=int,
+        help="""Number of processes over which the tables of all the input
+                files are spread. By default process them one at a time""",
+    )
 
     group = parser_r2d.add_mutually_exclusive_group()
     group.add_argument(
@@ -155,7 +163,7 @@ def add_build_hit_parser(subparsers):
 
 
 def build_hit_cli(args):
-    """Passes command line arguments to :func:`.hit.build_hit.build_hit`."""
+    """Passes command line arguments to :func:`.hit.build_hit.build_hit_batch`."""
 
     if len(args.dsp_lh5_file) > 1 and args.output is not None:
         msg = "not possible to set multiple output file names yet"
@@ -173,13 +181,12 @@ def build_hit_cli(args):
             basename = Path(file).stem.removesuffix("_dsp")
             out_files.append(f"{basename}_hit.lh5")
 
-    for i in range(len(args.dsp_lh5_file)):
-        build_hit(
-            args.dsp_lh5_file[i],
-            args.config,
-            outfile=out_files[i],
-            lh5_tables=args.hdf5_groups,
-            n_max=args.max_rows,
-            wo_mode=args.writemode,
-            buffer_len=args.chunk,
-        )
+    build_hit_batch(
+        zip(args.dsp_lh5_file, out_files, strict=True),
+        processes=args.jobs,
+        hit_config=args.config,
+        lh5_tables=args.hdf5_groups,
+        n_max=args.max_rows,
+        wo_mode=args.writemode,
+        buffer_len=args.chunk,
+    )
@@ -25,6 +25,9 @@ Several query commands exist, to access data at different levels:
 - :meth:`query_hist` accesses event data, as above, and returns a histogram
 - :meth:`query_evt` accesses `evt` tier data for a selection of runs; note that this
   cannot make use of other data tiers or of metadata (yet...)
+- :class:`QueryCache` stores the results of :meth:`query_data`, :meth:`query_hist`
+  and :meth:`query_evt` on disk, to reuse them when a query is repeated (pass it
+  as ``cache``)
 - :meth:`build_iterator` creates a :class:`LH5Iterator` object to load a selection of
   data fields and metadata for a selection of channels and runs. This can be used to
   perform more advanced queries if needed.
@@ -53,6 +56,7 @@ A template for a minimal `dataflow-config.yaml` file:
         cycle_def: experiment-period-run-datatype-starttime # REQUIRED: hyphen-separated-list-of-fields-in-cycle-name; these will be columns of run db
         metadata: LegendMetadata # REQUIRED: name of metadata class (e.g. LegendMetadata)
         ignored_cycles: dataprod/config/ignored_cycles # path in metadata to list of cycles to skip; by default do not ignore any
+        run_index: $_/.run_index.sqlite # file used to store the list of files in each tier, to avoid rescanning unchanged directories; by default next to this file
         tiers: ["raw", "dsp", "hit", "tcm", "evt"] # list of tiers TLAs to use from paths for parameter and data queries; default use all
 
         tables: # mapping from tier names to table paths in lh5 files
@@ -93,8 +97,12 @@ from .query_evt import query_evt
 from .query_hist import query_hist
 from .query_meta import query_meta
 from .query_runs import list_run_fields, query_runs
+from .result_cache import QueryCache
+from .run_index import RunIndex
 
 __all__ = [
+    "QueryCache",
+    "RunIndex",
     "build_iterator",
     "list_run_fields",
     "query_data",
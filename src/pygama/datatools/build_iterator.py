@@ -80,7 +80,8 @@ def build_iterator(
         or:class:`rich.Console`
 
     query_meta_kwargs
-        additional keyword arguments for :meth:`query_meta` and :meth:`query_runs`
+        additional keyword arguments for :meth:`query_meta` and :meth:`query_runs`,
+        e.g. ``processes`` and ``backend`` to parallelize the metadata query
     """
     with ExitStack() as stack:
         status = _setup_spinner(stack, progress)
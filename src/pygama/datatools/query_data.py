@@ -11,6 +11,7 @@ from rich.console import Console
 from rich.status import Status
 
 from . import build_iterator
+from .result_cache import QueryCache, _cached_query, _open_query_cache
 from .utils import _setup_executor, _setup_spinner, parse_query_paths
 
 
@@ -25,8 +26,10 @@ def query_data(
     return_alias_map: bool = False,
     processes: int | None = None,
     executor: Executor | None = None,
+    backend: str = "processes",
     library: str | None = None,
     progress: Status | Console | bool = True,
+    cache: str | Path | QueryCache | None = None,
     **kwargs,
 ):
     """
@@ -125,8 +128,15 @@ def query_data(
 
     executor:
         :class:`concurrent.futures.Executor` object for managing parallelism.
-        If ``None``, create a :class:`concurrent.futures.`ProcessPoolExecutor`
-        with number of processes equal to ``processes``.
+        If ``None``, create one with number of workers equal to ``processes``,
+        according to ``backend``.
+
+    backend:
+        kind of executor to create if ``executor`` is ``None``: ``"processes"``
+        (default) for a :class:`concurrent.futures.ProcessPoolExecutor`, or
+        ``"threads"`` for a :class:`concurrent.futures.ThreadPoolExecutor`. Threads
+        share the metadata and iterators instead of pickling them for each worker,
+        and start faster, which favours short queries
 
     library
         format of returned table. Can be ``ak`` (default), ``pd`` or ``np``
@@ -135,6 +145,10 @@ def query_data(
         if ``True`` draw progress bar; can also provide a :class:`rich.Status`
         or:class:`rich.Console`
 
+    cache
+        :class:`QueryCache` or directory of one, to store the result of this query
+        and reuse it when it is repeated. If ``None`` (default), do not cache.
+
     kwargs
         see :meth:`build_iterator`, :meth:`query_meta` and :meth:`query_runs`
     """
@@ -143,9 +157,31 @@ def query_data(
     entries_fields = parse_query_paths(entries)
 
     with ExitStack() as stack:
-        processes, executor = _setup_executor(stack, processes, executor)
+        processes, executor = _setup_executor(stack, processes, executor, backend)
         status = _setup_spinner(stack, progress)
 
+        cache = _open_query_cache(stack, cache)
+        if cache is not None:
+            return _cached_query(
+                cache,
+                query_data,
+                {
+                    "fields": fields,
+                    "channels": channels,
+                    "entries": entries,
+                    "return_query_vals": return_query_vals,
+                    "return_alias_map": return_alias_map,
+                    "library": library,
+                },
+                runs,
+                dataflow_config=dataflow_config,
+                tiers_key="tiers",
+                processes=processes,
+                executor=executor,
+                progress=status,
+                **kwargs,
+            )
+
         lh5_it, alias_map = build_iterator(
             {f for f, _, _ in field_info + entries_fields},
             runs,
@@ -12,7 +12,8 @@ from lh5 import LH5Iterator
 from rich.console import Console
 from rich.status import Status
 
-from . import query_runs
+from .query_runs import query_runs
+from .result_cache import QueryCache, _cached_query, _open_query_cache
 from .utils import (
     _read_dataflow_config,
     _setup_executor,
@@ -32,8 +33,10 @@ def query_evt(
     return_query_vals: bool = False,
     processes: Executor | int | None = None,
     executor: Executor | None = None,
+    backend: str = "processes",
     library: str | None = None,
     progress: Status | Console | bool = True,
+    cache: str | Path | QueryCache | None = None,
     **kwargs,
 ):
     """
@@ -108,8 +111,15 @@ def query_evt(
 
     executor:
         :class:`concurrent.futures.Executor` object for managing parallelism.
-        If ``None``, create a :class:`concurrent.futures.`ProcessPoolExecutor`
-        with number of processes equal to ``processes``.
+        If ``None``, create one with number of workers equal to ``processes``,
+        according to ``backend``.
+
+    backend:
+        kind of executor to create if ``executor`` is ``None``: ``"processes"``
+        (default) for a :class:`concurrent.futures.ProcessPoolExecutor`, or
+        ``"threads"`` for a :class:`concurrent.futures.ThreadPoolExecutor`. Threads
+        share the metadata and iterators instead of pickling them for each worker,
+        and start faster, which favours short queries
 
     library
         format of returned table. Can be ``ak`` (default), ``pd`` or ``np``
@@ -118,6 +128,10 @@ def query_evt(
         if ``True`` draw progress bar; can also provide a :class:`rich.Status`
         or:class:`rich.Console`
 
+    cache
+        :class:`QueryCache` or directory of one, to store the result of this query
+        and reuse it when it is repeated. If ``None`` (default), do not cache.
+
     kwargs
         see :meth:`query_runs`
     """
@@ -127,8 +141,31 @@ def query_evt(
     all_paths = {path for _, _, path in field_info + events_fields}
 
     with ExitStack() as stack:
-        processes, executor = _setup_executor(stack, processes, executor)
+        processes, executor = _setup_executor(stack, processes, executor, backend)
         status = _setup_spinner(stack, progress)
+
+        cache = _open_query_cache(stack, cache)
+        if cache is not None:
+            return _cached_query(
+                cache,
+                query_evt,
+                {
+                    "fields": fields,
+                    "events": events,
+                    "tables": tables,
+                    "return_query_vals": return_query_vals,
+                    "library": library,
+                },
+                runs,
+                dataflow_config=dataflow_config,
+                tiers_key="evt_tiers",
+                processes=processes,
+                executor=executor,
+                progress=status,
+                tiers=tiers,
+                **kwargs,
+            )
+
         df_config, df_paths, query_config = _read_dataflow_config(dataflow_config)
 
         # Query (or convert) run_records
@@ -12,7 +12,10 @@ import pandas as pd
 from rich.console import Console
 from rich.status import Status
 
-from . import build_iterator, query_meta, query_runs
+from .build_iterator import build_iterator
+from .query_meta import query_meta
+from .query_runs import query_runs
+from .result_cache import QueryCache, _cached_query, _open_query_cache
 from .utils import _setup_executor, _setup_spinner, parse_query_paths
 
 
@@ -25,7 +28,9 @@ def query_hist(
     dataflow_config: Path | str | Mapping = "$REFPROD/dataflow-config.yaml",
     processes: int | None = None,
     executor: Executor | None = None,
+    backend: str = "processes",
     progress: Status | Console | bool = True,
+    cache: str | Path | QueryCache | None = None,
     **kwargs,
 ):
     """
@@ -126,13 +131,24 @@ def query_hist(
 
     executor:
         :class:`concurrent.futures.Executor` object for managing parallelism.
-        If ``None``, create a :class:`concurrent.futures.`ProcessPoolExecutor`
-        with number of processes equal to ``processes``.
+        If ``None``, create one with number of workers equal to ``processes``,
+        according to ``backend``.
+
+    backend:
+        kind of executor to create if ``executor`` is ``None``: ``"processes"``
+        (default) for a :class:`concurrent.futures.ProcessPoolExecutor`, or
+        ``"threads"`` for a :class:`concurrent.futures.ThreadPoolExecutor`. Threads
+        share the metadata and iterators instead of pickling them for each worker,
+        and start faster, which favours short queries
 
     progress:
         if ``True`` draw progress bar; can also provide a :class:`rich.Status`
         or:class:`rich.Console`
 
+    cache
+        :class:`QueryCache` or directory of one, to store the result of this query
+        and reuse it when it is repeated. If ``None`` (default), do not cache.
+
     kwargs
         see :meth:build_iterator, :meth:query_meta, :meth:query_runs, and :meth:Hist
     """
@@ -153,9 +169,24 @@ def query_hist(
     entries_fields = parse_query_paths(entries)
 
     with ExitStack() as stack:
-        processes, executor = _setup_executor(stack, processes, executor)
+        processes, executor = _setup_executor(stack, processes, executor, backend)
         status = _setup_spinner(stack, progress)
 
+        cache = _open_query_cache(stack, cache)
+        if cache is not None:
+            return _cached_query(
+                cache,
+                query_hist,
+                {"axes": axes, "channels": channels, "entries": entries},
+                runs,
+                dataflow_config=dataflow_config,
+                tiers_key="tiers",
+                processes=processes,
+                executor=executor,
+                progress=status,
+                **kwargs,
+            )
+
         # split kwargs up based on which function they should feed into
         bi_kwargs = {}
         hist_kwargs = {}
@@ -17,7 +17,8 @@ import awkward as ak
 import legendmeta
 import numpy as np
 import pandas as pd
-from dbetto import TextDB
+from dbetto import AttrsDict, TextDB
+from dbetto.catalog import Catalog
 from legendmeta import MetadataRepository
 from rich.console import Console
 from rich.status import Status
@@ -50,6 +51,7 @@ def query_meta(
     return_alias_map: bool = False,
     processes: int | None = None,
     executor: Executor | None = None,
+    backend: str = "processes",
     library: str = "ak",
     progress: Status | Console | bool = True,
     **query_run_kwargs,
@@ -196,8 +198,15 @@ def query_meta(
 
     executor:
         :class:`concurrent.futures.Executor` object for managing parallelism.
-        If ``None``, create a :class:`concurrent.futures.`ProcessPoolExecutor`
-        with number of processes equal to ``processes``.
+        If ``None``, create one with number of workers equal to ``processes``,
+        according to ``backend``.
+
+    backend:
+        kind of executor to create if ``executor`` is ``None``: ``"processes"``
+        (default) for a :class:`concurrent.futures.ProcessPoolExecutor`, or
+        ``"threads"`` for a :class:`concurrent.futures.ThreadPoolExecutor`. Threads
+        share the metadata and iterators instead of pickling them for each worker,
+        and start faster, which favours short queries
 
     library
         format of returned table. Can be ``ak`` (default), ``pd`` or ``np``
@@ -210,7 +219,7 @@ def query_meta(
         see :meth:`query_runs`
     """
     with ExitStack() as stack:
-        processes, executor = _setup_executor(stack, processes, executor)
+        processes, executor = _setup_executor(stack, processes, executor, backend)
         status = _setup_spinner(stack, progress)
         df_config, df_paths, query_config = _read_dataflow_config(dataflow_config)
 
@@ -385,14 +394,13 @@ def query_meta(
                 raise ValueError(msg)
 
         # Now run the query...
+        meta_cache = _MetaCache(meta, chan_db, db_list)
         if executor is None:
             records, eval_success, path_hits = _query_loop(
                 run_records,
                 col_list,
                 channels,
-                meta,
-                chan_db,
-                db_list,
+                meta_cache,
                 col_name_map,
                 group_chans,
             )
@@ -400,6 +408,7 @@ def query_meta(
             records = []
             eval_success = False
             path_hits = {}
+            # workers receive the cache with its databases unloaded; see _MetaCache
             for rec, es, ph in executor.map(
                 _query_loop,
                 batched(run_records, int(np.ceil(len(run_records) / processes)))
@@ -413,9 +422,7 @@ def query_meta(
                 ],
                 repeat(col_list, processes),
                 repeat(channels, processes),
-                repeat(meta, processes),
-                repeat(chan_db, processes),
-                repeat(db_list, processes),
+                repeat(meta_cache, processes),
                 repeat(col_name_map, processes),
                 repeat(group_chans, processes),
             ):
@@ -468,17 +475,135 @@ def query_meta(
         return result
 
 
+# Databases whose validity entries determine LegendMetadata.channelmap()
+_CHANMAP_DBS = (
+    "hardware.configuration.channelmaps",
+    "datasets.statuses",
+    "dataprod.config",
+)
+
+
+def _unloaded(db):
+    # shallow copy of a TextDB with an empty, lazy store, which is cheap to pickle
+    # and reloads only the entries that are accessed
+    if not isinstance(db, TextDB):
+        return db
+    db = copy(db)
+    db.__store__ = AttrsDict()
+    db.__lazy__ = True
+    return db
+
+
+class _MetaCache:
+    """
+    Memoised access to the channel maps and cycle databases of :meth:`query_meta`.
+
+    Results of ``TextDB.on`` and ``channelmap`` are stored by the validity entries
+    that apply at the requested time rather than by the time itself, so that the
+    runs sharing an entry share a single object. Validity files are parsed once
+    per database. When pickled for a worker process, the metadata and databases
+    are sent without their loaded contents and the caches are left behind.
+    """
+
+    def __init__(self, meta: MetadataRepository, chan_db: str | None, db_list: dict):
+        self.meta = meta
+        self.chan_db = chan_db
+        self.db_list = db_list
+        self._catalogs = {}
+        self._entries = {}
+
+    def __getstate__(self):
+        return {
+            "meta": _unloaded(self.meta),
+            "chan_db": self.chan_db,
+            "db_list": {
+                k: None if info is None else info | {"db": _unloaded(info["db"])}
+                for k, info in self.db_list.items()
+            },
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _valid_files(self, db: TextDB, time: str) -> tuple:
+        # files of the validity entry of db at time, with the same validity
+        # file lookup as TextDB.on
+        path = db.__path__
+        if path not in self._catalogs:
+            validity = None
+            for ext in [*db.__extensions__, ".jsonl"]:
+                if (path / f"validity{ext}").is_file():
+                    validity = path / f"validity{ext}"
+                    break
+            self._catalogs[path] = (
+                None if validity is None else Catalog.read_from(validity)
+            )
+        if self._catalogs[path] is None:
+            msg = f"no validity.* file found in {path!s}"
+            raise RuntimeError(msg)
+
+        files = self._catalogs[path].valid_for(time)
+        return tuple(files) if isinstance(files, list) else (files,)
+
+    def _memo(self, key, load):
+        if key not in self._entries:
+            self._entries[key] = load()
+        return self._entries[key]
+
+    def on(self, db: TextDB, time: str):
+        """Return ``db.on(time)``, loaded once per validity entry."""
+        key = ("on", db.__path__, self._valid_files(db, time))
+        return self._memo(key, lambda: db.on(time))
+
+    def channelmap(self, run_record: dict, time: str):
+        """Return the channel map of a run, loaded once per validity entry."""
+        if self.chan_db:
+            entry = self.chan_db.format(**run_record)
+            return self._memo(("chan_db", entry), lambda: self.meta[entry])
+
+        if not time:
+            msg = "starttime not found in rundb, cannot access channelmap"
+            raise ValueError(msg)
+        try:
+            key = ["channelmap"]
+            for path in _CHANMAP_DBS:
+                try:
+                    db = get_recursive(self.meta, path.replace(".", "/"))
+                except (KeyError, AttributeError, FileNotFoundError):
+                    continue
+                if isinstance(db, TextDB):
+                    key.append(self._valid_files(db, time))
+            key = tuple(key) if len(key) > 1 else ("channelmap", time)
+        except RuntimeError:
+            key = ("channelmap", time)
+        return self._memo(key, lambda: self.meta.channelmap(on=time))
+
+    def cycle_db(self, name: str, run_record: dict, time: str):
+        """Return the entry of database ``name`` for a run."""
+        db_info = self.db_list[name]
+        if "cycle_entry" not in db_info:
+            if not time:
+                msg = f"starttime not found in rundb, cannot access {name} db"
+                raise ValueError(msg)
+            return self.on(db_info["db"], time)
+
+        entry = db_info["cycle_entry"].format(**run_record)
+        return self._memo(
+            ("cycle_entry", name, entry),
+            lambda: get_recursive(db_info["db"], entry),
+        )
+
+
 def _query_loop(
     run_records: Collection,
     col_list: set,
     channels: str,
-    meta: MetadataRepository,
-    chan_db: str | None,
-    db_list: dict[str, TextDB],
+    meta_cache: _MetaCache,
     col_name_map: dict,
     group_chans: bool,
 ):
     # Now loop through the runs, perform channel queries, and fetch fields
+    db_list = meta_cache.db_list
     records = []
     path_hits = dict.fromkeys(
         col_name_map, 0
@@ -501,26 +626,12 @@ def _query_loop(
             if db_info is None:
                 continue
             try:
-                if "cycle_entry" not in db_info:
-                    if not time:
-                        msg = f"starttime not found in rundb, cannot access {k} db"
-                        raise ValueError(msg)
-                    cycle_dbs[k] = db_info["db"].on(time)
-                else:
-                    cycle_dbs[k] = get_recursive(
-                        db_info["db"], db_info["cycle_entry"].format(**run_record)
-                    )
+                cycle_dbs[k] = meta_cache.cycle_db(k, run_record, time)
             except RuntimeError:
                 # if there is no valid parameter database for this run...
                 cycle_dbs[k] = None
 
-        if not chan_db:
-            if not time:
-                msg = "starttime not found in rundb, cannot access channelmap"
-                raise ValueError(msg)
-            chanlist = meta.channelmap(on=time)
-        else:
-            chanlist = meta[chan_db.format(run_record)]
+        chanlist = meta_cache.channelmap(run_record, time)
 
         # Get run DB entry corresponding to current run and get @run values
         for path, alias in col_name_map.items():
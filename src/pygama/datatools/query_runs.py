@@ -1,19 +1,21 @@
 from __future__ import annotations
 
+import ast
 import os
 import re
 from collections.abc import Collection, Mapping
 from concurrent.futures import Executor
 from contextlib import ExitStack
-from copy import copy
 from pathlib import Path
 
 import awkward as ak
 import numpy as np
+import pandas as pd
 from dbetto import TextDB
 from rich.console import Console
 from rich.status import Status
 
+from .run_index import RunIndex, _open_run_index
 from .utils import _read_dataflow_config, _setup_executor, _setup_spinner, get_recursive
 
 
@@ -27,8 +29,10 @@ def query_runs(
     tiers: str | Collection[str] | Mapping[str, str] | None = None,
     join: str = "inner",
     ignored_cycles: str | Collection[str] | None = None,
+    run_index: str | Path | RunIndex | bool | None = None,
     processes: int | None = None,
     executor: Executor | None = None,
+    backend: str = "processes",
     library: str = "ak",
     progress: Status | Console | bool = True,
 ):
@@ -100,14 +104,29 @@ def query_runs(
         path(s) in metadata to list(s) of ignored cycles. By default get from dataflow-config,
         or else do not skip any cycles.
 
+    run_index
+        SQLite file (or :class:`.RunIndex`) storing the file names found in the
+        directories of each tier, with the modification times of the directories.
+        Only directories that changed since the last query are listed again. By
+        default, get from dataflow-config, or else use ``.run_index.sqlite`` next
+        to ``dataflow-config.yaml`` if that directory is writable. If ``False``,
+        do not keep the index between queries.
+
     processes:
         number of processes. If ``None``, use number equal to threads available
         to ``executor`` (if provided), or else do not parallelize
 
     executor:
         :class:`concurrent.futures.Executor` object for managing parallelism.
-        If ``None``, create a :class:`concurrent.futures.`ProcessPoolExecutor`
-        with number of processes equal to ``processes``.
+        If ``None``, create one with number of workers equal to ``processes``,
+        according to ``backend``.
+
+    backend:
+        kind of executor to create if ``executor`` is ``None``: ``"processes"``
+        (default) for a :class:`concurrent.futures.ProcessPoolExecutor`, or
+        ``"threads"`` for a :class:`concurrent.futures.ThreadPoolExecutor`. Threads
+        share the metadata and iterators instead of pickling them for each worker,
+        and start faster, which favours short queries
 
     library
         format of returned table. Can be ``ak`` (default), ``pd`` or ``np``
@@ -116,10 +135,17 @@ def query_runs(
         if ``True`` draw progress spinner; can also provide a :class:`rich.Status`
         or:class:`rich.Console`
     """
+    config_dir = None
+    if isinstance(dataflow_config, (Path, str)):
+        config_dir = str(Path(os.path.expandvars(dataflow_config)).parent)
+
     with ExitStack() as stack:
-        _, executor = _setup_executor(stack, processes, executor)
+        _, executor = _setup_executor(stack, processes, executor, backend)
         progress = _setup_spinner(stack, progress)
         dataflow_config, df_paths, query_config = _read_dataflow_config(dataflow_config)
+        if run_index is None:
+            run_index = query_config.get("run_index", None)
+        run_index = _open_run_index(stack, run_index, config_dir)
 
         if cycle_def is None:
             if "cycle_def" not in query_config:
@@ -166,91 +192,71 @@ def query_runs(
             removed = set()
 
         col_names = cycle_def.split("-")
-        records = []
-
-        for dirpath, dirnames, files in os.walk(base_path, followlinks=True):
-            relpath = os.path.relpath(
-                dirpath, base_path
-            )  # get rid of base_path and the following slash
-
-            # Prune subdirectories that are not in all tiers
-            if join == "inner":
-                for subdir in copy(dirnames):
-                    if not all(
-                        Path(p, relpath, subdir).is_dir() for _, p in other_tiers
-                    ):
-                        dirnames.remove(subdir)
-
-            if executor is None:
-                records += _get_run_records_loop(
-                    files,
-                    relpath,
-                    col_names,
-                    this_tier,
-                    other_tiers,
-                    join == "inner",
-                    removed,
-                    runs,
-                )
-            else:
-                records.append(
-                    executor.submit(
-                        _get_run_records_loop,
-                        files,
-                        relpath,
-                        col_names,
-                        this_tier,
-                        other_tiers,
-                        join == "inner",
-                        removed,
-                        runs,
-                    )
-                )
 
-        if executor is not None:
-            records = [r for recs in records for r in recs.result()]
+        # list the files of each tier, from the run index
+        this_tree = run_index.list_tree(base_path)
+        other_trees = [run_index.list_tree(p) for _, p in other_tiers]
+
+        relpaths = sorted(this_tree)
+        # skip directories that are not in all tiers
+        if join == "inner":
+            relpaths = [r for r in relpaths if all(r in tree for tree in other_trees)]
+
+        if executor is None:
+            cycles = [_find_cycles(this_tree[r], this_tier[0]) for r in relpaths]
+        else:
+            cycles = [
+                executor.submit(_find_cycles, this_tree[r], this_tier[0])
+                for r in relpaths
+            ]
+            cycles = [c.result() for c in cycles]
+
+        records = _get_run_records(
+            relpaths,
+            cycles,
+            col_names,
+            this_tier,
+            [
+                (t, p, tree)
+                for (t, p), tree in zip(other_tiers, other_trees, strict=True)
+            ],
+            join == "inner",
+            removed,
+        )
+        records = _select_runs(records, runs)
 
         # If outer join, recursively query other tiers and perform outer join
-        if join == "outer" and len(tiers) > 1:
+        if join == "outer" and len(tier_list) > 1:
             other = query_runs(
                 runs=runs,
                 dataflow_config=dataflow_config,
                 group_by=None,
                 sort_by=sort_by,
-                tiers=tiers[1:],
+                cycle_def=cycle_def,
+                tiers={t[len("tier_") :]: p for t, p in tier_list[1:]},
                 join="outer",
                 ignored_cycles=ignored_cycles,
+                run_index=run_index,
                 processes=processes,
                 executor=executor,
                 library="pd",
                 progress=progress,
             )
-
             if len(other) == 0:
-                records = [r | {f"tier_{t}": None for t in tiers[1:]} for r in records]
-            elif len(records) == 0:
-                records = [r | {f"tier_{this_tier}": None} for r in other]
-            else:
-                records = (
-                    ak.to_dataframe(records)
-                    .merge(
-                        other,
-                        on=["cycle", "relpath", *col_names],
-                        how="outer",
-                    )
-                    .where(records.notna(), None)
-                    .to_dict(orient="records")
+                other = pd.DataFrame(
+                    columns=[*col_names, "relpath", "cycle"]
+                    + [t for t, _ in tier_list[1:]]
                 )
+            records = records.merge(
+                other, on=[*col_names, "relpath", "cycle"], how="outer"
+            )
+            records = records.astype(object).where(records.notna(), None)
 
         # Format and return results
-        records.sort(
-            key=lambda rec: (
-                rec[sort_by]
-                if isinstance(sort_by, str)
-                else [rec[sb] for sb in sort_by]
-            )
+        records = records.sort_values(
+            sort_by if isinstance(sort_by, str) else list(sort_by), kind="stable"
         )
-        result = ak.Array(records)
+        result = ak.Array({c: _to_ak(records[c]) for c in records.columns})
 
         if group_by is not None:
             if isinstance(group_by, str):
@@ -330,61 +336,138 @@ def list_run_fields(
     return {"relpath", "cycle"} | set(cycle_def.split("-")) | {t[0] for t in tiers}
 
 
-def _get_run_records_loop(
-    files: list[str],
-    relpath: str,
+def _find_cycles(files: list[str], tier: str) -> list[str]:
+    # Worker for query_runs to parse the cycle names of the files of a directory
+    # in one pass
+    return re.findall(
+        f"^(.*)-{tier}\\.lh5", "\n".join(sorted(files)), flags=re.MULTILINE
+    )
+
+
+def _get_run_records(
+    relpaths: list[str],
+    cycles: list[list[str]],
     col_names: list[str],
     this_tier: tuple[str, str],
-    other_tiers: list[tuple[str, str]],
+    other_tiers: list[tuple[str, str, dict[str, list[str]]]],
     inner_join: bool,
     removed: set[str],
-    runs,
-):
-    # Worker for query_runs to build a list of records for a directory
-    records = []
-    # parser to identify data files
-    parse_cycle = re.compile(f"(.*)-{this_tier[0]}\\.lh5")
-
-    # parse file names for data
-    for f in sorted(files):
-        record = dict.fromkeys(col_names)
-        record["relpath"] = relpath
-
-        match = parse_cycle.search(f)
-        if not match:
-            continue
-        cycle_name = match.group(1)
-        if cycle_name in removed:
-            continue
-
-        # extract fields from cycle name
-        cycle = cycle_name
-        cycle_vals = cycle_name.split("-")
-        if len(cycle_vals) != len(col_names):
-            continue
-
-        for k, v in zip(col_names, cycle_vals, strict=True):
-            record[k] = v
-        record["cycle"] = cycle
-        record[this_tier[0]] = f"{this_tier[1]}/{relpath}/{f}"
-
-        # evaluate the selection
-        select_run = eval(runs, {}, record) if runs else True
-        if not bool(select_run):
-            continue
-
-        # check if file exists in all tiers and add other tiers' files
-        for t, p in other_tiers:
-            path = f"{p}/{relpath}/{cycle}-{t}.lh5"
-            if not Path(path).exists():
-                if inner_join:
-                    record = None
-                    break
-                path = None
-            record[t] = path
-        if not record:
+) -> pd.DataFrame:
+    # Build the table of cycles found in each directory, as columns
+    relpath = pd.Series(
+        np.repeat(relpaths, [len(c) for c in cycles]).astype(object), dtype=object
+    )
+    cycle = pd.Series([c for dir_cycles in cycles for c in dir_cycles], dtype=object)
+
+    keep = cycle.str.count("-") == len(col_names) - 1
+    if removed:
+        keep &= ~cycle.isin(removed)
+    relpath = relpath[keep].reset_index(drop=True)
+    cycle = cycle[keep].reset_index(drop=True)
+
+    # extract fields from cycle names
+    records = pd.DataFrame(columns=col_names, dtype=object)
+    if len(cycle) > 0:
+        records = cycle.str.split("-", expand=True)
+        records.columns = col_names
+    records["relpath"] = relpath
+    records["cycle"] = cycle
+    records[this_tier[0]] = (
+        f"{this_tier[1]}/" + relpath + "/" + cycle + f"-{this_tier[0]}.lh5"
+    )
+
+    # check if file exists in all tiers and add other tiers' files
+    for t, p, tree in other_tiers:
+        tier_files = {f"{r}/{f}" for r, files in tree.items() for f in files}
+        files = relpath + "/" + cycle + f"-{t}.lh5"
+        found = files.isin(tier_files)
+        records[t] = (f"{p}/" + files).where(found, None)
+        if inner_join:
+            records = records[found]
+
+    return records.reset_index(drop=True)
+
+
+# nodes of the runs selections that mean the same to pandas and to python
+_COLUMNAR_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Name,
+    ast.Constant,
+    ast.Load,
+)
+
+
+def _is_columnar(runs: str) -> bool:
+    # Whether the runs selection only compares columns with each other or with
+    # constants, and can be evaluated by pandas for all cycles at once. `in`
+    # is only allowed with a list of constants, as a string on either side
+    # is a substring test in python
+    try:
+        tree = ast.parse(runs, mode="eval")
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Compare):
+            for op, right in zip(node.ops, node.comparators, strict=True):
+                if isinstance(op, (ast.In, ast.NotIn)) and not (
+                    isinstance(right, (ast.List, ast.Tuple))
+                    and all(isinstance(e, ast.Constant) for e in right.elts)
+                ):
+                    return False
+        elif isinstance(node, (ast.In, ast.NotIn, ast.List, ast.Tuple)):
             continue
-
-        records.append(record)
-
-    return records
+        elif not isinstance(node, _COLUMNAR_NODES):
+            return False
+    return True
+
+
+def _select_runs(records: pd.DataFrame, runs: str | None) -> pd.DataFrame:
+    # Evaluate the runs selection once for all cycles if it only compares
+    # columns, otherwise evaluate it for each cycle
+    if not runs or len(records) == 0:
+        return records
+    select = None
+    if _is_columnar(runs):
+        try:
+            select = records.eval(runs)
+        except (AttributeError, NameError, SyntaxError, TypeError, ValueError):
+            select = None
+    if select is None:
+        select = [bool(eval(runs, {}, rec)) for rec in records.to_dict("records")]
+    select = np.broadcast_to(np.asarray(select, dtype=bool), len(records))
+    return records[select]
+
+
+def _to_ak(col: pd.Series) -> ak.Array:
+    # Column of strings (or None) to awkward, building the layout from the
+    # encoded strings instead of converting each one
+    values = [v if isinstance(v, str) else None for v in col.tolist()]
+    encoded = [v.encode() if v is not None else b"" for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    layout = ak.contents.ListOffsetArray(
+        ak.index.Index64(offsets),
+        ak.contents.NumpyArray(
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            parameters={"__array__": "char"},
+        ),
+        parameters={"__array__": "string"},
+    )
+    if any(v is None for v in values):
+        valid = np.array([v is not None for v in values], dtype=np.int8)
+        layout = ak.contents.ByteMaskedArray(
+            ak.index.Index8(valid), layout, valid_when=True
+        )
+    return ak.Array(layout)
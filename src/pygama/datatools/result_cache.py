@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+import time
+from collections.abc import Callable, Mapping
+from contextlib import ExitStack
+from copy import deepcopy
+from inspect import signature
+from pathlib import Path
+
+import awkward as ak
+import hist
+import lh5
+import numpy as np
+import pandas as pd
+from lgdo import LGDO, Table
+
+from .query_runs import query_runs
+from .utils import _read_dataflow_config
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL,
+    runs TEXT NOT NULL,
+    alias_map TEXT
+);
+"""
+
+
+class QueryCache:
+    """
+    On-disk cache of the results of :meth:`query_data`, :meth:`query_hist` and
+    :meth:`query_evt`.
+
+    Results are stored by a hash of the query (fields, selections, keyword
+    arguments and dataflow config), together with the list of runs they were
+    computed from and the sizes and modification times of the input files of each
+    run. A query is answered from the cache if none of these files changed; if
+    runs were added after the cached ones, only the new runs are processed and
+    their result is merged with the cached one (histograms are added bin-wise).
+    Otherwise, the query is processed again. Changes to the metadata and
+    parameter databases are not tracked; call :meth:`clear` after updating them.
+
+    LGDO results are stored as LH5 files, awkward arrays as their buffers in a
+    NumPy ``.npz`` file, and other results are pickled. When the size of the
+    stored results exceeds ``max_size``, the least recently used ones are removed.
+
+    Parameters
+    ----------
+    path
+        directory to store the results and the SQLite index in
+    max_size
+        size budget of the cache in bytes
+    """
+
+    def __init__(self, path: str | Path, max_size: int = 10 * 2**30):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.con = sqlite3.connect(self.path / "index.sqlite", timeout=60)
+        with self.con:
+            self.con.executescript(_SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def clear(self):
+        """Remove all results from the cache."""
+        with self.con:
+            for (file,) in self.con.execute("SELECT file FROM results"):
+                (self.path / file).unlink(missing_ok=True)
+            self.con.execute("DELETE FROM results")
+
+    def get(self, key: str) -> tuple | None:
+        """
+        Return ``(result, alias_map, runs)`` stored for ``key``, or ``None`` if
+        there is none. ``runs`` is the list of ``[run, file_stats]`` pairs the
+        result was computed from.
+        """
+        row = self.con.execute(
+            "SELECT file, runs, alias_map FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        file, runs, alias_map = row
+        try:
+            result = _load_result(self.path / file)
+        except (OSError, KeyError, ValueError, pickle.UnpicklingError):
+            log.warning("could not read cached result %s, discarding it", file)
+            self._remove(key, file)
+            return None
+
+        with self.con:
+            self.con.execute(
+                "UPDATE results SET atime = ? WHERE key = ?", (time.time(), key)
+            )
+        return (
+            result,
+            None if alias_map is None else json.loads(alias_map),
+            json.loads(runs),
+        )
+
+    def put(self, key: str, result, alias_map: Mapping | None, runs: list):
+        """Store ``result`` for ``key`` and evict results over the size budget."""
+        old = self.con.execute(
+            "SELECT file FROM results WHERE key = ?", (key,)
+        ).fetchone()
+        file = _save_result(self.path, key, result)
+        with self.con:
+            self.con.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    file,
+                    (self.path / file).stat().st_size,
+                    time.time(),
+                    json.dumps(runs),
+                    None if alias_map is None else json.dumps(alias_map),
+                ),
+            )
+        if old is not None and old[0] != file:
+            (self.path / old[0]).unlink(missing_ok=True)
+        self._evict(keep=key)
+
+    def _remove(self, key: str, file: str):
+        with self.con:
+            self.con.execute("DELETE FROM results WHERE key = ?", (key,))
+        (self.path / file).unlink(missing_ok=True)
+
+    def _evict(self, keep: str):
+        total = 0
+        for key, file, size in self.con.execute(
+            "SELECT key, file, size FROM results ORDER BY atime DESC"
+        ).fetchall():
+            total += size
+            if total > self.max_size and key != keep:
+                log.debug("evicting cached result %s", file)
+                self._remove(key, file)
+                total -= size
+
+
+def _save_result(path: Path, key: str, result) -> str:
+    # write to a temporary file first so that readers never see a partial result
+    if isinstance(result, LGDO):
+        file = f"{key}.lh5"
+        lh5.write(result, "result", path / f"{file}.tmp", wo_mode="overwrite_file")
+    elif isinstance(result, ak.Array):
+        file = f"{key}.npz"
+        form, length, buffers = ak.to_buffers(result)
+        with (path / f"{file}.tmp").open("wb") as f:
+            np.savez(f, __form__=form.to_json(), __length__=length, **buffers)
+    else:
+        file = f"{key}.pkl"
+        with (path / f"{file}.tmp").open("wb") as f:
+            pickle.dump(result, f)
+    (path / f"{file}.tmp").replace(path / file)
+    return file
+
+
+def _load_result(file: Path):
+    if file.suffix == ".lh5":
+        return lh5.read("result", file)
+    if file.suffix == ".npz":
+        with np.load(file) as npz:
+            buffers = {k: npz[k] for k in npz.files}
+        form = str(buffers.pop("__form__"))
+        length = int(buffers.pop("__length__"))
+        return ak.from_buffers(form, length, buffers)
+    with file.open("rb") as f:
+        return pickle.load(f)
+
+
+def _merge_results(old, new):
+    # combine the results of a query over two sets of runs
+    if isinstance(old, hist.Hist):
+        return old + new
+    if isinstance(old, Table):
+        old.append(new)
+        return old
+    if isinstance(old, ak.Array):
+        return ak.concatenate([old, new])
+    if isinstance(old, pd.DataFrame):
+        return pd.concat([old, new], ignore_index=True)
+    if isinstance(old, np.ndarray):
+        return np.concatenate([old, new])
+    if isinstance(old, Mapping):
+        return {k: _merge_results(v, new[k]) for k, v in old.items()}
+    msg = f"cannot merge cached results of type {type(old)}"
+    raise TypeError(msg)
+
+
+def _key_default(obj):
+    # JSON serialization of the arguments of a query for hashing
+    if isinstance(obj, (set, frozenset)):
+        return sorted(map(str, obj))
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    return repr(obj)
+
+
+def _open_query_cache(
+    stack: ExitStack, cache: str | Path | QueryCache | None
+) -> QueryCache | None:
+    # Helper to open the result cache of a query and enter its context
+    if cache is None or isinstance(cache, QueryCache):
+        return cache
+    return stack.enter_context(QueryCache(cache))
+
+
+def _cached_query(
+    cache: QueryCache,
+    query: Callable,
+    query_args: Mapping,
+    runs,
+    *,
+    dataflow_config,
+    tiers_key: str,
+    processes,
+    executor,
+    progress,
+    **kwargs,
+):
+    # Run query(**query_args, runs=..., **kwargs) through cache. The run records
+    # are queried here so that the input files of each run can be checked, and
+    # only the runs missing from the cached result are passed to query
+    df_config, df_paths, query_config = _read_dataflow_config(dataflow_config)
+
+    if runs is None or isinstance(runs, str):
+        qr_params = signature(query_runs).parameters
+        run_records = query_runs(
+            runs,
+            dataflow_config=df_config,
+            processes=processes,
+            executor=executor,
+            progress=progress,
+            **{k: v for k, v in kwargs.items() if k in qr_params},
+        )
+        runs_key = runs
+    else:
+        run_records = ak.Array(runs)
+        runs_key = sorted(run_records.fields)
+
+    tiers = kwargs.get("tiers")
+    if tiers is None:
+        tiers = query_config.get(tiers_key, [])
+    tiers = [t for t in tiers if f"tier_{t}" in df_paths]
+
+    # name of each run and the size and modification time of its input files
+    run_stats = []
+    for rec in ak.to_list(run_records[["relpath", "cycle"]]):
+        relpaths, cycles = rec["relpath"], rec["cycle"]
+        if not isinstance(relpaths, list):
+            relpaths, cycles = [relpaths], [cycles]
+        stats = []
+        for relpath, cycle in zip(relpaths, cycles, strict=True):
+            for t in tiers:
+                try:
+                    st = Path(
+                        df_paths[f"tier_{t}"], relpath, f"{cycle}-tier_{t}.lh5"
+                    ).stat()
+                    stats.append([st.st_size, st.st_mtime_ns])
+                except FileNotFoundError:
+                    stats.append(None)
+        name = "|".join(f"{r}/{c}" for r, c in zip(relpaths, cycles, strict=True))
+        run_stats.append([name, stats])
+
+    key = hashlib.sha256(
+        json.dumps(
+            [query.__name__, query_args, runs_key, kwargs, df_config],
+            sort_keys=True,
+            default=_key_default,
+        ).encode()
+    ).hexdigest()
+
+    def run_query(records):
+        # query may modify its arguments, e.g. set axis labels
+        ret = query(
+            **deepcopy(query_args),
+            runs=records,
+            dataflow_config=df_config,
+            processes=processes,
+            executor=executor,
+            progress=progress,
+            **kwargs,
+        )
+        return ret if isinstance(ret, tuple) else (ret, None)
+
+    cached = cache.get(key)
+    if cached is not None:
+        result, alias_map, cached_runs = cached
+        n_cached = len(cached_runs)
+        if run_stats[:n_cached] == cached_runs:
+            if n_cached == len(run_stats):
+                log.debug("query result found in cache")
+                return result if alias_map is None else (result, alias_map)
+
+            log.debug(
+                "updating cached query result with %d new runs",
+                len(run_stats) - n_cached,
+            )
+            try:
+                new_result, alias_map = run_query(run_records[n_cached:])
+                result = _merge_results(result, new_result)
+            except (ValueError, TypeError):
+                # e.g. no channels selected in the new runs
+                log.debug("could not update cached query result, querying all runs")
+                result = None
+        else:
+            result = None
+    else:
+        result = None
+
+    if result is None:
+        result, alias_map = run_query(run_records)
+    cache.put(key, result, alias_map, run_stats)
+    return result if alias_map is None else (result, alias_map)
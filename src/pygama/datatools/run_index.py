@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+from contextlib import ExitStack
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    root TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    parent TEXT,
+    mtime INTEGER NOT NULL,
+    PRIMARY KEY (root, relpath)
+);
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (root, relpath, name)
+);
+"""
+
+
+class RunIndex:
+    """
+    Persistent index of the files in the directory trees of data tiers.
+
+    The file names in each directory of a tree are stored in an SQLite database,
+    together with the modification time of the directory. When a tree is listed
+    again, only the directories whose modification time changed are read from
+    disk; the others cost a single ``stat``. Used by :meth:`query_runs` to avoid
+    walking the whole data production on each query.
+
+    Parameters
+    ----------
+    path
+        SQLite file to store the index in. If ``":memory:"`` (default), the
+        index only lives as long as this object.
+    """
+
+    def __init__(self, path: str | Path = ":memory:"):
+        self.path = str(path)
+        self.con = sqlite3.connect(self.path, timeout=60)
+        with self.con:
+            self.con.executescript(_SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def list_tree(self, root: str | Path) -> dict[str, list[str]]:
+        """
+        Return the names of the files in each directory of the tree under ``root``,
+        by path relative to ``root`` (``"."`` for ``root`` itself), refreshing the
+        index for the directories that changed. Symbolic links to directories are
+        followed. If ``root`` does not exist, return an empty dict.
+        """
+        root = str(Path(root).resolve())
+        stored = dict(
+            self.con.execute(
+                "SELECT relpath, mtime FROM dirs WHERE root = ?", (root,)
+            ).fetchall()
+        )
+        children = {}
+        for relpath, parent in self.con.execute(
+            "SELECT relpath, parent FROM dirs WHERE root = ?", (root,)
+        ):
+            if parent is not None:
+                children.setdefault(parent, []).append(relpath)
+
+        seen = set()
+        changed = {}
+        stack = [(".", None)]
+        while stack:
+            relpath, parent = stack.pop()
+            path = Path(root, relpath)
+            try:
+                # stat before listing, a change during the listing is seen next time
+                mtime = path.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            seen.add(relpath)
+
+            if stored.get(relpath) == mtime:
+                stack += [(d, relpath) for d in children.get(relpath, [])]
+                continue
+
+            files = []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        stack.append((str(Path(relpath, entry.name)), relpath))
+                    elif entry.is_file():
+                        files.append(entry.name)
+            changed[relpath] = (parent, mtime, files)
+
+        removed = set(stored) - seen
+        if changed or removed:
+            log.debug(
+                "updating run index for %s: %d changed and %d removed directories",
+                root,
+                len(changed),
+                len(removed),
+            )
+            with self.con:
+                for relpath in removed | set(changed):
+                    self.con.execute(
+                        "DELETE FROM dirs WHERE root = ? AND relpath = ?",
+                        (root, relpath),
+                    )
+                    self.con.execute(
+                        "DELETE FROM files WHERE root = ? AND relpath = ?",
+                        (root, relpath),
+                    )
+                self.con.executemany(
+                    "INSERT INTO dirs VALUES (?, ?, ?, ?)",
+                    [
+                        (root, relpath, parent, mtime)
+                        for relpath, (parent, mtime, _) in changed.items()
+                    ],
+                )
+                self.con.executemany(
+                    "INSERT INTO files VALUES (?, ?, ?)",
+                    [
+                        (root, relpath, name)
+                        for relpath, (_, _, files) in changed.items()
+                        for name in files
+                    ],
+                )
+
+        tree = {relpath: [] for relpath in seen}
+        for relpath, name in self.con.execute(
+            "SELECT relpath, name FROM files WHERE root = ?", (root,)
+        ):
+            tree[relpath].append(name)
+        return tree
+
+
+def _open_run_index(
+    stack: ExitStack,
+    run_index: str | Path | RunIndex | bool | None,
+    config_dir: str | None,
+) -> RunIndex:
+    # Helper to open the run index used by query_runs and enter its context. By
+    # default, store it next to dataflow-config.yaml if that directory is writable,
+    # else keep it in memory
+    if isinstance(run_index, RunIndex):
+        return run_index
+    if run_index is None and config_dir is not None and os.access(config_dir, os.W_OK):
+        run_index = Path(config_dir) / ".run_index.sqlite"
+    if run_index is None or run_index is False:
+        run_index = ":memory:"
+    return stack.enter_context(RunIndex(run_index))
@@ -5,8 +5,10 @@ import os
 import re
 import string
 from collections.abc import Mapping
-from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import ExitStack
+from copy import deepcopy
+from functools import partial
 from pathlib import Path
 
 from dbetto import Props, TextDB
@@ -111,17 +113,33 @@ def _setup_spinner(
     return None
 
 
+class _ThreadPoolExecutor(ThreadPoolExecutor):
+    # Thread pool whose tasks get their own copy of the arguments bound in a
+    # functools.partial, as they would in a process pool. LH5Iterator.map binds
+    # the initial value of its aggregation this way, which must not be shared
+    def submit(self, fn, /, *args, **kwargs):
+        if isinstance(fn, partial):
+            fn = partial(fn.func, *deepcopy(fn.args), **fn.keywords)
+        return super().submit(fn, *args, **kwargs)
+
+
 def _setup_executor(
     stack: ExitStack,
     processes: int | None,
     executor: Executor | None,
+    backend: str = "processes",
 ):
     # Helper to set up concurrent.futures.Executor and enter context
+    executors = {"processes": ProcessPoolExecutor, "threads": _ThreadPoolExecutor}
+    if backend not in executors:
+        msg = f"backend must be 'processes' or 'threads', not {backend!r}"
+        raise ValueError(msg)
+
     if processes is None and isinstance(executor, Executor):
         processes = executor._max_workers
 
     if executor is None and isinstance(processes, int):
-        executor = stack.enter_context(ProcessPoolExecutor(processes))
+        executor = stack.enter_context(executors[backend](processes))
 
     return processes, executor
 
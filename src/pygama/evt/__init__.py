@@ -5,7 +5,7 @@ Utilities for grouping hit data into events.
 from __future__ import annotations
 
 from .build_evt import build_evt
-from .build_tcm import build_tcm
+from .build_tcm import build_tcm, build_tcm_batch
 from .tcm import generate_tcm_cols
 
-__all__ = ["build_evt", "build_tcm", "generate_tcm_cols"]
+__all__ = ["build_evt", "build_tcm", "build_tcm_batch", "generate_tcm_cols"]
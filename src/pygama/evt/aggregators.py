@@ -1,15 +1,28 @@
 """
 This module provides aggregators to build the `evt` tier.
+
+The aggregators first try to evaluate their expression once, over the hits of
+all their channels together, and to reduce it event by event with segmented
+array operations. They fall back to a loop over the channels when the
+expression is not element-wise or reads jagged fields.
 """
 
 from __future__ import annotations
 
+import re
+from collections import namedtuple
+
 import awkward as ak
-import lh5
 import numpy as np
 from lgdo import types
 
 from . import utils
+from .expressions import compile_expression, flat_array
+
+# the hits of some channels in a TCM chunk, as parallel arrays in TCM
+# (flattened, event-major) order: the expression result, the query mask,
+# position among the flattened hits, event and position in the channel list
+FlatHits = namedtuple("FlatHits", ("res", "mask", "hit_idx", "evt_idx", "ch_pos"))
 
 
 def evaluate_to_first_or_last(
@@ -60,6 +73,23 @@ def evaluate_to_first_or_last(
     if not isinstance(datainfo, utils.DataInfo):
         datainfo = utils.make_files_config(datainfo)
 
+    flat = _flat_to_first_or_last(
+        datainfo,
+        tcm,
+        channels,
+        channels_skip,
+        expr,
+        field_list,
+        query,
+        n_rows,
+        sorter,
+        pars_dict,
+        default_value,
+        is_first,
+    )
+    if flat is not None:
+        return flat
+
     # winning value per event, and the sorter value that won it. Both are
     # indexed by event and assigned positionally: a channel's hits are numbered
     # 0..n-1 while the events it fired in are arbitrary, and confusing the two
@@ -105,17 +135,15 @@ def evaluate_to_first_or_last(
             cache=getattr(tcm, "cache", None),
         )
 
-        # find if sorter is in hit or dsp
-        sort_field = lh5.read_as(
-            f"{ch}/{sorter[0]}/{sorter[1]}",
-            (
-                datainfo.hit.file
-                if f"{datainfo.hit.group}" == sorter[0]
-                else datainfo.dsp.file
-            ),
-            idx=idx_ch,
-            library="np",
-        )
+        # read the sorter through the cache, with the rest of the table
+        sort_field = utils.find_parameters(
+            datainfo=datainfo,
+            ch=ch,
+            idx_ch=idx_ch,
+            field_list=[sorter],
+            cache=getattr(tcm, "cache", None),
+        )[f"{sorter[0]}_{sorter[1]}"]
+        sort_field = ak.to_numpy(sort_field, allow_missing=False)
 
         if sort_field.ndim > 1:
             msg = f"sorter '{sorter[0]}/{sorter[1]}' must be a 1D array"
@@ -193,6 +221,23 @@ def evaluate_to_scalar(
     """
     if not isinstance(datainfo, utils.DataInfo):
         datainfo = utils.make_files_config(datainfo)
+
+    flat = _flat_to_scalar(
+        datainfo,
+        tcm,
+        mode,
+        channels,
+        channels_skip,
+        expr,
+        field_list,
+        query,
+        n_rows,
+        pars_dict,
+        default_value,
+    )
+    if flat is not None:
+        return flat
+
     out = None
 
     for ch in channels:
@@ -227,22 +272,23 @@ def evaluate_to_scalar(
                 cache=getattr(tcm, "cache", None),
             )
 
-            # switch through modes
+            # switch through modes, with unbuffered ufuncs so that every hit of
+            # a channel repeated in an event is counted
             if mode == "sum":
                 if res.dtype == bool:
                     res = res.astype(int)
                 if out.dtype == bool:
                     out = out.astype(int)
-                out[evt_ids_ch[limarr]] += res[limarr]
+                np.add.at(out, evt_ids_ch[limarr], res[limarr])
             else:
                 if res.dtype != bool:
                     res = res.astype(bool)
 
                 if mode == "any":
-                    out[evt_ids_ch] |= res & limarr
+                    np.logical_or.at(out, evt_ids_ch, res & limarr)
 
                 if mode == "all":
-                    out[evt_ids_ch] &= res & limarr
+                    np.logical_and.at(out, evt_ids_ch, res & limarr)
 
     return types.Array(nda=out)
 
@@ -284,6 +330,21 @@ def evaluate_at_channel(
     """
     if not isinstance(datainfo, utils.DataInfo):
         datainfo = utils.make_files_config(datainfo)
+
+    flat = _flat_at_channel(
+        datainfo,
+        tcm,
+        channels,
+        channels_skip,
+        expr,
+        field_list,
+        ch_comp,
+        pars_dict,
+        default_value,
+    )
+    if flat is not None:
+        return flat
+
     table_id_fmt = datainfo.hit.table_fmt
 
     out = utils.make_numpy_full(len(ch_comp.nda), default_value, type(default_value))
@@ -538,6 +599,25 @@ def evaluate_to_vector(
        ``ascend_by:<hit|dsp.field>`` results in an vector ordered ascending,
        ``decend_by:<hit|dsp.field>`` sorts descending.
     """
+    if not isinstance(datainfo, utils.DataInfo):
+        datainfo = utils.make_files_config(datainfo)
+
+    flat = _flat_to_vector(
+        datainfo,
+        tcm,
+        channels,
+        channels_skip,
+        expr,
+        field_list,
+        query,
+        n_rows,
+        pars_dict,
+        default_value,
+        sorter,
+    )
+    if flat is not None:
+        return flat
+
     out, dtype = evaluate_to_aoesa(
         datainfo=datainfo,
         tcm=tcm,
@@ -579,3 +659,373 @@ def evaluate_to_vector(
     return types.VectorOfVectors(
         ak.values_astype(ak.drop_none(ak.nan_to_none(ak.Array(out))), dtype)
     )
+
+
+# The functions below evaluate an expression once over the hits of all the
+# channels of an aggregation, and reduce event by event with array
+# operations, instead of looping over channels. They return None when that is
+# not possible (e.g. non element-wise expressions or jagged fields), in which
+# case the aggregators fall back to their channel loop.
+
+
+def _flat_hits(
+    datainfo,
+    tcm,
+    channels,
+    expr,
+    field_list,
+    pars_dict=None,
+    query=None,
+    skip=(),
+) -> FlatHits | None:
+    """Evaluate `expr` and `query` at the hits of `channels`, except `skip`.
+
+    If `expr` is ``None`` only the query is evaluated, and `res` is ``None``.
+    """
+    if query is not None and not isinstance(query, str):
+        return None
+
+    index = utils.tcm_index(tcm)
+    chans = []
+    for pos, ch in enumerate(channels):
+        if ch in skip:
+            continue
+        table_id = utils.get_tcm_id_by_pattern(datainfo.hit.table_fmt, ch)
+        if table_id is None:
+            continue
+        chans.append((pos, ch, table_id, *index.channel(table_id)))
+
+    # the hits of a channel listed twice would be counted twice by the loop
+    if not chans or len({c[2] for c in chans}) < len(chans):
+        return None
+
+    tiers = tuple(k for k in datainfo._asdict() if k not in ("tcm", "raw"))
+    res = None
+    if expr is not None:
+        res = _flat_eval(datainfo, tcm, chans, expr, tiers, field_list, pars_dict)
+        if res is None:
+            return None
+
+    hit_idx = np.concatenate([c[3] for c in chans])
+    if query is None:
+        mask = np.ones(len(hit_idx), dtype=bool)
+    else:
+        query_fields = re.findall(
+            rf"({'|'.join(datainfo._asdict().keys())}).([a-zA-Z_$][\w$]*)", query
+        )
+        tiers = tuple(k for k in datainfo._asdict() if k not in ("tcm", "evt"))
+        mask = _flat_eval(datainfo, tcm, chans, query, tiers, query_fields, None)
+        if mask is None:
+            return None
+        mask = mask.astype(bool, copy=False)
+
+    order = np.argsort(hit_idx, kind="stable")
+    return FlatHits(
+        res=None if res is None else res[order],
+        mask=mask[order],
+        hit_idx=hit_idx[order],
+        evt_idx=np.concatenate([c[5] for c in chans])[order],
+        ch_pos=np.repeat([c[0] for c in chans], [len(c[3]) for c in chans])[order],
+    )
+
+
+def _flat_eval(datainfo, tcm, chans, expr, tiers, field_list, pars_dict):
+    # `expr` evaluated at the concatenated hits of `chans`, as a 1D array, or
+    # None if the per-channel results would differ from that
+    n_hits = sum(len(c[3]) for c in chans)
+
+    if expr == "tcm.table_key":
+        return np.repeat(
+            np.array([c[2] for c in chans], dtype=int), [len(c[3]) for c in chans]
+        )
+    if expr == "tcm.row_in_table":
+        return np.concatenate([c[4] for c in chans])
+    if expr == "tcm.index":
+        return np.concatenate([c[3] for c in chans])
+
+    code = compile_expression(expr, tiers)
+    if not code.elementwise:
+        return None
+
+    pars_dict = pars_dict or {}
+    cols = [
+        utils.find_parameters(
+            datainfo=datainfo,
+            ch=ch,
+            idx_ch=idx_ch,
+            field_list=field_list,
+            cache=getattr(tcm, "cache", None),
+        )
+        for _, ch, _, _, idx_ch, _ in chans
+    ]
+
+    variables = {}
+    for name in code.names:
+        # parameters take precedence over fields, as in get_data_at_channel()
+        if name in pars_dict:
+            value = pars_dict[name]
+            if not isinstance(value, bool | int | float | np.generic):
+                return None
+            variables[name] = value
+            continue
+
+        values = [flat_array(c.get(name)) for c in cols]
+        if any(v is None for v in values):
+            return None
+        variables[name] = np.concatenate(values)
+
+    res = code(variables)
+    if not hasattr(res, "__len__") or isinstance(res, str):
+        return np.full(n_hits, res)
+    res = flat_array(res if isinstance(res, ak.Array) else np.asarray(res))
+    return res if res is not None and len(res) == n_hits else None
+
+
+def _event_counts(evt_idx, n_rows) -> np.ndarray:
+    return np.bincount(evt_idx, minlength=n_rows)
+
+
+def _reduce_by_event(ufunc, values, evt_idx, n_rows, identity) -> np.ndarray:
+    """Reduce `values`, sorted by event `evt_idx`, event by event with `ufunc`.
+
+    Events without any value get `identity`.
+    """
+    counts = _event_counts(evt_idx, n_rows)
+    nonempty = counts > 0
+    starts = (np.cumsum(counts) - counts)[nonempty]
+
+    out = np.full(n_rows, identity, dtype=values.dtype)
+    if len(values) > 0:
+        out[nonempty] = ufunc.reduceat(values, starts)
+    return out
+
+
+def _first_per_event(order, evt_idx) -> np.ndarray:
+    """The first element of `order` in each event (`order` sorted by event)."""
+    _, first = np.unique(evt_idx[order], return_index=True)
+    return order[first]
+
+
+def _flat_to_scalar(
+    datainfo,
+    tcm,
+    mode,
+    channels,
+    channels_skip,
+    expr,
+    field_list,
+    query,
+    n_rows,
+    pars_dict,
+    default_value,
+) -> types.Array | None:
+    hits = _flat_hits(
+        datainfo, tcm, channels, expr, field_list, pars_dict, query, channels_skip
+    )
+    if hits is None:
+        return None
+
+    res = hits.res
+    out = utils.make_numpy_full(n_rows, default_value, res.dtype)
+
+    if mode == "sum":
+        if res.dtype == bool:
+            res = res.astype(int)
+        if out.dtype == bool:
+            out = out.astype(int)
+        evt_idx = hits.evt_idx[hits.mask]
+        total = _reduce_by_event(np.add, res[hits.mask], evt_idx, n_rows, 0)
+        touched = _event_counts(evt_idx, n_rows) > 0
+        out[touched] += total[touched]
+        return types.Array(nda=out)
+
+    res = res.astype(bool, copy=False) & hits.mask
+    touched = _event_counts(hits.evt_idx, n_rows) > 0
+    if mode == "any":
+        out[touched] |= _reduce_by_event(
+            np.logical_or, res, hits.evt_idx, n_rows, False
+        )[touched]
+    if mode == "all":
+        out[touched] &= _reduce_by_event(
+            np.logical_and, res, hits.evt_idx, n_rows, True
+        )[touched]
+
+    return types.Array(nda=out)
+
+
+def _flat_to_first_or_last(
+    datainfo,
+    tcm,
+    channels,
+    channels_skip,
+    expr,
+    field_list,
+    query,
+    n_rows,
+    sorter,
+    pars_dict,
+    default_value,
+    is_first,
+) -> types.Array | None:
+    hits = _flat_hits(
+        datainfo, tcm, channels, expr, field_list, pars_dict, query, channels_skip
+    )
+    if hits is None:
+        return None
+    sort_hits = _flat_hits(
+        datainfo,
+        tcm,
+        channels,
+        f"{sorter[0]}.{sorter[1]}",
+        [sorter],
+        skip=channels_skip,
+    )
+    if sort_hits is None:
+        return None
+
+    sort_field = sort_hits.res.astype(float)
+    sel = np.flatnonzero(
+        hits.mask & (sort_field < np.inf if is_first else sort_field > -np.inf)
+    )
+
+    # segmented argmin/argmax of the sorter. Ties go to the channel listed
+    # first, then to the first (last) hit of that channel, as in the loop
+    if is_first:
+        keys = (hits.hit_idx[sel], hits.ch_pos[sel], sort_field[sel])
+    else:
+        keys = (-hits.hit_idx[sel], hits.ch_pos[sel], -sort_field[sel])
+    order = sel[np.lexsort((*keys, hits.evt_idx[sel]))]
+    win = _first_per_event(order, hits.evt_idx)
+
+    out = utils.make_numpy_full(n_rows, default_value, hits.res.dtype)
+    out[hits.evt_idx[win]] = hits.res[win]
+    return types.Array(nda=out)
+
+
+def _flat_at_channel(
+    datainfo,
+    tcm,
+    channels,
+    channels_skip,
+    expr,
+    field_list,
+    ch_comp,
+    pars_dict,
+    default_value,
+) -> types.Array | None:
+    table_id_fmt = datainfo.hit.table_fmt
+    hit_tables = utils.table_names(datainfo, "hit", getattr(tcm, "cache", None))
+
+    # the loop goes through the channels of `ch_comp` in ascending order and
+    # writes each one's value at every event it has a hit in, so the channel
+    # with the largest table key (and its last hit) wins
+    names = [
+        utils.get_table_name_by_pattern(table_id_fmt, table_id)
+        for table_id in np.unique(ch_comp.nda.astype(int))
+    ]
+    names = [n for n in names if n in hit_tables]
+    evaluated = {n for n in names if n in channels and n not in channels_skip}
+
+    out = utils.make_numpy_full(len(ch_comp.nda), default_value, type(default_value))
+    if not names:
+        return types.Array(nda=out)
+
+    hits = _flat_hits(
+        datainfo, tcm, names, expr, field_list, pars_dict, skip=set(names) - evaluated
+    )
+    rest = _flat_hits(datainfo, tcm, names, None, [], skip=evaluated)
+    if (hits is None and evaluated) or (rest is None and set(names) - evaluated):
+        return None
+
+    parts = [p for p in (hits, rest) if p is not None]
+    values = np.concatenate(
+        [
+            p.res if p.res is not None else np.full(len(p.hit_idx), default_value)
+            for p in parts
+        ]
+    )
+    hit_idx = np.concatenate([p.hit_idx for p in parts])
+    ch_pos = np.concatenate([p.ch_pos for p in parts])
+    evt_idx = np.concatenate([p.evt_idx for p in parts])
+
+    order = np.lexsort((-hit_idx, -ch_pos, evt_idx))
+    win = _first_per_event(order, evt_idx)
+    out[evt_idx[win]] = values[win]
+    return types.Array(nda=out)
+
+
+def _flat_to_vector(
+    datainfo,
+    tcm,
+    channels,
+    channels_skip,
+    expr,
+    field_list,
+    query,
+    n_rows,
+    pars_dict,
+    default_value,
+    sorter,
+) -> types.VectorOfVectors | None:
+    skip = set(channels_skip)
+    hits = _flat_hits(datainfo, tcm, channels, expr, field_list, pars_dict, query, skip)
+    if hits is None:
+        return None
+    parts = [hits]
+    if skip & set(channels):
+        rest = _flat_hits(
+            datainfo, tcm, channels, None, [], query=query, skip=set(channels) - skip
+        )
+        if rest is None:
+            return None
+        parts.append(rest)
+
+    sort_field = None
+    if sorter is not None:
+        md, fld = sorter.split(":")
+        if md not in ("ascend_by", "descend_by"):
+            msg = "sorter values can only have 'ascend_by' or 'descend_by' prefixes"
+            raise ValueError(msg)
+        sort_hits = _flat_hits(
+            datainfo, tcm, channels, fld, [tuple(fld.split("."))], skip=skip
+        )
+        if sort_hits is None:
+            return None
+        # aligned with `parts`: the skipped channels have no sorter value
+        sort_field = np.concatenate(
+            [
+                sort_hits.res.astype(float),
+                *(np.full(len(p.hit_idx), np.nan) for p in parts[1:]),
+            ]
+        )
+        if md == "descend_by":
+            sort_field = -sort_field
+
+    # the loop fills an (event, channel) matrix of this type, where the last
+    # hit of a channel in an event overwrites the others, and drops NaNs
+    dtype = hits.res.dtype
+    work_dtype = np.result_type(np.nan, dtype)
+    values = np.concatenate(
+        [
+            p.res if p.res is not None else np.full(len(p.hit_idx), default_value)
+            for p in parts
+        ]
+    ).astype(work_dtype)
+    mask = np.concatenate([p.mask for p in parts])
+    hit_idx = np.concatenate([p.hit_idx for p in parts])
+    ch_pos = np.concatenate([p.ch_pos for p in parts])
+    evt_idx = np.concatenate([p.evt_idx for p in parts])
+
+    last = np.lexsort((-hit_idx, ch_pos, evt_idx))
+    _, first = np.unique(
+        evt_idx[last] * len(channels) + ch_pos[last], return_index=True
+    )
+    keep = last[first]
+    keep = keep[mask[keep] & ~np.isnan(values[keep])]
+
+    keys = (ch_pos[keep],) if sort_field is None else (ch_pos[keep], sort_field[keep])
+    keep = keep[np.lexsort((*keys, evt_idx[keep]))]
+
+    return types.VectorOfVectors(
+        ak.unflatten(values[keep].astype(dtype), _event_counts(evt_idx[keep], n_rows))
+    )
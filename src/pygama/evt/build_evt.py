@@ -9,7 +9,10 @@ import importlib
 import itertools
 import logging
 import re
+from collections import deque
 from collections.abc import Mapping, Sequence
+from concurrent.futures import Executor
+from functools import partial
 from pathlib import Path
 from typing import Any
 
@@ -19,7 +22,8 @@ import lh5
 import numpy as np
 from lgdo import Array, ArrayOfEqualSizedArrays, Table, VectorOfVectors
 
-from ..utils import load_dict
+from ..datatools.utils import _setup_executor
+from ..utils import _AsyncWriter, load_dict
 from . import aggregators, utils
 from .build_tcm import _concat_tables
 
@@ -31,6 +35,8 @@ def build_evt(
     config: str | Mapping[str, ...],
     wo_mode: str = "write_safe",
     buffer_len=10**4,
+    processes: int | None = None,
+    executor: Executor | None = None,
 ) -> None | Table:
     r"""Transform data from hit-structured tiers to event-structured data.
 
@@ -59,7 +65,8 @@ def build_evt(
           contains slahes it will be interpreted as the path to the output
           field inside nested sub-tables.
         - ``outputs`` defines the fields that are actually included in the
-          output table.
+          output table. Operations that none of them depends on are not
+          evaluated, and intermediate fields are freed after their last use.
 
         Inside the ``operations`` block:
 
@@ -223,7 +230,14 @@ def build_evt(
         channel_mapping = None
 
     evt_tbl = build_evt_cols(
-        datainfo, config, channels, wo_mode, buffer_len, channel_mapping
+        datainfo,
+        config,
+        channels,
+        wo_mode,
+        buffer_len,
+        channel_mapping,
+        processes=processes,
+        executor=executor,
     )
     if datainfo.evt.file is None:
         return evt_tbl
@@ -237,6 +251,8 @@ def build_evt_cols(
     wo_mode: str = "write_safe",
     buffer_len=10**4,
     channel_mapping: dict | None = None,
+    processes: int | None = None,
+    executor: Executor | None = None,
 ) -> None | Table:
     """
     Iterates through the TCM file and builds the event table according to the
@@ -268,6 +284,15 @@ def build_evt_cols(
     channel_mapping
         dictionary that maps the channel to a name. This can be used in functions
         to get the channel name instead of the channel number.
+    processes
+        number of processes. If ``None``, use number equal to threads available
+        to `executor` (if provided), or else do not parallelize. In parallel,
+        each job builds one TCM chunk of `buffer_len` rows, and the chunks are
+        written out in order by the calling process.
+    executor
+        :class:`concurrent.futures.Executor` object for managing parallelism.
+        If ``None``, create a :class:`concurrent.futures.ProcessPoolExecutor`
+        with number of processes equal to `processes`.
 
     Returns
     -------
@@ -279,6 +304,9 @@ def build_evt_cols(
     if not isinstance(datainfo, utils.DataInfo):
         datainfo = utils.make_files_config(datainfo)
 
+    # only evaluate the operations that the outputs need
+    config = _prune_operations(config)
+
     if (
         datainfo.evt.file is not None
         and wo_mode == "of"
@@ -286,17 +314,25 @@ def build_evt_cols(
     ):
         Path(datainfo.evt.file).unlink()
 
-    # Take ownership of the input files for the whole run. Every lower-tier
-    # read otherwise reopens the file, and there is one such read per
-    # (chunk, operation, channel) -- hundreds of thousands of opens for a
-    # calibration file. lh5.ls/lh5.read accept an open handle directly.
-    stack = contextlib.ExitStack()
-    with stack:
-        datainfo = _open_input_tiers(datainfo, stack)
-        cache = utils.EvtCache()
-        return _build_evt_cols(
-            datainfo, config, channels, wo_mode, buffer_len, channel_mapping, cache
-        )
+    with contextlib.ExitStack() as stack:
+        processes, executor = _setup_executor(stack, processes, executor)
+
+        if executor is None:
+            chunks = _build_evt_chunks(
+                datainfo, config, channels, buffer_len, channel_mapping
+            )
+        else:
+            chunks = _build_evt_chunks_parallel(
+                datainfo,
+                config,
+                channels,
+                buffer_len,
+                channel_mapping,
+                processes,
+                executor,
+            )
+
+        return _write_evt_chunks(datainfo, config, chunks, wo_mode)
 
 
 def _open_input_tiers(datainfo, stack):
@@ -316,16 +352,9 @@ def _open_input_tiers(datainfo, stack):
     return datainfo._replace(**opened) if opened else datainfo
 
 
-def _build_evt_cols(
-    datainfo,
-    config,
-    channels,
-    wo_mode,
-    buffer_len,
-    channel_mapping,
-    cache,
-) -> None | Table:
-    evt_tables = []
+def _prepare_evt_cache(datainfo, config, channels, cache) -> dict:
+    # file-level work shared by all chunks: fills in the read plan of `cache`
+    # and returns the LGDO attrs to forward to the operations' outputs
 
     # Pre-compute source attrs for single-field aggregation operations.
     # Done once here because attrs are file-level metadata, not per-chunk data.
@@ -349,162 +378,406 @@ def _build_evt_cols(
             if src_attrs:
                 op_source_attrs[_op_field] = src_attrs
 
-    for tcm_lh5 in lh5.LH5Iterator(
-        datainfo.tcm.file,
-        datainfo.tcm.group,
+    # plan the lower-tier reads up front, so that each (tier, channel) table
+    # is read once per chunk for all operations together
+    cache.plan = _plan_reads(datainfo, config["operations"], channels)
+
+    return op_source_attrs
+
+
+def _build_evt_chunks(datainfo, config, channels, buffer_len, channel_mapping):
+    # yields the evt table of each TCM chunk in turn, built in this process
+
+    # Take ownership of the input files for the whole run. Every lower-tier
+    # read otherwise reopens the file, and there is one such read per
+    # (chunk, operation, channel) -- hundreds of thousands of opens for a
+    # calibration file. lh5.ls/lh5.read accept an open handle directly.
+    with contextlib.ExitStack() as stack:
+        datainfo = _open_input_tiers(datainfo, stack)
+        cache = utils.EvtCache()
+        op_source_attrs = _prepare_evt_cache(datainfo, config, channels, cache)
+
+        for tcm_lh5 in lh5.LH5Iterator(
+            datainfo.tcm.file,
+            datainfo.tcm.group,
+            buffer_len=buffer_len,
+            field_mask=["table_key", "row_in_table"],
+        ):
+            yield _build_evt_chunk(
+                datainfo,
+                config,
+                channels,
+                channel_mapping,
+                cache,
+                op_source_attrs,
+                tcm_lh5,
+            )
+
+
+def _build_evt_chunks_parallel(
+    datainfo, config, channels, buffer_len, channel_mapping, processes, executor
+):
+    # yields the evt table of each TCM chunk in order, built by `executor`.
+    # Only a couple of chunks per process are in flight at any time, so that
+    # finished tables do not pile up in memory if writing is the bottleneck
+    for name, tier in datainfo._asdict().items():
+        if tier.file is not None and not isinstance(tier.file, str | Path):
+            msg = (
+                f"the {name} tier must be given as a file path, not an open "
+                "file, to build the evt tier in parallel"
+            )
+            raise ValueError(msg)
+
+    # the file-level work is done once here and shipped to the jobs
+    with contextlib.ExitStack() as stack:
+        cache = utils.EvtCache()
+        op_source_attrs = _prepare_evt_cache(
+            _open_input_tiers(datainfo, stack), config, channels, cache
+        )
+
+    n_tcm_rows = lh5.read_n_rows(datainfo.tcm.group, datainfo.tcm.file)
+    starts = iter(range(0, n_tcm_rows, buffer_len))
+    # DataInfo is a class made on the fly, which cannot be pickled
+    job_fun = partial(
+        _build_evt_range,
+        files={name: tuple(tier) for name, tier in datainfo._asdict().items()},
+        config=config,
+        channels=channels,
+        channel_mapping=channel_mapping,
         buffer_len=buffer_len,
-        field_mask=["table_key", "row_in_table"],
-    ):
-        # load tcm data from disk
-        cache.new_chunk()
-        tcm = utils.TCMData(
-            table_key=tcm_lh5.table_key.view_as("ak"),
-            row_in_table=tcm_lh5.row_in_table.view_as("ak"),
-            cache=cache,
+        op_source_attrs=op_source_attrs,
+        plan=cache.plan,
+    )
+
+    futures = deque(
+        executor.submit(job_fun, start)
+        for start in itertools.islice(starts, 2 * (processes or 1))
+    )
+    try:
+        while futures:
+            tbl = futures.popleft().result()
+            for start in itertools.islice(starts, 1):
+                futures.append(executor.submit(job_fun, start))
+            yield tbl
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _build_evt_range(
+    start,
+    *,
+    files,
+    config,
+    channels,
+    channel_mapping,
+    buffer_len,
+    op_source_attrs,
+    plan,
+) -> Table:
+    # builds the evt table of the TCM rows start to start + buffer_len with
+    # its own file handles, as a job of _build_evt_chunks_parallel. The
+    # operations' attrs and the read plan are prepared by the caller
+    with contextlib.ExitStack() as stack:
+        datainfo = _open_input_tiers(utils.make_files_config(files), stack)
+        cache = utils.EvtCache()
+        cache.plan = plan
+
+        tcm_lh5 = lh5.read(
+            datainfo.tcm.group,
+            datainfo.tcm.file,
+            start_row=start,
+            n_rows=buffer_len,
+            field_mask=["table_key", "row_in_table"],
+        )
+        return _build_evt_chunk(
+            datainfo, config, channels, channel_mapping, cache, op_source_attrs, tcm_lh5
         )
 
-        # get number of events in file (ask the TCM)
-        table = Table(size=len(tcm_lh5))
 
-        # now loop over operations (columns in evt table)
-        for field, v in config["operations"].items():
-            log.debug("processing field: '%s'", field)
+def _build_evt_chunk(
+    datainfo, config, channels, channel_mapping, cache, op_source_attrs, tcm_lh5
+) -> Table:
+    # evaluates all operations on one TCM chunk and returns the requested
+    # output fields, nested in sub-tables where needed
+    cache.new_chunk()
+    n_rows = len(tcm_lh5)
+    table_key = tcm_lh5.table_key.view_as("ak")
+    row_in_table = tcm_lh5.row_in_table.view_as("ak")
+    tcm = utils.TCMData(
+        table_key=table_key,
+        row_in_table=row_in_table,
+        cache=cache,
+        index=utils.TCMIndex(table_key, row_in_table),
+    )
 
-            # if mode not defined in operation, it can only be an operation on the
-            # evt level
-            if "aggregation_mode" not in v:
-                # compute and eventually get rid of evt. suffix
-                obj = table.eval(
-                    v["expression"].replace("evt.", ""), v.get("parameters", {})
-                )
+    table = Table(size=n_rows)
+    drop_after = _drop_schedule(config)
 
-                # add attributes if present
-                if "lgdo_attrs" in v:
-                    obj.attrs |= v["lgdo_attrs"]
+    # now loop over operations (columns in evt table)
+    for i, (field, v) in enumerate(config["operations"].items()):
+        log.debug("processing field: '%s'", field)
 
-                if "description" in v:
-                    obj.attrs["description"] = v["description"]
+        # if mode not defined in operation, it can only be an operation on the
+        # evt level
+        if "aggregation_mode" not in v:
+            # compute and eventually get rid of evt. suffix
+            obj = table.eval(
+                v["expression"].replace("evt.", ""), v.get("parameters", {})
+            )
 
-            # else we build the event entry
-            else:
-                if "channels" not in v:
-                    channels_e = []
-                elif isinstance(v["channels"], str):
-                    channels_e = channels[v["channels"]]
-                elif isinstance(v["channels"], list):
-                    channels_e = list(
-                        itertools.chain.from_iterable(
-                            [channels[e] for e in v["channels"]]
-                        )
-                    )
-                channels_skip = []
-                if "exclude_channels" in v:
-                    if isinstance(v["exclude_channels"], str):
-                        channels_skip = channels[v["exclude_channels"]]
-                    elif isinstance(v["exclude_channels"], list):
-                        channels_skip = list(
-                            itertools.chain.from_iterable(
-                                [channels[e] for e in v["exclude_channels"]]
-                            )
-                        )
-
-                defaultv = v.get("initial", np.nan)
-                if isinstance(defaultv, str) and (
-                    defaultv in ["np.nan", "np.inf", "-np.inf"]
-                ):
-                    defaultv = eval(defaultv)
-
-                obj = evaluate_expression(
-                    datainfo,
-                    tcm,
-                    channels=channels_e,
-                    channels_skip=channels_skip,
-                    mode=v["aggregation_mode"],
-                    expr=v["expression"],
-                    n_rows=len(tcm_lh5),
-                    table=table,
-                    parameters=v.get("parameters", None),
-                    query=v.get("query", None),
-                    default_value=defaultv,
-                    sorter=v.get("sort", None),
-                    channel_mapping=channel_mapping,
-                )
+            # add attributes if present
+            if "lgdo_attrs" in v:
+                obj.attrs |= v["lgdo_attrs"]
 
-                # forward attrs pre-computed from the source lower-tier field
-                if field in op_source_attrs:
-                    obj.attrs |= op_source_attrs[field]
+            if "description" in v:
+                obj.attrs["description"] = v["description"]
 
-                # add attribute if present (user attrs override source attrs)
-                if "lgdo_attrs" in v:
-                    obj.attrs |= v["lgdo_attrs"]
+        # else we build the event entry
+        else:
+            channels_e = _resolve_channels(v.get("channels", []), channels)
+            channels_skip = _resolve_channels(v.get("exclude_channels", []), channels)
+
+            defaultv = v.get("initial", np.nan)
+            if isinstance(defaultv, str) and (
+                defaultv in ["np.nan", "np.inf", "-np.inf"]
+            ):
+                defaultv = eval(defaultv)
+
+            obj = evaluate_expression(
+                datainfo,
+                tcm,
+                channels=channels_e,
+                channels_skip=channels_skip,
+                mode=v["aggregation_mode"],
+                expr=v["expression"],
+                n_rows=n_rows,
+                table=table,
+                parameters=v.get("parameters", None),
+                query=v.get("query", None),
+                default_value=defaultv,
+                sorter=v.get("sort", None),
+                channel_mapping=channel_mapping,
+            )
 
-                if "description" in v:
-                    obj.attrs["description"] = v["description"]
+            # forward attrs pre-computed from the source lower-tier field
+            if field in op_source_attrs:
+                obj.attrs |= op_source_attrs[field]
 
-            # cast to type, if required
-            # hijack the poor LGDO
-            if "dtype" in v:
-                type_ = v["dtype"]
+            # add attribute if present (user attrs override source attrs)
+            if "lgdo_attrs" in v:
+                obj.attrs |= v["lgdo_attrs"]
 
-                if isinstance(obj, Array):
-                    obj.nda = obj.nda.astype(type_)
-                if isinstance(obj, VectorOfVectors):
-                    fldata_ptr = obj.flattened_data
-                    while isinstance(fldata_ptr, VectorOfVectors):
-                        fldata_ptr = fldata_ptr.flattened_data
+            if "description" in v:
+                obj.attrs["description"] = v["description"]
 
-                    fldata_ptr.nda = fldata_ptr.nda.astype(type_)
+        # cast to type, if required
+        # hijack the poor LGDO
+        if "dtype" in v:
+            type_ = v["dtype"]
 
-            log.debug("new column %s = %r", field, obj)
-            table.add_field(field, obj)
+            if isinstance(obj, Array):
+                obj.nda = obj.nda.astype(type_)
+            if isinstance(obj, VectorOfVectors):
+                fldata_ptr = obj.flattened_data
+                while isinstance(fldata_ptr, VectorOfVectors):
+                    fldata_ptr = fldata_ptr.flattened_data
 
-        # might need to re-organize fields in subtables, create a new object for that
-        nested_tbl = Table(size=len(tcm_lh5))
-        output_fields = config.get("outputs", table.keys())
+                fldata_ptr.nda = fldata_ptr.nda.astype(type_)
 
-        for field, obj in table.items():
-            # also only add fields requested by the user
-            if field not in output_fields:
-                continue
+        log.debug("new column %s = %r", field, obj)
+        table.add_field(field, obj)
 
-            # if names contain slahes, put in sub-tables
-            lvl_ptr = nested_tbl
-            subfields = field.strip("/").split("___")
-            for level in subfields:
-                # if we are at the end, just add the field
-                if level == subfields[-1]:
-                    lvl_ptr.add_field(level, obj)
-                    break
-
-                if not level:
-                    msg = f"invalid field name '{field}'"
-                    raise RuntimeError(msg)
-
-                # otherwise, increase nesting
-                if level not in lvl_ptr:
-                    lvl_ptr.add_field(level, Table(size=len(tcm_lh5)))
-                lvl_ptr = lvl_ptr[level]
-
-        # write output fields into outfile
-        if output_fields:
-            if datainfo.evt.file is None:
-                evt_tables.append(nested_tbl)
+        # free the intermediate columns that no later operation reads
+        for name in drop_after.get(i, ()):
+            table.remove_field(name, delete=True)
+
+    # might need to re-organize fields in subtables, create a new object for that
+    nested_tbl = Table(size=n_rows)
+    output_fields = config.get("outputs", table.keys())
+
+    for field, obj in table.items():
+        # also only add fields requested by the user
+        if field not in output_fields:
+            continue
+
+        # if names contain slahes, put in sub-tables
+        lvl_ptr = nested_tbl
+        subfields = field.strip("/").split("___")
+        for level in subfields:
+            # if we are at the end, just add the field
+            if level == subfields[-1]:
+                lvl_ptr.add_field(level, obj)
+                break
+
+            if not level:
+                msg = f"invalid field name '{field}'"
+                raise RuntimeError(msg)
+
+            # otherwise, increase nesting
+            if level not in lvl_ptr:
+                lvl_ptr.add_field(level, Table(size=n_rows))
+            lvl_ptr = lvl_ptr[level]
+
+    return nested_tbl
+
+
+def _write_evt_chunks(datainfo, config, chunks, wo_mode) -> None | Table:
+    # writes the chunks' evt tables into the output file in order, in the
+    # background while the next chunk is built, or concatenates them if there
+    # is no output file
+    evt_tables = []
+    with _AsyncWriter() as writer:
+        for nested_tbl in chunks:
+            # write output fields into outfile
+            if config.get("outputs", nested_tbl.keys()):
+                if datainfo.evt.file is None:
+                    evt_tables.append(nested_tbl)
+                else:
+                    writer.write(
+                        obj=nested_tbl,
+                        name=datainfo.evt.group,
+                        lh5_file=datainfo.evt.file,
+                        wo_mode="o" if wo_mode == "u" else "a",
+                    )
             else:
-                lh5.write(
-                    obj=nested_tbl,
-                    name=datainfo.evt.group,
-                    lh5_file=datainfo.evt.file,
-                    wo_mode="o" if wo_mode == "u" else "a",
-                )
-        else:
-            # warning will be given on each iteration, maybe not ideal?
-            log.warning("no output fields specified, no file will be written.")
-            evt_tables.append(nested_tbl)
+                # warning will be given on each iteration, maybe not ideal?
+                log.warning("no output fields specified, no file will be written.")
+                evt_tables.append(nested_tbl)
     if datainfo.evt.file is None:
         return _concat_tables(evt_tables)
     return None
 
 
+def _resolve_channels(spec: str | list[str], channels: dict) -> list:
+    """Expand a channel group name, or a list of them, into channel names."""
+    if isinstance(spec, str):
+        return channels[spec]
+    return list(itertools.chain.from_iterable([channels[e] for e in spec]))
+
+
+def _operation_dependencies(op: Mapping) -> set[str]:
+    """Names of the `evt` fields that an operation may read.
+
+    Looks at the expression, the query, the target of ``keep_at_ch:`` and
+    ``keep_at_idx:`` (or the sorter of ``first_at:``/``last_at:``) and the
+    ``sort`` of ``gather``. Errs on the side of too many names: evt fields can
+    be referenced with or without the ``evt.`` prefix, so any identifier that
+    is not an attribute counts.
+    """
+    texts = [op.get("expression", "")]
+    mode = op.get("aggregation_mode", "")
+    if ":" in mode:
+        texts.append(mode.split(":", maxsplit=1)[-1])
+    for key in ("query", "sort"):
+        if isinstance(op.get(key), str):
+            texts.append(op[key])
+
+    names = set()
+    for text in texts:
+        names.update(re.findall(r"(?<![\w.])[A-Za-z_]\w*", text.replace("evt.", "")))
+    return names
+
+
+def _prune_operations(config: Mapping) -> Mapping:
+    """Drop the operations that no field in ``outputs`` depends on.
+
+    Returns `config` itself if it has no ``outputs`` (everything is output) or
+    if nothing can be dropped.
+    """
+    if "outputs" not in config:
+        return config
+
+    operations = config["operations"]
+    needed = set()
+    todo = [f for f in config["outputs"] if f in operations]
+    while todo:
+        field = todo.pop()
+        if field in needed:
+            continue
+        needed.add(field)
+        todo.extend(
+            dep
+            for dep in _operation_dependencies(operations[field])
+            if dep in operations
+        )
+
+    if len(needed) == len(operations):
+        return config
+
+    log.debug(
+        "skipping operations not needed by the outputs: %s",
+        [f for f in operations if f not in needed],
+    )
+    return {
+        **config,
+        "operations": {f: v for f, v in operations.items() if f in needed},
+    }
+
+
+def _drop_schedule(config: Mapping) -> dict[int, list[str]]:
+    """The intermediate fields to drop after each operation.
+
+    Maps the position of an operation to the fields, not in ``outputs``, that
+    no operation after it reads.
+    """
+    operations = config["operations"]
+    outputs = set(config.get("outputs", operations))
+    position = {f: i for i, f in enumerate(operations)}
+
+    last_use = {}
+    for i, v in enumerate(operations.values()):
+        for dep in _operation_dependencies(v):
+            # names of later operations are not fields of the table yet
+            if position.get(dep, i) < i:
+                last_use[dep] = i
+
+    schedule = {}
+    for field, i in last_use.items():
+        if field not in outputs:
+            schedule.setdefault(i, []).append(field)
+    return schedule
+
+
+def _plan_reads(
+    datainfo: utils.DataInfo, operations: Mapping, channels: dict
+) -> dict[tuple[str, str], tuple[str, ...]]:
+    """Collect the lower-tier columns that the operations will read.
+
+    Parses the expression, query and sorter of every aggregation and returns,
+    for each ``(tier, channel)`` table, the fields read from it. ``function``
+    operations are not included, since the modules do their own reads.
+    """
+    lower_tiers = [k for k in datainfo._asdict() if k not in ("tcm", "evt")]
+    field_re = re.compile(
+        rf"({'|'.join(re.escape(t) for t in lower_tiers)})\.([a-zA-Z_$][\w$]*)"
+    )
+
+    plan = {}
+    for v in operations.values():
+        mode = v.get("aggregation_mode", "")
+        if not mode or mode == "function":
+            continue
+
+        exprs = [v["expression"], mode.split(":", maxsplit=1)[-1]]
+        if isinstance(v.get("query"), str) and "evt." not in v["query"]:
+            exprs.append(v["query"])
+        if v.get("sort") is not None:
+            exprs.append(v["sort"].split(":", maxsplit=1)[-1])
+        fields = [f for e in exprs for f in field_re.findall(e)]
+        if not fields:
+            continue
+
+        skip = set(_resolve_channels(v.get("exclude_channels", []), channels))
+        for ch in _resolve_channels(v.get("channels", []), channels):
+            if ch in skip:
+                continue
+            for tier, fld in fields:
+                plan.setdefault((tier, ch), {})[fld] = None
+
+    return {k: tuple(v) for k, v in plan.items()}
+
+
 def evaluate_expression(
     datainfo: utils.DataInfo | Mapping[str, Sequence[str, ...]],
     tcm: utils.TCMData,
@@ -1,14 +1,27 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
+from collections.abc import Iterable
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import ExitStack
+from copy import deepcopy
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing import Manager
 from pathlib import Path
+from queue import Queue
 
 import awkward as ak
+import h5py
 import lgdo
 import lh5
-from lgdo.types import Struct, Table, VectorOfVectors
+import numpy as np
+from lgdo.types import Array, Struct, Table, VectorOfVectors
+from rich import console, progress
 
+from ..datatools.utils import _setup_executor
 from . import tcm as ptcm
 
 log = logging.getLogger(__name__)
@@ -41,6 +54,39 @@ def _concat_tables(tbls):
     return out_tbl
 
 
+class _ReadAheadIterator:
+    """Wrap an :class:`lh5.LH5Iterator` so that its next chunk is read on a
+    worker thread while the current one is being merged.
+
+    Exposes the subset of the iterator interface used by
+    :func:`.tcm.generate_tcm_cols`. Chunks are copied, since the wrapped
+    iterator reuses its buffer.
+    """
+
+    def __init__(self, it: lh5.LH5Iterator, pool: Executor):
+        self.buffer_len = it.buffer_len
+        self.current_i_entry = 0
+        self._it = it
+        self._pool = pool
+        self._future = pool.submit(self._read)
+
+    def _read(self):
+        try:
+            buffer = next(self._it)
+        except StopIteration:
+            return None, None
+        return deepcopy(buffer), self._it.current_i_entry
+
+    def __next__(self):
+        buffer, i_entry = self._future.result()
+        if buffer is None:
+            raise StopIteration
+        self.current_i_entry = i_entry
+        if len(buffer) == self.buffer_len:
+            self._future = self._pool.submit(self._read)
+        return buffer
+
+
 def build_tcm(
     input_tables: list[tuple[str, str | list[str]]],
     coin_cols: str | list[str],
@@ -52,6 +98,10 @@ def build_tcm(
     wo_mode: str = "write_safe",
     buffer_len: int | None = None,
     out_fields: str | list[str] | None = None,
+    threads: int | None = None,
+    incremental: bool = False,
+    progress_queue: Queue | None = None,
+    job_id: int = 0,
 ) -> lgdo.Table | None:
     r"""Build a Time Coincidence Map (TCM).
 
@@ -78,8 +128,9 @@ def build_tcm(
         Width of the clustering window(s). If a single value is supplied it will
         be used for all ``coin_cols``.
     window_refs
-        Window reference for the clustering window. Currently only ``"last"`` is
-        implemented.
+        Window reference for the clustering window: ``"last"``, ``"first"``
+        or ``"center"``, see :func:`.tcm.generate_tcm_cols`. If a single value
+        is supplied it will be used for all ``coin_cols``.
     out_file
         name (including path) for the output file. If ``None``, no file will be
         written; the TCM will just be returned in memory.
@@ -91,6 +142,29 @@ def build_tcm(
     out_fields
         Optional additional fields to propagate from the input tables into the
         output TCM.
+    threads
+        if set, read the input tables ahead on this many worker threads, so
+        that HDF5 reading and decompression overlaps with the merge. Useful
+        for files with many channels.
+    incremental
+        if ``True``, do not write out the events at the end of the input that
+        hits from a later input file could still join. Instead, save them in
+        `out_file` as ``{out_name}_state``, together with the last value of
+        the first coincidence column for each table key. A later call with the
+        same `out_file` and `out_name` (and `wo_mode` other than ``"of"``)
+        then resumes from this state and appends to the existing TCM, with the
+        same result as building from the concatenation of the input files.
+        Only the last event is held back, and `row_in_table` still counts from
+        the start of each file, so the TCM gets a ``file_idx`` column with the
+        index of the input file of each hit, counted over all the calls. A
+        final call with ``incremental=False`` writes out the remaining events
+        and removes the state. Input files must be passed in time order: no
+        table may start before the last event held back.
+    progress_queue
+        queue to which progress information is sent, in the format understood
+        by :class:`lh5.MapProgress` (see :meth:`lh5.LH5Iterator.map`).
+    job_id
+        ``task_id`` used for the messages sent to `progress_queue`.
 
     Returns
     -------
@@ -134,8 +208,37 @@ def build_tcm(
             )
             raise ValueError(msg)
 
+    if incremental and out_file is None:
+        msg = "incremental TCM building requires an out_file"
+        raise ValueError(msg)
+
+    # resume from the state of a previous incremental build, if any
+    state_name = f"{out_name}_state"
+    pending = None
+    last_coin = {}
+    tables_attr = None
+    n_files = 0
+    resumed = (
+        out_file is not None
+        and wo_mode not in ("of", "overwrite_file")
+        and Path(out_file).exists()
+        and state_name in lh5.ls(out_file)
+    )
+    if resumed:
+        pending, last_coin, tables_attr, n_files = _read_tcm_state(
+            out_file, state_name, coin_cols
+        )
+        msg = f"resuming from {state_name} with {len(pending['table_key'])} hits"
+        log.debug(msg)
+
+    # the hits of a later file must not go before the event held back
+    held_back = None
+    if pending is not None and len(pending["table_key"]) > 0:
+        held_back = np.min(pending[coin_cols[0]])
+
     iterators = []
     table_keys = []
+    file_indices = []
     all_tables = []
 
     # determine buffer length automatically
@@ -151,13 +254,13 @@ def build_tcm(
             if out_fields is not None
             else 2 + len(set(coin_cols))
         )
-        buffer_len = int(10**7 / (ntables * n_fields))
+        buffer_len = int(10**7 / (max(ntables, 1) * n_fields))
 
     msg = f"buffer length is {buffer_len}"
     log.debug(msg)
 
     # loop over files
-    for filename, patterns in input_tables:
+    for file_idx, (filename, patterns) in enumerate(input_tables, start=n_files):
         patterns_list = [patterns] if isinstance(patterns, str) else patterns
 
         # make a list of tables in the file
@@ -195,40 +298,314 @@ def build_tcm(
                 )
             )
             table_keys.append(table_key)
+            file_indices.append(file_idx)
+
+            if (incremental or resumed) and len(iterators[-1]) > 0:
+                first, last = (
+                    lh5.read(f"{table}/{coin_cols[0]}", filename, start_row=i, n_rows=1)
+                    .nda[0]
+                    .item()
+                    for i in (0, len(iterators[-1]) - 1)
+                )
+                if table_key in last_coin and first < last_coin[table_key]:
+                    msg = (
+                        f"{coin_cols[0]} of {table} in {filename} starts at {first}, "
+                        f"before the last hit already in the TCM ({last_coin[table_key]})"
+                    )
+                    raise ValueError(msg)
+                if held_back is not None and first < held_back:
+                    msg = (
+                        f"{coin_cols[0]} of {table} in {filename} starts at {first}, "
+                        f"before the event held back by the last call ({held_back})"
+                    )
+                    raise ValueError(msg)
+                last_coin[table_key] = max(last, last_coin.get(table_key, last))
 
     coin_windows = [
         ptcm.coin_groups(n, w, r)
         for n, w, r in zip(coin_cols, coin_windows, window_refs, strict=False)
     ]
 
-    tcm_gen = ptcm.generate_tcm_cols(
-        iterators, coin_windows=coin_windows, table_keys=table_keys, fields=out_fields
-    )
+    # an appended TCM keeps the attributes it was created with
+    if tables_attr is None:
+        tables_attr = str(all_tables)
+
+    n_hits = sum(len(it) for it in iterators)
+    if pending is not None:
+        n_hits += len(pending["table_key"])
+    _put_progress(progress_queue, job_id, 0, n_hits, "Processing")
+
     tcm = []
     # clear existing output files
     if out_file is not None and wo_mode == "of" and Path(out_file).exists():
         Path(out_file).unlink()
 
-    wrote_first = False
-    while True:
-        try:
-            out_tbl = tcm_gen.__next__()
-            out_tbl.attrs.update(
-                {"tables": str(all_tables), "hash_func": str(hash_func)}
-            )
-            if out_file is not None:
-                lh5.write(
-                    out_tbl,
-                    out_name,
-                    out_file,
-                    wo_mode=wo_mode if not wrote_first else "a",
+    with ExitStack() as stack:
+        if threads is not None and threads > 0:
+            pool = stack.enter_context(ThreadPoolExecutor(threads))
+            iterators = [_ReadAheadIterator(it, pool) for it in iterators]
+
+        tcm_gen = ptcm.generate_tcm_cols(
+            iterators,
+            coin_windows=coin_windows,
+            table_keys=table_keys,
+            fields=out_fields,
+            pending=pending,
+            flush=not incremental,
+            file_indices=file_indices if incremental or resumed else None,
+        )
+
+        # when resuming, the TCM table may already exist
+        wrote_first = resumed
+        n_done = 0
+        while True:
+            try:
+                out_tbl = tcm_gen.__next__()
+                out_tbl.attrs.update(
+                    {"tables": tables_attr, "hash_func": str(hash_func)}
                 )
-                wrote_first = True
-            else:
-                tcm.append(out_tbl)
-        except StopIteration:
-            break
+                if out_file is not None:
+                    lh5.write(
+                        out_tbl,
+                        out_name,
+                        out_file,
+                        wo_mode=wo_mode if not wrote_first else "a",
+                    )
+                    wrote_first = True
+                else:
+                    tcm.append(out_tbl)
+                n_done += len(out_tbl.table_key.flattened_data)
+                _put_progress(progress_queue, job_id, n_done, n_hits, "Processing")
+            except StopIteration as stop:
+                pending = stop.value
+                break
+
+    if incremental:
+        _write_tcm_state(
+            out_file,
+            state_name,
+            pending,
+            last_coin,
+            coin_cols,
+            out_fields,
+            tables_attr,
+            n_files + len(input_tables),
+        )
+    elif resumed:
+        with h5py.File(out_file, "a") as f:
+            del f[state_name]
+
+    _put_progress(progress_queue, job_id, n_hits, n_hits, "Finished")
 
     if out_file is None:
         return _concat_tables(tcm)
     return None
+
+
+def _read_tcm_state(
+    out_file: str, state_name: str, coin_cols: list[str]
+) -> tuple[dict[str, np.ndarray], dict[int, float], str, int]:
+    # read the pending hits, last coincidence value per table key, TCM
+    # "tables" attribute and number of input files saved by an incremental
+    # build
+    state = lh5.read(state_name, out_file)
+    if state.attrs.get("coin_cols") != str(coin_cols):
+        msg = (
+            f"{state_name} in {out_file} was built with coin_cols "
+            f"{state.attrs.get('coin_cols')}, not {coin_cols}"
+        )
+        raise ValueError(msg)
+
+    pending = {k: v.nda for k, v in state["pending"].items()}
+    last_coin = dict(
+        zip(
+            state["tables"]["table_key"].nda.tolist(),
+            state["tables"]["last"].nda.tolist(),
+            strict=True,
+        )
+    )
+    return pending, last_coin, state.attrs["tables"], int(state.attrs["n_files"])
+
+
+def _write_tcm_state(
+    out_file: str,
+    state_name: str,
+    pending: dict[str, np.ndarray] | None,
+    last_coin: dict[int, float],
+    coin_cols: list[str],
+    out_fields: list[str] | None,
+    tables_attr: str,
+    n_files: int,
+) -> None:
+    # save what a later incremental build needs to resume
+    if pending is None:
+        int_cols = ("table_key", "row_in_table", "file_idx")
+        pending = {
+            k: np.zeros(0, dtype=int if k in int_cols else float)
+            for k in dict.fromkeys([*int_cols, *coin_cols, *(out_fields or [])])
+        }
+    state = Struct(
+        {
+            "pending": Table({k: Array(v) for k, v in pending.items()}),
+            "tables": Table(
+                {
+                    "table_key": Array(np.array(list(last_coin), dtype=int)),
+                    "last": Array(np.array(list(last_coin.values()))),
+                }
+            ),
+        },
+        attrs={
+            "coin_cols": str(coin_cols),
+            "tables": tables_attr,
+            "n_files": str(n_files),
+        },
+    )
+    lh5.write(state, state_name, out_file, wo_mode="o")
+
+
+def build_tcm_batch(
+    jobs: Iterable[tuple[list[tuple[str, str | list[str]]], str | None]],
+    coin_cols: str | list[str],
+    processes: int | None = None,
+    executor: Executor | None = None,
+    progress: progress.Progress | console.Console | bool = False,
+    **kwargs,
+) -> list[lgdo.Table | None]:
+    """Build many TCMs concurrently, one per job.
+
+    Typically used to build the TCM of every raw file in a run, with one job
+    per file. Log records emitted by the workers are forwarded to the loggers
+    of the parent process.
+
+    Parameters
+    ----------
+    jobs
+        each entry is ``(input_tables, out_file)``, see :func:`build_tcm`.
+    coin_cols
+        see :func:`build_tcm`.
+    processes
+        number of processes. If ``None``, use number equal to threads available
+        to `executor` (if provided), or else do not parallelize.
+    executor
+        :class:`concurrent.futures.Executor` object for managing parallelism.
+        If ``None``, create a :class:`concurrent.futures.ProcessPoolExecutor`
+        with number of processes equal to `processes`.
+    progress
+        if ``True`` draw a progress bar for each job; can also provide an
+        existing :class:`rich.progress.Progress` or :class:`rich.console.Console`.
+    kwargs
+        forwarded to :func:`build_tcm`.
+
+    Returns
+    -------
+    list
+        the return value of :func:`build_tcm` for each job, in order.
+    """
+    jobs = list(jobs)
+
+    with ExitStack() as stack:
+        processes, executor = _setup_executor(stack, processes, executor)
+
+        prog = None
+        if progress:
+            prog = stack.enter_context(
+                lh5.MapProgress(
+                    [
+                        Path(out_file).name if out_file is not None else f"#{i}"
+                        for i, (_, out_file) in enumerate(jobs)
+                    ],
+                    progress if progress is not True else None,
+                )
+            )
+
+        job_fun = partial(
+            _build_tcm_job,
+            coin_cols=coin_cols,
+            progress_queue=prog.queue if prog else None,
+            kwargs=kwargs,
+        )
+
+        if executor is None:
+            return [job_fun(i, job) for i, job in enumerate(jobs)]
+
+        # route log records from the workers through a queue to this process
+        manager = stack.enter_context(Manager())
+        log_queue = manager.Queue()
+        listener = QueueListener(log_queue, _LogForwarder())
+        listener.start()
+        stack.callback(listener.stop)
+
+        job_fun = partial(
+            job_fun,
+            log_queue=log_queue,
+            log_level=logging.getLogger("pygama").getEffectiveLevel(),
+            parent_pid=os.getpid(),
+        )
+        return list(executor.map(job_fun, range(len(jobs)), jobs))
+
+
+def _build_tcm_job(
+    job_id: int,
+    job: tuple[list[tuple[str, str | list[str]]], str | None],
+    *,
+    coin_cols: str | list[str],
+    progress_queue: Queue | None,
+    kwargs: dict,
+    log_queue: Queue | None = None,
+    log_level: int = logging.NOTSET,
+    parent_pid: int | None = None,
+) -> lgdo.Table | None:
+    # runs build_tcm for one job of build_tcm_batch, sending log records to
+    # the parent through log_queue when in a different process
+    input_tables, out_file = job
+
+    pygama_log = logging.getLogger("pygama")
+    redirect = log_queue is not None and os.getpid() != parent_pid
+    if redirect:
+        # handlers inherited from a forked parent would emit a second time
+        old_state = pygama_log.handlers, pygama_log.level, pygama_log.propagate
+        pygama_log.handlers = [QueueHandler(log_queue)]
+        pygama_log.setLevel(log_level)
+        pygama_log.propagate = False
+
+    try:
+        return build_tcm(
+            input_tables,
+            coin_cols,
+            out_file=out_file,
+            progress_queue=progress_queue,
+            job_id=job_id,
+            **kwargs,
+        )
+    finally:
+        if redirect:
+            pygama_log.handlers, level, pygama_log.propagate = old_state
+            pygama_log.setLevel(level)
+
+
+class _LogForwarder(logging.Handler):
+    """Hand records received from worker processes to the matching logger."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def _put_progress(
+    progress_queue: Queue | None, job_id: int, n_done: int, n_hits: int, status: str
+) -> None:
+    # report progress through the fraction of hits written to the TCM, in the
+    # format used by lh5.MapProgress
+    if progress_queue is None:
+        return
+    progress_queue.put(
+        {
+            "task_id": job_id,
+            "total": 1,
+            "completed": n_done / n_hits if n_hits > 0 else 1.0,
+            "entries": n_done,
+            "status": status,
+            "finished": status == "Finished",
+        }
+    )
@@ -0,0 +1,232 @@
+"""
+This module compiles the expressions and queries of `evt` configurations.
+"""
+
+from __future__ import annotations
+
+import ast
+import functools
+import logging
+import re
+from collections.abc import Iterable, Mapping
+
+import awkward as ak
+import numexpr as ne
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# array types that numexpr evaluates the same way as NumPy does, and the
+# numexpr signature type of each. Narrower types would be promoted
+# differently, so they stay with the fallback
+_NUMEXPR_TYPES = {
+    np.dtype(bool): bool,
+    np.dtype(np.int64): np.int64,
+    np.dtype(np.float64): np.float64,
+}
+
+# syntax that numexpr supports with NumPy semantics. Notably missing: `%` and
+# `//` (C rather than Python rounding), `and`/`or`/`not`, chained comparisons,
+# subscripts and attribute lookups (e.g. ``ak.`` calls)
+_NUMEXPR_NODES = (
+    ast.Expression,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.BitAnd,
+    ast.BitOr,
+    ast.BitXor,
+    ast.Invert,
+    ast.USub,
+    ast.UAdd,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+)
+
+
+class EvtExpression:
+    """An expression of the `evt` config language, compiled once.
+
+    References to fields of the lower tiers (e.g. ``hit.cuspEmax``) become
+    variables prefixed with the tier name (``hit_cuspEmax``), and the ``evt.``
+    prefix is dropped, as expected by :func:`.utils.find_parameters`.
+
+    Calling the object evaluates the expression. When all the variables it
+    uses are flat arrays (or scalars) of a type that numexpr handles like
+    NumPy, it runs a numexpr kernel, compiled once per combination of input
+    types. Anything else (jagged data, ``ak.`` calls, etc.) falls back to
+    Python's :func:`eval`.
+
+    Parameters
+    ----------
+    expr
+        the expression, as written in the configuration.
+    tiers
+        names of the tiers whose ``tier.`` prefix turns into ``tier_``.
+    """
+
+    def __init__(self, expr: str, tiers: Iterable[str]):
+        self.expr = expr
+
+        tiers = [t for t in tiers if t != "evt"]
+        src = re.sub(r"\bevt\.", "", expr)
+        if tiers:
+            src = re.sub(rf"\b({'|'.join(map(re.escape, tiers))})\.", r"\1_", src)
+        self.source = src
+
+        self.code = compile(src, "<evt expression>", "eval")
+        tree = ast.parse(src.strip(), mode="eval")
+
+        # a bare field reference needs no evaluation at all
+        self.field = tree.body.id if isinstance(tree.body, ast.Name) else None
+        self.names = sorted({n.id for n in ast.walk(tree) if isinstance(n, ast.Name)})
+
+        # arithmetic and comparisons only: each output element depends on the
+        # same element of the inputs, so the expression can be evaluated over
+        # the hits of many channels at once
+        self.elementwise = _numexpr_compatible(tree)
+        self.numexpr = self.field is None and self.elementwise
+        # NumPy refuses integers to negative integer powers, numexpr does not
+        self._float_pow_only = any(isinstance(n, ast.Pow) for n in ast.walk(tree))
+        self._kernels = {}
+
+    def __repr__(self) -> str:
+        return f"EvtExpression({self.expr!r})"
+
+    def __call__(self, variables: Mapping):
+        """Evaluate the expression with `variables` in scope."""
+        if self.field is not None and self.field in variables:
+            return variables[self.field]
+
+        if self.numexpr:
+            args = _numexpr_args(self.names, variables)
+            if args is not None:
+                kernel = self._kernel(args, variables)
+                if kernel is not None:
+                    return kernel(*args)
+
+        return eval(self.code, dict(variables))
+
+    def _kernel(self, args: list[np.ndarray], variables: Mapping) -> ne.NumExpr:
+        # numexpr kernels are typed, so compile one per input signature
+        signature = tuple((a.dtype, a.ndim) for a in args)
+        if signature not in self._kernels:
+            log.debug("compiling %r for %s", self.expr, signature)
+            self._kernels[signature] = self._compile(args, variables)
+        return self._kernels[signature]
+
+    def _compile(self, args: list[np.ndarray], variables: Mapping) -> ne.NumExpr:
+        # the kernel for the types of `args`, or None if numexpr does not
+        # support them or would not give the same result type as eval(), as
+        # checked on the first element (e.g. numexpr does bool + int in int32)
+        if self._float_pow_only and any(a.dtype.kind != "f" for a in args):
+            return None
+
+        sample = [a[:1] if a.ndim else a for a in args]
+        try:
+            kernel = ne.NumExpr(
+                self.source,
+                signature=[
+                    (name, _NUMEXPR_TYPES[a.dtype])
+                    for name, a in zip(self.names, args, strict=True)
+                ],
+            )
+            got = kernel(*sample)
+            with np.errstate(all="ignore"):
+                expected = eval(
+                    self.code,
+                    {
+                        name: s if s.ndim else variables[name]
+                        for name, s in zip(self.names, sample, strict=True)
+                    },
+                )
+        except (TypeError, ValueError, KeyError, NotImplementedError, ArithmeticError):
+            return None
+
+        if np.asarray(expected).dtype != got.dtype:
+            log.debug("numexpr result type differs for %r, not using it", self.expr)
+            return None
+        return kernel
+
+
+@functools.cache
+def compile_expression(expr: str, tiers: tuple[str, ...]) -> EvtExpression:
+    """The :class:`EvtExpression` for `expr`, compiled once per process.
+
+    Shared by all the chunks, channels and operations that evaluate the same
+    expression, so that its numexpr kernels are only built once.
+    """
+    return EvtExpression(expr, tiers)
+
+
+def flat_array(value) -> np.ndarray | None:
+    """`value` as a 1D NumPy array, or None if it is not a flat numeric array.
+
+    Columns read by :func:`.utils.read_rows` are lazily indexed awkward
+    arrays, which are materialised here. Jagged, record and option-type
+    arrays are refused.
+    """
+    if isinstance(value, ak.Array):
+        if value.ndim != 1 or not isinstance(
+            ak.type(value).content, ak.types.NumpyType
+        ):
+            return None
+        value = ak.to_numpy(value, allow_missing=False)
+    elif not isinstance(value, np.ndarray):
+        return None
+    return value if value.ndim == 1 else None
+
+
+def _numexpr_compatible(tree: ast.Expression) -> bool:
+    for node in ast.walk(tree):
+        if not isinstance(node, _NUMEXPR_NODES):
+            return False
+        if isinstance(node, ast.Compare) and len(node.ops) > 1:
+            return False
+        if isinstance(node, ast.Constant) and type(node.value) not in (
+            bool,
+            int,
+            float,
+        ):
+            return False
+    return True
+
+
+def _numexpr_args(names: list[str], variables: Mapping) -> list | None:
+    # the variables as typed NumPy objects, or None if numexpr cannot (or need
+    # not) evaluate them
+    args = []
+    has_array = False
+    for name in names:
+        if name not in variables:
+            return None
+        value = variables[name]
+
+        if isinstance(value, ak.Array):
+            value = flat_array(value)
+            if value is None:
+                return None
+        elif isinstance(value, bool | int | float):
+            value = np.asarray(value)
+        elif not isinstance(value, np.ndarray | np.generic):
+            return None
+
+        if value.dtype not in _NUMEXPR_TYPES or value.ndim > 1:
+            return None
+        has_array |= value.ndim == 1
+        args.append(value)
+
+    # all scalars: not worth a kernel call, and eval() returns a scalar
+    return args if has_array else None
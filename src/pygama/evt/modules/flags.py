@@ -0,0 +1,55 @@
+"""
+Module provides processors for event-level quality flags, stored as
+bit-aggregation columns (see :mod:`pygama.hit.aggregations`).
+"""
+
+from __future__ import annotations
+
+from collections.abc import Sequence
+
+import awkward as ak
+from lgdo import types
+
+from ...hit.aggregations import pack_bitmask, unpack_bitmask
+from .. import utils
+
+
+def pack_flags(
+    datainfo: utils.DataInfo,  # noqa: ARG001
+    tcm: utils.TCMData,  # noqa: ARG001
+    table_names: Sequence[str],  # noqa: ARG001
+    channel_mapping: dict,  # noqa: ARG001
+    *,
+    flags: Sequence[types.Array | types.VectorOfVectors],
+    bit_names: Sequence[str],
+) -> types.Array | types.VectorOfVectors:
+    """Pack event-level boolean fields into a bit-aggregation column.
+
+    For example, in the :func:`.build_evt` configuration: ::
+
+        "expression": "pygama.evt.modules.flags.pack_flags(<...>,
+            flags=[evt.is_muon_tagged, evt.is_discharge],
+            bit_names=['is_muon_tagged', 'is_discharge'])"
+    """
+    return pack_bitmask(flags, bit_names=bit_names)
+
+
+def get_flag(
+    datainfo: utils.DataInfo,  # noqa: ARG001
+    tcm: utils.TCMData,  # noqa: ARG001
+    table_names: Sequence[str],  # noqa: ARG001
+    channel_mapping: dict,  # noqa: ARG001
+    *,
+    aggregation: types.Array | types.VectorOfVectors,
+    name: str,
+) -> types.Array | types.VectorOfVectors:
+    """Extract the bit `name` of a bit-aggregation column.
+
+    The column must carry the ``bit_names`` attribute, which is forwarded from
+    the lower tiers to fields like ``hit.quality_flags`` (see
+    :func:`.build_evt`). Only the requested bit is unpacked.
+    """
+    bit = unpack_bitmask(aggregation, fields=[name])[name]
+    if bit.ndim == 1:
+        return types.Array(ak.to_numpy(bit))
+    return types.VectorOfVectors(bit)
@@ -97,9 +97,13 @@ def gather_pulse_data(
         if utils.get_tcm_id_by_pattern(datainfo.hit.table_fmt, id) is not None
     ]
 
-    tcm_id_padded = types.VectorOfVectors(tcm.table_key).to_aoesa().view_as("np")
-    locs = np.isin(tcm_id_padded, table_ids)
-    tcm_filtered = types.VectorOfVectors(tcm.table_key[ak.from_regular(locs)])
+    index = utils.tcm_index(tcm)
+    selected = index.hit_mask(table_ids)
+    tcm_filtered = types.VectorOfVectors(
+        tcm.table_key[ak.unflatten(selected, index.counts)]
+    )
+    # position of each selected hit in the filtered TCM
+    filtered_pos = np.cumsum(selected) - 1
     # prepare output
     out = np.empty(len(tcm_filtered.flattened_data.nda), dtype="object")
 
@@ -109,8 +113,7 @@ def gather_pulse_data(
             continue
 
         # determine list of indices found in the TCM that we want to load for channel
-        chan_tcm_indexs = np.where(ak.flatten(tcm.table_key) == table_id)[0].to_numpy()
-        tbl_idxs_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
+        chan_tcm_indexs, tbl_idxs_ch, _ = index.channel(table_id)
 
         if len(tbl_idxs_ch) == 0:
             msg = f"No entries for channel {channel}"
@@ -125,7 +128,7 @@ def gather_pulse_data(
         # remove nans (this happens when SiPM data is stored as ArrayOfEqualSizedArrays)
         data = ak.drop_none(ak.nan_to_none(data))
 
-        glob_ids_ch = np.where(tcm_filtered.flattened_data.nda == table_id)[0]
+        glob_ids_ch = filtered_pos[chan_tcm_indexs]
 
         out[glob_ids_ch] = ak.to_list(data)
 
@@ -207,16 +210,14 @@ def gather_tcm_data(
         if utils.get_tcm_id_by_pattern(datainfo.hit.table_fmt, id) is not None
     ]
     # find them in tcm.id (we'll filter the rest out)
-    tcm_id_padded = types.VectorOfVectors(tcm.table_key).to_aoesa().view_as("np")
-    locs = np.isin(tcm_id_padded, table_ids)
+    index = utils.tcm_index(tcm)
+    locs = ak.unflatten(index.hit_mask(table_ids), index.counts)
 
     # select tcm field requested by the user
     data = tcm._asdict()[tcm_field]
 
     # apply mask
-    # NOTE: need to cast to irregular axes, otherwise the masking result is
-    # non-nested
-    data = data[ak.from_regular(locs)]
+    data = data[locs]
 
     # check if user wants to apply a custom mask
     if drop_empty:
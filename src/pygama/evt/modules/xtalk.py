@@ -4,7 +4,6 @@ Module for cross talk correction of energies.
 
 from __future__ import annotations
 
-import awkward as ak
 import lh5
 import numpy as np
 from dbetto import Props
@@ -33,6 +32,7 @@ def build_tcm_index_array(
 
     # initialise the output object
     tcm_indexs_out = np.full((len(tcm.table_key), len(rawids)), np.nan)
+    index = utils.tcm_index(tcm)
 
     # parse observables string. default to hit tier
     for idx_chan, channel in enumerate(rawids):
@@ -43,8 +43,7 @@ def build_tcm_index_array(
         )
         if table_id is None:
             continue
-        chan_tcm_indexs = np.where(ak.flatten(tcm.table_key) == table_id)[0].to_numpy()
-        tbl_idxs_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
+        chan_tcm_indexs, tbl_idxs_ch, _ = index.channel(table_id)
         tcm_indexs_out[tbl_idxs_ch, idx_chan] = chan_tcm_indexs
 
     # transpose to return object where row is events and column rawid idx
@@ -89,14 +88,11 @@ def gather_energy(
 
     # initialise the output object
     energy_out = np.full((len(tcm.table_key), len(rawids)), np.nan)
+    index = utils.tcm_index(tcm)
 
     for idx_chan, channel in enumerate(rawids):
         tbl = types.Table()
-        chan_tcm_indexs = np.where(ak.flatten(tcm.table_key) == channel)[0].to_numpy()
-        tbl_idxs_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
-        evt_ids_ch = np.repeat(
-            np.arange(0, len(tcm.table_key)), ak.sum(tcm.table_key == channel, axis=1)
-        )
+        _, tbl_idxs_ch, evt_ids_ch = index.channel(channel)
 
         for name, file, group, column in tier_params:
             try:
@@ -155,14 +151,11 @@ def filter_hits(
             if (name, file, group, column) not in tier_params:
                 tier_params.append((name, file, group, column))
 
+    index = utils.tcm_index(tcm)
     for idx_chan, channel in enumerate(rawids):
         tbl = types.Table()
 
-        chan_tcm_indexs = np.where(ak.flatten(tcm.table_key) == channel)[0].to_numpy()
-        tbl_idxs_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
-        evt_ids_ch = np.repeat(
-            np.arange(0, len(tcm.table_key)), ak.sum(tcm.table_key == channel, axis=1)
-        )
+        _, tbl_idxs_ch, evt_ids_ch = index.channel(channel)
 
         for name, file, group, column in tier_params:
             try:
@@ -318,6 +311,7 @@ def calibrate_energy(
 
     table_fmt = datainfo._asdict()[tier].table_fmt
     file = datainfo._asdict()[tier].file
+    index = utils.tcm_index(tcm)
 
     for i, chan in enumerate(xtalk_matrix_rawids):
         try:
@@ -339,11 +333,7 @@ def calibrate_energy(
             if table_id is None:
                 continue
 
-            chan_tcm_indexs = np.where(ak.flatten(tcm.table_key) == table_id)[
-                0
-            ].to_numpy()
-            tbl_idxs_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
-            evt_ids_ch = ak.any(tcm.table_key == table_id, axis=1)
+            _, tbl_idxs_ch, evt_ids_ch = index.channel(table_id)
 
             # read the dsp data
             outtbl_obj = lh5.read(
@@ -3,7 +3,7 @@ from __future__ import annotations
 import logging
 from collections import namedtuple
 
-import awkward as ak
+import numba as nb
 import numpy as np
 from lgdo.types import Table, VectorOfVectors
 
@@ -14,6 +14,14 @@ log = logging.getLogger(__name__)
 
 coin_groups = namedtuple("coin_groups", ["name", "window", "window_ref"])
 
+# integers above this cannot be stacked into a float64 key matrix without
+# losing their ordering
+_MAX_EXACT_FLOAT_INT = 2**53
+
+# codes for the supported window references, as understood by
+# _cluster_boundaries
+_WINDOW_REFS = {"last": 0, "first": 1, "center": 2}
+
 
 def generate_tcm_cols(
     iterators: list,
@@ -21,6 +29,9 @@ def generate_tcm_cols(
     table_keys: list[int] | None = None,
     row_in_tables: list[int] | None = None,
     fields: list[str] | None = None,
+    pending: dict[str, np.ndarray] | None = None,
+    flush: bool = True,
+    file_indices: list[int] | None = None,
 ) -> dict[np.ndarray]:
     r"""Generate the columns of a time coincidence map.
 
@@ -45,8 +56,11 @@ def generate_tcm_cols(
     `table_key` and `row_in_table` correspond to the hits in event 0, rows 4 to 6
     correspond to event 1, and so on.
 
-    This implementation uses Awkward Arrays for concatenation, sorting, and
-    clustering.
+    This implementation keeps the pending (not yet written) hits in plain NumPy
+    column buffers. Every chunk read from an iterator is a sorted run, and the
+    runs are combined with the pending buffer by a compiled k-way merge (see
+    :func:`_kway_merge`); LGDO objects are only built for the rows that are
+    yielded.
 
     Parameters
     ----------
@@ -63,6 +77,11 @@ def generate_tcm_cols(
         - ``"first"`` -- the first element in the cluster (rigid window width)
         - ``"last"`` -- the last element in the cluster (window grows until two
           data are separated by more than coin_window)
+        - ``"center"`` -- the midpoint between the first and the last element
+          in the cluster (window grows at half the rate of ``"last"``)
+
+        When several coincidence columns are given, a datum starts a new
+        cluster as soon as it fails the test for any of them.
 
     table_keys
         if provided, use `table_keys` in place of "index in coin_data" as the
@@ -71,6 +90,18 @@ def generate_tcm_cols(
     row_in_tables
         if provided, use these values in places of the ``DataFrame`` index for
         the return values of `row_in_table`.
+    pending
+        hits left over by a previous call with ``flush=False``, to be
+        clustered together with the data from `iterators`.
+    flush
+        if ``False``, do not write out the last event of the data, which hits
+        from a later call could still join. Its hits are instead returned (as
+        the generator's return value, i.e. ``StopIteration.value``) in the
+        format accepted by `pending`, for incremental building.
+    file_indices
+        if provided, add a ``file_idx`` column holding, for each hit, the
+        entry of `file_indices` corresponding to its iterator. Used to tell
+        apart the rows of tables read from different files.
 
     Returns
     -------
@@ -81,69 +112,6 @@ def generate_tcm_cols(
         ``row_in_table`` specify the location in ``coin_data`` of each datum
         belonging to the coincidence event.
     """
-
-    def _sort_tcm(arr: ak.Array, coin_windows_local) -> ak.Array:
-        if arr is None or len(arr) == 0:
-            return arr
-
-        # primary keys are coin_cols in given order, with table_key as a tie-breaker
-        table_key_np = ak.to_numpy(arr["table_key"])
-        coin_key_nps = [ak.to_numpy(arr[entry.name]) for entry in coin_windows_local]
-        order = np.lexsort([table_key_np, *list(reversed(coin_key_nps))])
-        return arr[order]
-
-    def _get_sort_keys(arr: ak.Array, coin_windows_local) -> list[np.ndarray]:
-        keys = [ak.to_numpy(arr[entry.name]) for entry in coin_windows_local]
-        keys.append(ak.to_numpy(arr["table_key"]))
-        return keys
-
-    def _merge_sorted_tcms(a: ak.Array, b: ak.Array, coin_windows_local) -> ak.Array:
-        if a is None or len(a) == 0:
-            return b
-        if b is None or len(b) == 0:
-            return a
-
-        a_keys = _get_sort_keys(a, coin_windows_local)
-        b_keys = _get_sort_keys(b, coin_windows_local)
-
-        na = len(a)
-        nb = len(b)
-        out_idx = np.empty(na + nb, dtype=np.int64)
-
-        ia = 0
-        ib = 0
-        io = 0
-
-        while ia < na and ib < nb:
-            take_a = False
-            for ka, kb in zip(a_keys, b_keys, strict=False):
-                va = ka[ia]
-                vb = kb[ib]
-                if va < vb:
-                    take_a = True
-                    break
-                if va > vb:
-                    take_a = False
-                    break
-            else:
-                # stable: if identical keys, keep existing tcm (a) first
-                take_a = True
-
-            if take_a:
-                out_idx[io] = ia
-                ia += 1
-            else:
-                out_idx[io] = na + ib
-                ib += 1
-            io += 1
-
-        if ia < na:
-            out_idx[io:] = np.arange(ia, na, dtype=np.int64)
-        else:
-            out_idx[io:] = na + np.arange(ib, nb, dtype=np.int64)
-
-        return ak.concatenate([a, b], axis=0)[out_idx]
-
     if isinstance(iterators, list):
         iterators = np.array(iterators)
 
@@ -152,7 +120,26 @@ def generate_tcm_cols(
     elif not isinstance(coin_windows, list | tuple | np.ndarray):
         coin_windows = [coin_windows]
 
-    tcm = None
+    coin_names = [entry.name for entry in coin_windows]
+    for entry in coin_windows:
+        if entry.window_ref not in _WINDOW_REFS:
+            msg = f"window_ref {entry.window_ref}"
+            raise NotImplementedError(msg)
+    windows = np.array([entry.window for entry in coin_windows], dtype=np.float64)
+    window_refs = np.array(
+        [_WINDOW_REFS[entry.window_ref] for entry in coin_windows], dtype=np.int64
+    )
+    fields = [] if fields is None else list(fields)
+    if file_indices is not None:
+        fields.append("file_idx")
+
+    # pending hits, sorted by (coin columns..., table_key): the key matrix
+    # used for merging and clustering, and the columns that get written out
+    keys = None
+    cols = None
+    if pending is not None and len(pending["table_key"]) > 0:
+        keys, cols = _sorted_run(pending, coin_names, fields)
+
     at_end = np.zeros(len(iterators), dtype=bool)
     skip_mask = np.zeros(len(iterators), dtype=bool)
     buffer = None
@@ -166,9 +153,12 @@ def generate_tcm_cols(
     _tk_unsort = np.argsort(_tk_sort)
     table_keys_sorted = table_keys_np[_tk_sort]
 
-    while not at_end.all():
+    # make at least one pass, to deal with the pending hits if no iterators
+    first_pass = True
+    while first_pass or not at_end.all():
+        first_pass = False
         curr_mask = ~skip_mask & ~at_end
-        arrays = []
+        runs = []
 
         for _ii, it in enumerate(iterators[curr_mask]):
             ii = np.where(curr_mask)[0][_ii]
@@ -186,62 +176,64 @@ def generate_tcm_cols(
             if buf_len <= 0:
                 continue
 
-            buf_ak = buffer.view_as("ak")[:buf_len]
-
-            table_key = int(table_keys[ii])
-            buf_ak = ak.with_field(
-                buf_ak, np.full(buf_len, table_key, dtype=int), "table_key"
-            )
-
+            chunk = {"table_key": np.full(buf_len, int(table_keys[ii]), dtype=int)}
             if row_in_tables is not None:
-                row_in_table = row_in_tables.astype(int)[ii][start : start + buf_len]
+                chunk["row_in_table"] = row_in_tables.astype(int)[ii][
+                    start : start + buf_len
+                ]
             else:
-                row_in_table = np.arange(start, start + buf_len, dtype=int)
-            buf_ak = ak.with_field(buf_ak, row_in_table, "row_in_table")
-
-            # LH5Iterator reuses the same underlying buffer across iterations.
-            # Make an explicit copy so concatenation/merging isn't corrupted when the
-            # iterator advances and overwrites the buffer.
-            arrays.append(ak.copy(buf_ak))
+                chunk["row_in_table"] = np.arange(start, start + buf_len, dtype=int)
+            if file_indices is not None:
+                chunk["file_idx"] = np.full(buf_len, int(file_indices[ii]), dtype=int)
 
-        if at_end.all() and len(arrays) == 0 and tcm is None:
-            break
-        if len(arrays) == 0 and tcm is None:
-            continue
+            # LH5Iterator reuses the same underlying buffer across iterations,
+            # so take copies: the pending buffer outlives this chunk
+            for name in dict.fromkeys(coin_names + fields):
+                if name not in chunk:
+                    chunk[name] = np.array(buffer[name].nda[:buf_len])
 
-        new_tcm = ak.concatenate(arrays, axis=0) if len(arrays) > 0 else None
-        new_tcm = _sort_tcm(new_tcm, coin_windows)
+            runs.append(_sorted_run(chunk, coin_names, fields))
 
-        tcm = new_tcm if tcm is None else _merge_sorted_tcms(tcm, new_tcm, coin_windows)
+        if keys is None and len(runs) == 0:
+            continue
 
-        # Ensure tcm doesn't retain views into iterator-reused buffers.
-        tcm = ak.copy(tcm)
+        if len(runs) > 0:
+            keys, cols = _merge_runs(([] if keys is None else [(keys, cols)]) + runs)
 
-        if tcm is None or len(tcm) == 0:
+        if len(keys) == 0:
             continue
 
-        # define mask, true when new event, false if part of same event
-        mask = np.zeros(len(tcm) - 1, dtype=bool)
-        for entry in coin_windows:
-            diffs = np.diff(ak.to_numpy(tcm[entry.name]))
-            if entry.window_ref == "last":
-                mask = mask | (diffs > entry.window)
-            else:
-                msg = f"window_ref {entry.window_ref}"
-                raise NotImplementedError(msg)
+        # define mask, true when new event, false if part of same event. The
+        # pending buffer always starts at the beginning of an event, so
+        # clustering it from the top is exact across chunk boundaries
+        if (window_refs == _WINDOW_REFS["last"]).all():
+            mask = np.zeros(len(keys) - 1, dtype=bool)
+            for i_key, entry in enumerate(coin_windows):
+                mask |= np.diff(keys[:, i_key]) > entry.window
+        else:
+            mask = _cluster_boundaries(keys, windows, window_refs)
 
         # grab up to evt including last instance of a channel to know that all channels
         # have been included in previous evts
-        table_key_np = ak.to_numpy(tcm["table_key"])
-        row_in_table_np = ak.to_numpy(tcm["row_in_table"])  # reuse later for output
+        table_key_np = cols["table_key"]
+        row_in_table_np = cols["row_in_table"]
 
         # Fast last-occurrence computation (no per-hit Python loop):
         # map table_key values -> [0..n_keys) via searchsorted on sorted keys,
         # then take max index per key with np.maximum.at
+        # (hits carried over in `pending` may belong to no current iterator)
         key_pos = np.searchsorted(table_keys_sorted, table_key_np)
+        known = np.zeros(len(key_pos), dtype=bool)
+        if table_keys_sorted.size > 0:
+            in_range = key_pos < table_keys_sorted.size
+            known[in_range] = (
+                table_keys_sorted[key_pos[in_range]] == table_key_np[in_range]
+            )
         last_sorted = np.full(table_keys_sorted.size, -1, dtype=np.int64)
         np.maximum.at(
-            last_sorted, key_pos, np.arange(table_key_np.size, dtype=np.int64)
+            last_sorted,
+            key_pos[known],
+            np.arange(table_key_np.size, dtype=np.int64)[known],
         )
         last_idx = last_sorted[_tk_unsort]
 
@@ -260,10 +252,11 @@ def generate_tcm_cols(
             len(at_end),
         )
 
+        # exhausted tables hold nothing back: without flush, a later call can
+        # only add hits after the end of the data, which can join the last
+        # event at most
         for i, entry in enumerate(table_keys):
-            if entry not in last_instance:
-                last_instance[entry] = np.inf
-            if at_end[i]:
+            if entry not in last_instance or at_end[i]:
                 last_instance[entry] = np.inf
 
         active_keys = table_keys_np[~at_end]
@@ -278,12 +271,15 @@ def generate_tcm_cols(
             skip_mask = np.zeros(len(table_keys), dtype=bool)
 
         # want to write entries only up to last entry of a channel to ensure all included in evt
-        if at_end.all():
+        if at_end.all() and flush:
             write_mask = mask
             last_entry = None
         else:
-            last_instance_min = int(np.min([last_instance[arr] for arr in table_keys]))
-            last_entry = np.where(mask[:last_instance_min])[0]
+            # capped, so that without flush the last event is kept
+            last_instance_min = np.min(
+                [last_instance[arr] for arr in table_keys], initial=len(mask)
+            )
+            last_entry = np.where(mask[: int(last_instance_min)])[0]
 
             if len(last_entry) == 0:
                 continue
@@ -295,7 +291,7 @@ def generate_tcm_cols(
 
         # get cumulative_length
         cumulative_length = np.array(np.where(write_mask)[0]) + 1
-        if at_end.all():
+        if last_entry is None:
             cumulative_length = np.append(cumulative_length, len(write_mask) + 1)
 
         out_tbl = Table(size=len(cumulative_length))
@@ -313,16 +309,200 @@ def generate_tcm_cols(
                 flattened_data=row_in_table_np[:last_entry],
             ),
         )
-        if fields is not None:
-            for f in fields:
-                out_tbl.add_field(
-                    f,
-                    VectorOfVectors(
-                        cumulative_length=cumulative_length,
-                        flattened_data=ak.to_numpy(tcm[f])[:last_entry],
-                    ),
-                )
+        for f in fields:
+            out_tbl.add_field(
+                f,
+                VectorOfVectors(
+                    cumulative_length=cumulative_length,
+                    flattened_data=cols[f][:last_entry],
+                ),
+            )
 
-        tcm = None if last_entry is None else tcm[last_entry:]
+        if last_entry is None:
+            keys = cols = None
+        else:
+            # copy, so that the yielded table does not pin the whole buffer
+            keys = keys[last_entry:].copy()
+            cols = {k: v[last_entry:].copy() for k, v in cols.items()}
 
         yield out_tbl
+
+    if keys is None:
+        return None
+    return {name: keys[:, i] for i, name in enumerate(coin_names)} | cols
+
+
+def _sorted_run(
+    chunk: dict[str, np.ndarray], coin_names: list[str], fields: list[str]
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Turn one iterator chunk into a sorted run ``(keys, cols)``.
+
+    `keys` is the ``(n, len(coin_names) + 1)`` matrix of sort keys, with
+    ``table_key`` as the last (tie-breaking) column. Data coming out of the
+    DAQ is nearly always time-ordered already, in which case no sort is needed.
+    """
+    cols = {k: chunk[k] for k in dict.fromkeys(["table_key", "row_in_table", *fields])}
+    keys = _stack_keys([chunk[n] for n in coin_names] + [chunk["table_key"]])
+
+    if not _is_sorted(keys):
+        order = np.lexsort(keys.T[::-1])
+        keys = keys[order]
+        cols = {k: v[order] for k, v in cols.items()}
+
+    return keys, cols
+
+
+def _stack_keys(columns: list[np.ndarray]) -> np.ndarray:
+    """Stack key columns into one matrix of their common dtype."""
+    dtype = np.result_type(*columns)
+    if dtype.kind == "f":
+        for col in columns:
+            if col.dtype.kind in "iu" and np.any(
+                np.abs(col.astype(np.float64)) >= _MAX_EXACT_FLOAT_INT
+            ):
+                msg = (
+                    "cannot build a TCM from a mix of floating-point and integer "
+                    f"coincidence columns with integers >= 2**53 ({col.dtype})"
+                )
+                raise ValueError(msg)
+    elif dtype.kind not in "iu":
+        msg = f"coincidence columns must be numeric, got {dtype}"
+        raise ValueError(msg)
+
+    return np.column_stack([col.astype(dtype, copy=False) for col in columns])
+
+
+def _merge_runs(
+    runs: list[tuple[np.ndarray, dict[str, np.ndarray]]],
+) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Merge sorted runs ``(keys, cols)`` into a single sorted run.
+
+    Ties are resolved in favour of the earlier run, so that the pending buffer
+    (always passed first) keeps its hits ahead of equal-keyed new ones.
+    """
+    if len(runs) == 1:
+        return runs[0]
+
+    keys = np.concatenate([r[0] for r in runs])
+    run_bounds = np.cumsum([0] + [len(r[0]) for r in runs]).astype(np.int64)
+    order = _kway_merge(keys, run_bounds)
+
+    cols = {k: np.concatenate([r[1][k] for r in runs])[order] for k in runs[0][1]}
+    return keys[order], cols
+
+
+@nb.njit(cache=True)
+def _is_sorted(keys: np.ndarray) -> bool:
+    """Whether the rows of `keys` are in lexicographic order."""
+    for i in range(1, keys.shape[0]):
+        for j in range(keys.shape[1]):
+            if keys[i, j] > keys[i - 1, j]:
+                break
+            if keys[i, j] < keys[i - 1, j]:
+                return False
+    return True
+
+
+@nb.njit(cache=True)
+def _head_less(keys, cursor, ra, rb) -> bool:
+    """Whether the current head of run `ra` sorts before that of run `rb`."""
+    ia = cursor[ra]
+    ib = cursor[rb]
+    for j in range(keys.shape[1]):
+        if keys[ia, j] < keys[ib, j]:
+            return True
+        if keys[ia, j] > keys[ib, j]:
+            return False
+    return ra < rb
+
+
+@nb.njit(cache=True)
+def _kway_merge(keys: np.ndarray, run_bounds: np.ndarray) -> np.ndarray:
+    """Merge the sorted runs ``keys[run_bounds[i]:run_bounds[i+1]]``.
+
+    Keeps one cursor per run in a binary min-heap, so the cost is
+    ``O(n log k)`` for `n` rows in `k` runs. Returns the permutation of the
+    rows of `keys` that puts them in lexicographic order.
+    """
+    n_runs = len(run_bounds) - 1
+    cursor = run_bounds[:-1].copy()
+    heap = np.empty(n_runs, dtype=np.int64)
+    size = 0
+
+    # heapify the non-empty runs
+    for r in range(n_runs):
+        if cursor[r] == run_bounds[r + 1]:
+            continue
+        heap[size] = r
+        i = size
+        size += 1
+        while i > 0:
+            parent = (i - 1) // 2
+            if not _head_less(keys, cursor, heap[i], heap[parent]):
+                break
+            heap[i], heap[parent] = heap[parent], heap[i]
+            i = parent
+
+    out = np.empty(keys.shape[0], dtype=np.int64)
+    i_out = 0
+    while size > 1:
+        r = heap[0]
+        out[i_out] = cursor[r]
+        i_out += 1
+        cursor[r] += 1
+        if cursor[r] == run_bounds[r + 1]:
+            size -= 1
+            heap[0] = heap[size]
+
+        # sift the new head down
+        i = 0
+        while True:
+            child = 2 * i + 1
+            if child >= size:
+                break
+            if child + 1 < size and _head_less(
+                keys, cursor, heap[child + 1], heap[child]
+            ):
+                child += 1
+            if not _head_less(keys, cursor, heap[child], heap[i]):
+                break
+            heap[i], heap[child] = heap[child], heap[i]
+            i = child
+
+    # one run left: the rest of it is already in order
+    if size == 1:
+        r = heap[0]
+        for i in range(cursor[r], run_bounds[r + 1]):
+            out[i_out] = i
+            i_out += 1
+
+    return out
+
+
+@nb.njit(cache=True)
+def _cluster_boundaries(
+    keys: np.ndarray, windows: np.ndarray, window_refs: np.ndarray
+) -> np.ndarray:
+    """Cluster sorted rows of `keys`, one leading column per coincidence window.
+
+    Returns a mask of length ``len(keys) - 1`` that is true where row ``j + 1``
+    starts a new cluster. Unlike ``"last"``, the ``"first"`` and ``"center"``
+    references depend on where the current cluster started, so the rows are
+    scanned sequentially.
+    """
+    n = keys.shape[0]
+    mask = np.zeros(max(n - 1, 0), dtype=np.bool_)
+    start = 0
+    for j in range(1, n):
+        for i in range(len(windows)):
+            if window_refs[i] == 0:
+                ref = keys[j - 1, i]
+            elif window_refs[i] == 1:
+                ref = keys[start, i]
+            else:
+                ref = 0.5 * (keys[start, i] + keys[j - 1, i])
+            if keys[j, i] - ref > windows[i]:
+                mask[j - 1] = True
+                start = j
+                break
+    return mask
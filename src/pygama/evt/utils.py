@@ -14,52 +14,112 @@ import lh5
 import numpy as np
 from numpy.typing import NDArray
 
+from .expressions import compile_expression
+
 H5DataLoc = namedtuple(
     "H5DataLoc", ("file", "group", "table_fmt"), defaults=3 * (None,)
 )
 DataInfo = namedtuple("DataInfo", ("raw", "tcm", "evt"), defaults=3 * (None,))
 
+# longest range, in multiples of the number of rows wanted, that read_rows()
+# reads in one go instead of reading the rows point by point
+MAX_RANGE_READ_SPAN = 4
+
 TCMData = namedtuple(
-    "TCMData", ("table_key", "row_in_table", "cache"), defaults=(None,)
+    "TCMData",
+    ("table_key", "row_in_table", "cache", "index"),
+    defaults=(None, None),
 )
 
 
+class TCMIndex:
+    """The hits of a TCM chunk grouped by table key, in CSR layout.
+
+    The flattened (event-major) hits are stably sorted by table key, so that
+    the hits of the `i`-th entry of :attr:`table_keys` are the contiguous
+    slice ``offsets[i]:offsets[i+1]`` of :attr:`hit_idx` (position among the
+    flattened hits), :attr:`row_in_table` and :attr:`evt_idx`, in TCM order.
+
+    Built once per chunk with a single argsort, instead of scanning the whole
+    chunk with a full-length mask for every channel. :func:`.build_evt`
+    attaches it to the :obj:`TCMData` it hands to aggregators and modules;
+    use :func:`tcm_index` to get it.
+    """
+
+    def __init__(self, table_key: ak.Array, row_in_table: ak.Array):
+        flat_key = ak.to_numpy(ak.flatten(table_key))
+        flat_row = ak.to_numpy(ak.flatten(row_in_table))
+        self.counts = ak.to_numpy(ak.num(table_key, axis=1))
+        self.n_hits = len(flat_key)
+
+        order = np.argsort(flat_key, kind="stable")
+        self.table_keys, starts = np.unique(flat_key[order], return_index=True)
+        self.offsets = np.append(starts, self.n_hits)
+        self.hit_idx = order
+        self.row_in_table = flat_row[order]
+        self.evt_idx = np.repeat(np.arange(len(self.counts)), self.counts)[order]
+
+    def channel(self, table_id: int) -> tuple[NDArray, NDArray, NDArray]:
+        """``(hit_idx, row_in_table, evt_idx)`` of the hits of one table key."""
+        i = np.searchsorted(self.table_keys, table_id)
+        if i == len(self.table_keys) or self.table_keys[i] != table_id:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        sl = slice(self.offsets[i], self.offsets[i + 1])
+        return self.hit_idx[sl], self.row_in_table[sl], self.evt_idx[sl]
+
+    def hit_mask(self, table_ids) -> NDArray:
+        """Mask of the flattened hits that belong to any of `table_ids`."""
+        mask = np.zeros(self.n_hits, dtype=bool)
+        for table_id in table_ids:
+            mask[self.channel(table_id)[0]] = True
+        return mask
+
+
+def tcm_index(tcm) -> TCMIndex:
+    """The :class:`TCMIndex` of `tcm`, built on the spot if it has none."""
+    index = getattr(tcm, "index", None)
+    if index is None:
+        index = TCMIndex(tcm.table_key, tcm.row_in_table)
+    return index
+
+
 class EvtCache:
     """Memoises the work that :func:`build_evt_cols` would otherwise repeat.
 
     An `evt` configuration evaluates many operations over the same channels,
     and each operation is evaluated again for every TCM chunk. Without
-    memoisation the same HDF5 table is listed, the same lower-tier column is
-    read, and the same per-channel TCM index arrays are rebuilt once per
-    (chunk, operation, channel) — which is why calibration files, holding
-    ~200x more events than physics files and so ~100x more chunks, are so much
-    slower to process.
+    memoisation the same HDF5 table is listed and the same lower-tier column
+    is read once per (chunk, operation, channel) — which is why calibration
+    files, holding ~200x more events than physics files and so ~100x more
+    chunks, are so much slower to process. (The per-channel TCM indices are
+    kept in the chunk's :class:`TCMIndex` instead.)
 
-    Three caches with two different lifetimes:
+    Two caches with different lifetimes, plus the read plan (compiled
+    expressions are kept by :func:`.expressions.compile_expression`):
 
     `fields`
         which columns each ``(tier, channel)`` table holds. File-scoped: the
         input files do not change between chunks.
-    `code`
-        compiled expression objects, keyed by expression string. File-scoped.
-    `cols`, `idx`
-        lower-tier column data and per-channel TCM indices. Chunk-scoped, and
-        must be dropped by :meth:`new_chunk` because both are tied to the rows
-        of the chunk currently being processed.
+    `cols`
+        lower-tier column data. Chunk-scoped, and must be dropped by
+        :meth:`new_chunk` because it is tied to the rows of the chunk
+        currently being processed.
+    `plan`
+        the fields to read from each ``(tier, channel)`` table, as collected
+        from the whole configuration before the first chunk. The first
+        operation to touch a table reads all of its planned fields at once,
+        so that later operations find them in `cols`.
     """
 
     def __init__(self):
         self.fields = {}
-        self.code = {}
         self.cols = {}
-        self.idx = {}
-        self._n_hits = 0
+        self.plan = {}
 
     def new_chunk(self) -> None:
         """Drop everything tied to the previous chunk's rows."""
         self.cols.clear()
-        self.idx.clear()
-        self._n_hits = 0
 
     def table_fields(self, datainfo, tier_name: str, ch: str) -> frozenset:
         """Names of the columns held by ``ch``'s table in tier `tier_name`."""
@@ -80,39 +140,6 @@ class EvtCache:
             self.fields[key] = frozenset(lh5.ls(tier.file))
         return self.fields[key]
 
-    def compile(self, expr: str):
-        """Compile `expr` once and reuse the code object across channels."""
-        if expr not in self.code:
-            self.code[expr] = compile(expr, "<evt expression>", "eval")
-        return self.code[expr]
-
-    def channel_indices(self, tcm, table_id: int):
-        """``(chan_tcm_indexs, idx_ch, evt_ids_ch)`` for one channel.
-
-        Computed for every channel at once on first use, because the
-        per-channel form is a full jagged reduction over the chunk's TCM and
-        every aggregator needs it for every operation.
-        """
-        if not self.idx:
-            self._build_indices(tcm)
-        entry = self.idx.get(int(table_id))
-        if entry is None:
-            empty_mask = np.zeros(self._n_hits, dtype=bool)
-            empty = np.empty(0, dtype=np.int64)
-            return empty_mask, empty, empty
-        return entry
-
-    def _build_indices(self, tcm) -> None:
-        flat_key = ak.flatten(tcm.table_key).to_numpy()
-        flat_row = ak.flatten(tcm.row_in_table).to_numpy()
-        counts = ak.num(tcm.table_key, axis=1).to_numpy()
-        # event index of every hit, in flattened (event-major) order
-        evt_of_hit = np.repeat(np.arange(len(counts)), counts)
-        self._n_hits = len(flat_key)
-        for table_id in np.unique(flat_key):
-            mask = flat_key == table_id
-            self.idx[int(table_id)] = (mask, flat_row[mask], evt_of_hit[mask])
-
 
 def table_names(datainfo, tier_name="hit", cache=None) -> frozenset:
     """Names of the tables (channels) present in tier `tier_name`.
@@ -128,12 +155,11 @@ def table_names(datainfo, tier_name="hit", cache=None) -> frozenset:
 def channel_indices(tcm, table_id):
     """Locate one channel's hits within the current TCM chunk.
 
-    Returns ``(chan_tcm_indexs, idx_ch, evt_ids_ch)``: the mask selecting this
+    Returns ``(chan_tcm_indexs, idx_ch, evt_ids_ch)``: the positions of this
     channel's entries among the chunk's flattened hits, the rows to read from
     the channel's lower-tier table, and the event each of those hits belongs
-    to. Served from ``tcm.cache`` when there is one — every aggregator needs
-    these for every operation, and recomputing them is a full jagged reduction
-    over the chunk.
+    to. These are slices of the chunk's :class:`TCMIndex` (see
+    :func:`tcm_index`).
 
     Raises
     ------
@@ -152,16 +178,7 @@ def channel_indices(tcm, table_id):
         )
         raise ValueError(msg)
 
-    cache = getattr(tcm, "cache", None)
-    if cache is not None:
-        return cache.channel_indices(tcm, table_id)
-
-    chan_tcm_indexs = (ak.flatten(tcm.table_key) == table_id).to_numpy()
-    idx_ch = ak.flatten(tcm.row_in_table)[chan_tcm_indexs].to_numpy()
-    evt_ids_ch = np.repeat(
-        np.arange(0, len(tcm.table_key)), ak.sum(tcm.table_key == table_id, axis=1)
-    )
-    return chan_tcm_indexs, idx_ch, evt_ids_ch
+    return tcm_index(tcm).channel(table_id)
 
 
 def make_files_config(data: dict):
@@ -317,12 +334,8 @@ def find_parameters(
             continue
 
         if cache is None:
-            tier_ak = lh5.read_as(
-                f"{ch.replace('/', '')}/{tier.group}/",
-                tier.file,
-                field_mask=flds,
-                idx=idx_ch,
-                library="ak",
+            tier_ak = read_rows(
+                f"{ch.replace('/', '')}/{tier.group}/", tier.file, flds, idx_ch
             )
             final_dict |= dict(
                 zip(
@@ -333,17 +346,18 @@ def find_parameters(
             )
             continue
 
-        # read only the columns this chunk has not already loaded
+        # read only the columns this chunk has not already loaded, together
+        # with whatever else the plan needs from this table
         missing = list(
-            dict.fromkeys(f for f in flds if (name, ch, f) not in cache.cols)
+            dict.fromkeys(
+                f
+                for f in [*flds, *cache.plan.get((name, ch), ())]
+                if f in keys and (name, ch, f) not in cache.cols
+            )
         )
         if missing:
-            tier_ak = lh5.read_as(
-                f"{ch.replace('/', '')}/{tier.group}/",
-                tier.file,
-                field_mask=missing,
-                idx=idx_ch,
-                library="ak",
+            tier_ak = read_rows(
+                f"{ch.replace('/', '')}/{tier.group}/", tier.file, missing, idx_ch
             )
             for fld, col in zip(ak.fields(tier_ak), ak.unzip(tier_ak), strict=False):
                 cache.cols[(name, ch, fld)] = col
@@ -356,6 +370,33 @@ def find_parameters(
     return final_dict
 
 
+def read_rows(name: str, lh5_file, field_mask: list[str], idx: NDArray) -> ak.Array:
+    """Read the rows `idx` of some columns of a table, as an awkward array.
+
+    The rows of a channel within a TCM chunk are (nearly) contiguous, so they
+    are read as the single range ``idx.min()`` to ``idx.max()`` and picked out
+    in memory, rather than point by point. Falls back to a point read if the
+    range would be more than :data:`MAX_RANGE_READ_SPAN` times longer than
+    `idx`.
+    """
+    idx = np.asarray(idx)
+    if len(idx) > 0:
+        start = int(idx.min())
+        n_rows = int(idx.max()) - start + 1
+        if n_rows <= MAX_RANGE_READ_SPAN * len(idx):
+            tbl = lh5.read_as(
+                name,
+                lh5_file,
+                field_mask=field_mask,
+                start_row=start,
+                n_rows=n_rows,
+                library="ak",
+            )
+            return tbl[idx - start]
+
+    return lh5.read_as(name, lh5_file, field_mask=field_mask, idx=idx, library="ak")
+
+
 def get_data_at_channel(
     datainfo,
     ch,
@@ -400,7 +441,7 @@ def get_data_at_channel(
     elif expr == "tcm.row_in_table":
         res = idx_ch
     elif expr == "tcm.index":
-        res = np.where(chan_tcm_indexs)[0]
+        res = chan_tcm_indexs
     else:
         var = find_parameters(
             datainfo=datainfo,
@@ -413,22 +454,11 @@ def get_data_at_channel(
         if pars_dict is not None:
             var = var | pars_dict
 
-        # evaluate expression
-        # move tier+dots in expression to underscores (e.g. evt.foo -> evt_foo)
-
-        new_expr = expr
-        for name in datainfo._asdict():
-            if name == "evt":
-                new_expr = new_expr.replace(f"{name}.", "")
-            elif name not in ["tcm", "raw"]:
-                new_expr = new_expr.replace(f"{name}.", f"{name}_")
-
-        # compiled once per expression, then reused for every channel
-        code = cache.compile(new_expr) if cache is not None else new_expr
-        res = eval(
-            code,
-            var,
-        )
+        # evaluate expression, with tier prefixes turned into underscores
+        # (e.g. hit.foo -> hit_foo). Compiled once, then reused for every
+        # channel and chunk
+        tiers = tuple(k for k in datainfo._asdict() if k not in ("tcm", "raw"))
+        res = compile_expression(expr, tiers)(var)
 
         # in case the expression evaluates to a single value blow it up
         if not hasattr(res, "__len__") or isinstance(res, str):
@@ -492,16 +522,8 @@ def get_mask_from_query(
             cache=cache,
         )
 
-        new_query = query
-        for name in datainfo._asdict():
-            if name not in ["tcm", "evt"]:
-                new_query = new_query.replace(f"{name}.", f"{name}_")
-
-        code = cache.compile(new_query) if cache is not None else new_query
-        limarr = eval(
-            code,
-            query_var,
-        )
+        tiers = tuple(k for k in datainfo._asdict() if k not in ("tcm", "evt"))
+        limarr = compile_expression(query, tiers)(query_var)
 
         # in case the expression evaluates to a single value blow it up
         if (not hasattr(limarr, "__len__")) or (isinstance(limarr, str)):
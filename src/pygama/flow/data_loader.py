@@ -7,6 +7,7 @@ import logging
 import os
 import re
 import string
+from concurrent.futures import ThreadPoolExecutor
 from itertools import product
 from keyword import iskeyword
 from typing import Iterator
@@ -14,7 +15,6 @@ from typing import Iterator
 import lh5
 import numpy as np
 import pandas as pd
-from awkward_pandas import AwkwardDtype
 from dspeed.vis import WaveformBrowser
 from lh5 import LH5Iterator
 from lh5.io.utils import expand_vars
@@ -22,6 +22,7 @@ from lgdo.types import Array, Struct, Table
 from lgdo.types.vovutils import build_cl, explode_arrays
 from tqdm.auto import tqdm
 
+from ..utils import _AsyncWriter
 from . import utils
 from .file_db import FileDB
 
@@ -442,6 +443,7 @@ class DataLoader:
         save_output_columns: bool = False,
         in_memory: bool = True,
         output_file: str = None,
+        files: list[int] = None,
     ) -> dict[int, pd.DataFrame] | pd.DataFrame | None:
         """Applies cuts to the tables and files of interest.
 
@@ -466,6 +468,8 @@ class DataLoader:
             if ``True``, returns the generated entry list in memory.
         output_file
             HDF5 file name to write the entry list to.
+        files
+            indices of the files to use instead of `self.file_list`.
 
         Returns
         -------
@@ -479,7 +483,9 @@ class DataLoader:
         Does *not* load the column information into memory. This is done by
         :meth:`.load`.
         """
-        if self.file_list is None:
+        if files is None:
+            files = self.file_list
+        if files is None:
             raise ValueError("You need to make a query on filedb, use set_files()")
 
         if not in_memory and output_file is None:
@@ -492,7 +498,9 @@ class DataLoader:
 
         # Default columns in the entry_list
         if tcm_level is None:
-            return self.build_hit_entries(save_output_columns, in_memory, output_file)
+            return self.build_hit_entries(
+                save_output_columns, in_memory, output_file, files
+            )
 
         # Assumes only one tier in a TCM level
         parent = self.tcms[tcm_level]["parent"]
@@ -532,7 +540,7 @@ class DataLoader:
                         ):
                             for_output.append(term)
             col_tiers_dict[level] = self.get_tiers_for_col(
-                cut_cols[level], merge_files=False
+                cut_cols[level], merge_files=False, files=files
             )
 
         if save_output_columns:
@@ -541,13 +549,13 @@ class DataLoader:
         if log.getEffectiveLevel() >= logging.INFO:
             progress_bar = tqdm(
                 desc="Building entry list",
-                total=len(self.file_list),
+                total=len(files),
                 delay=2,
                 unit="keys",
             )
 
         # Make the entry list for each file
-        for file in self.file_list:
+        for file in files:
             if log.getEffectiveLevel() >= logging.INFO:
                 progress_bar.update()
                 progress_bar.set_postfix(
@@ -588,26 +596,29 @@ class DataLoader:
             except KeyError:
                 log.warning(f"Cannot find table {tcm_table_name} in file {tcm_path}")
                 continue
-            # vector of tables should have a better explode method
-            # Have to do some hacky stuff until I get a view_as("pd") method
-            f_entries = tcm_lgdo.view_as("pd")
-            for col in f_entries:
-                if isinstance(f_entries[col].dtype, AwkwardDtype):
-                    f_entries[col] = f_entries[col].to_list()
-            f_entries = f_entries.explode(list(f_entries.columns))
-            f_entries.reset_index(inplace=True)
+            # one entry per hit, as flat arrays: the TCM is exploded by
+            # repeating the per-event columns over the hits of each event
             renaming = {
-                "index": f"{child}_idx",
                 self.tcms[tcm_level]["tcm_cols"]["parent_tb"]: f"{parent}_table",
                 self.tcms[tcm_level]["tcm_cols"]["parent_idx"]: f"{parent}_idx",
             }
-            f_entries.rename(columns=renaming, inplace=True)
+            f_cols = utils.explode_tcm(tcm_lgdo, f"{child}_idx", renaming)
+            n_hits = len(f_cols[f"{child}_idx"])
             if self.merge_files:
-                f_entries["file"] = file
+                f_cols["file"] = np.full(n_hits, file)
             # At this point, should have a list of all available hits/evts joined by tcm
 
+            # the hits still in the entry list
+            keep = np.ones(n_hits, dtype=bool)
             if mode == "any":
-                drop_idx = None
+                # the hits dropped by all the cuts so far
+                drop_any = None
+            elif mode != "only":
+                raise ValueError("mode must be either 'any' or 'only'")
+
+            # output columns, and which hits they have been filled for
+            out_cols = {}
+            out_filled = {}
 
             # Perform cuts specified for child or parent level, in that order
             for level in [child, parent]:
@@ -618,6 +629,7 @@ class DataLoader:
                         cut = self.cuts[level]
 
                 col_tiers = col_tiers_dict[level]
+                level_idx = f_cols[f"{level}_idx"]
 
                 # Tables in first tier of event should be the same for all tiers in one level
                 tables = self.filedb.df.loc[file, f"{self.tiers[level][0]}_tables"]
@@ -631,76 +643,99 @@ class DataLoader:
 
                 # Cut any rows of TCM not relating to requested tables
                 if level == parent:
-                    f_entries.query(f"{level}_table in {tables}", inplace=True)
+                    keep &= np.isin(f_cols[f"{level}_table"], tables)
 
                 for tb in tables:
-                    tb_table = None
+                    # tiers with columns needed for the cut
+                    tiers = [
+                        tier
+                        for tier in self.tiers[level]
+                        if tb in col_tiers[file]["tables"].get(tier, [])
+                    ]
+                    if not tiers:
+                        continue
+
+                    # the hits in this table, and the table rows they refer to
+                    tb_mask = keep.copy()
                     if level == parent:
-                        tcm_idx = f_entries.query(f"{level}_table == {tb}").index
+                        tb_mask &= f_cols[f"{level}_table"] == tb
+                    rows, row_of_hit = np.unique(
+                        level_idx[tb_mask], return_inverse=True
+                    )
+
+                    tb_table = None
+                    if len(rows) > 0:
+                        # read the rows at once if they are the first ones
+                        if rows[-1] == len(rows) - 1:
+                            read_kwargs = {"n_rows": len(rows)}
+                        else:
+                            read_kwargs = {"idx": rows}
+                        for tier in tiers:
+                            tier_path = os.path.join(
+                                self.data_dir,
+                                self.filedb.tier_dirs[tier].lstrip("/"),
+                                self.filedb.df.loc[file, f"{tier}_file"].lstrip("/"),
+                            )
+                            table_name = self.filedb.get_table_name(tier, tb)
+                            try:
+                                tier_table = lh5.read(
+                                    table_name,
+                                    tier_path,
+                                    field_mask=cut_cols[level],
+                                    **read_kwargs,
+                                )
+                            except KeyError:
+                                log.warning(
+                                    f"Cannot find {table_name} in file {tier_path}"
+                                )
+                                continue
+                            if tb_table is None:
+                                tb_table = tier_table
+                            else:
+                                tb_table.join(tier_table)
+                        if tb_table is None:
+                            continue
+                        tb_df = tb_table.view_as("pd")
+                        passed = tb_df.eval(cut).to_numpy(dtype=bool)
                     else:
-                        tcm_idx = f_entries.index
-                    idx_mask = f_entries.loc[tcm_idx, f"{level}_idx"]
-                    for tier in self.tiers[level]:
-                        tier_path = os.path.join(
-                            self.data_dir,
-                            self.filedb.tier_dirs[tier].lstrip("/"),
-                            self.filedb.df.loc[file, f"{tier}_file"].lstrip("/"),
-                        )
-                        if tier in col_tiers[file]["tables"].keys():
-                            if tb in col_tiers[file]["tables"][tier]:
-                                table_name = self.filedb.get_table_name(tier, tb)
-                                try:
-                                    tier_table = lh5.read(
-                                        table_name,
-                                        tier_path,
-                                        field_mask=cut_cols[level],
-                                        idx=idx_mask.tolist(),
-                                    )
-                                except KeyError:
-                                    log.warning(
-                                        f"Cannot find {table_name} in file {tier_path}"
-                                    )
-                                    continue
-                                if tb_table is None:
-                                    tb_table = tier_table
-                                else:
-                                    tb_table.join(tier_table)
-                    if tb_table is None:
-                        continue
-                    tb_df = tb_table.view_as("pd")
-                    tb_df.query(cut, inplace=True)
-                    idx_match = f_entries.query(f"{level}_idx in {list(tb_df.index)}")
+                        passed = np.zeros(0, dtype=bool)
+
+                    # the hits whose row in this table passes the cut
+                    match = keep & np.isin(level_idx, rows[passed])
                     if level == parent:
-                        idx_match = idx_match.query(f"{level}_table == {tb}")
+                        match &= f_cols[f"{level}_table"] == tb
+
                     if mode == "only":
-                        keep_idx = idx_match.index
-                        drop_idx = set.symmetric_difference(
-                            set(tcm_idx), list(keep_idx)
-                        )
-                        f_entries.drop(drop_idx, inplace=True)
-                    elif mode == "any":
-                        evts = idx_match[f"{child}_idx"].unique().tolist()
-                        keep_idx = f_entries.query(f"{child}_idx in {evts}").index
-                        drop = set.symmetric_difference(
-                            set(f_entries.index), list(keep_idx)
-                        )
-                        if drop_idx is None:
-                            drop_idx = drop
-                        else:
-                            drop_idx = set.intersection(drop_idx, drop)
+                        keep &= ~tb_mask | match
                     else:
-                        raise ValueError("mode must be either 'any' or 'only'")
+                        # keep every hit of the events with a passing hit
+                        evts = np.unique(f_cols[f"{child}_idx"][match])
+                        drop = keep & ~np.isin(f_cols[f"{child}_idx"], evts)
+                        drop_any = drop if drop_any is None else drop_any & drop
 
-                    if save_output_columns:
+                    if save_output_columns and len(rows) > 0:
+                        hits = np.flatnonzero(tb_mask)
                         for col in tb_df.columns:
-                            if col in for_output:
-                                f_entries.loc[keep_idx, col] = tb_df[col].tolist()
+                            if col not in for_output:
+                                continue
+                            values = tb_df[col].to_numpy()
+                            if col not in out_cols:
+                                out_cols[col] = np.empty(n_hits, dtype=values.dtype)
+                                out_filled[col] = np.zeros(n_hits, dtype=bool)
+                            out_cols[col][hits] = values[row_of_hit]
+                            out_filled[col][hits] = True
 
-            if mode == "any":
-                if drop_idx is not None:
-                    f_entries.drop(index=drop_idx, inplace=True)
+            if mode == "any" and drop_any is not None:
+                keep &= ~drop_any
+
+            # hits without a value (e.g. in tables without the column) get NaN
+            for col, values in out_cols.items():
+                if not out_filled[col][keep].all():
+                    values = values.astype(float)
+                    values[~out_filled[col]] = np.nan
+                f_cols[col] = values
 
-            f_entries.reset_index(inplace=True, drop=True)
+            f_entries = pd.DataFrame({col: v[keep] for col, v in f_cols.items()})
 
             if in_memory:
                 entries[file] = f_entries
@@ -726,6 +761,7 @@ class DataLoader:
         save_output_columns: bool = False,
         in_memory: bool = True,
         output_file: str = None,
+        files: list[int] = None,
     ) -> dict[int, pd.DataFrame] | pd.DataFrame | None:
         """Called by :meth:`.build_entry_list` to handle the case when
         `tcm_level` is unspecified.
@@ -741,6 +777,8 @@ class DataLoader:
             If ``True``, returns the generated entry list in memory.
         output_file
             HDF5 file name to write the entry list to.
+        files
+            indices of the files to use instead of `self.file_list`.
 
         Returns
         -------
@@ -749,6 +787,8 @@ class DataLoader:
             ``{low_level}_table``, and output columns if
             applicable.  Only returned if `in_memory` is ``True``.
         """
+        if files is None:
+            files = self.file_list
         low_level = self.levels[0]
         if in_memory:
             entries = {}
@@ -779,18 +819,18 @@ class DataLoader:
                             entry_cols.append(term)
 
         log.debug(f"need to load {cut_cols} columns for applying cuts")
-        col_tiers = self.get_tiers_for_col(cut_cols, merge_files=False)
+        col_tiers = self.get_tiers_for_col(cut_cols, merge_files=False, files=files)
 
         if log.getEffectiveLevel() >= logging.INFO:
             progress_bar = tqdm(
                 desc="Building entry list",
-                total=len(self.file_list),
+                total=len(files),
                 delay=2,
                 unit="keys",
             )
 
         # now we loop over the files in our list
-        for file in self.file_list:
+        for file in files:
             if log.getEffectiveLevel() >= logging.INFO:
                 progress_bar.update()
                 progress_bar.set_postfix(
@@ -912,12 +952,19 @@ class DataLoader:
             return entries
 
     def next(
-        self, entry_list: pd.DataFrame = None, chunk_size: int = 10000, **kwargs
+        self,
+        entry_list: pd.DataFrame | dict[int, pd.DataFrame] = None,
+        chunk_size: int = 10000,
+        **kwargs,
     ) -> Iterator[Table | Struct | pd.DataFrame]:
         """Loads the requested data from disk in chunks.
 
         This method should be used instead of :meth:`.load` to handle large
-        data sets.
+        data sets. If no `entry_list` is given, it is built file by file as
+        the chunks are loaded, so that only the entries of one file are in
+        memory at a time. The next chunk is loaded in a background thread
+        while the current one is processed: the configuration of the loader
+        must not be changed during the iteration.
 
         Note
         ----
@@ -948,23 +995,74 @@ class DataLoader:
         .load
         """
         if entry_list is None:
-            entry_list = self.build_entry_list(
-                tcm_level=kwargs.get("tcm_level", None), save_output_columns=True
-            )
-
-        start = stop = 0
-        etot = len(entry_list)
-        while stop < etot:
-            start = stop
-
-            if stop + chunk_size > etot:
-                stop = etot
+            entries = self._stream_entry_list(kwargs.get("tcm_level", None))
+            streamed = True
+        else:
+            if isinstance(entry_list, dict):
+                entries = iter(entry_list.items())
             else:
-                stop += chunk_size
+                # merged entry lists have a file column
+                entries = iter([(None, entry_list)])
+            streamed = False
+
+        def load_chunks():
+            for files, chunk in self._chunk_entries(entries, chunk_size):
+                if streamed:
+                    yield self.load(entry_list=chunk, files=files, **kwargs)
+                else:
+                    yield self.load(entry_list=chunk, **kwargs)
+
+        yield from _prefetch(load_chunks())
 
-            yield self.load(
-                entry_list=entry_list[start:stop].reset_index(drop=True), **kwargs
+    def _stream_entry_list(
+        self, tcm_level: str = None
+    ) -> Iterator[tuple[int, pd.DataFrame]]:
+        # yields the entry list of each file of the file list in turn
+        for file in list(self.file_list):
+            entries = self.build_entry_list(
+                tcm_level=tcm_level, save_output_columns=True, files=[file]
             )
+            if isinstance(entries, dict):
+                entries = entries.get(file)
+            if entries is not None and len(entries) > 0:
+                yield file, entries
+
+    def _chunk_entries(
+        self, entries: Iterator[tuple[int, pd.DataFrame]], chunk_size: int
+    ) -> Iterator[tuple[list[int], pd.DataFrame | dict[int, pd.DataFrame]]]:
+        # regroups the (file, entry list) pairs of `entries` into chunks of
+        # `chunk_size` entries, in the format expected by load(). Returns them
+        # with the files they refer to
+        pieces = []
+        n_entries = 0
+
+        def make_chunk():
+            if self.merge_files:
+                chunk = pd.concat([p for _, p in pieces], ignore_index=True)
+                files = sorted(set(chunk["file"]))
+            else:
+                chunk = {}
+                for file, piece in pieces:
+                    if file in chunk:
+                        piece = pd.concat((chunk[file], piece))
+                    chunk[file] = piece.reset_index(drop=True)
+                files = list(chunk)
+            return files, chunk
+
+        for file, f_entries in entries:
+            start = 0
+            while start < len(f_entries):
+                stop = min(start + chunk_size - n_entries, len(f_entries))
+                pieces.append((file, f_entries[start:stop]))
+                n_entries += stop - start
+                start = stop
+                if n_entries == chunk_size:
+                    yield make_chunk()
+                    pieces = []
+                    n_entries = 0
+
+        if n_entries > 0:
+            yield make_chunk()
 
     def load(
         self,
@@ -973,6 +1071,7 @@ class DataLoader:
         output_file: str = None,
         orientation: str = "hit",
         tcm_level: str = None,
+        files: list[int] = None,
     ) -> None | Table | Struct | pd.DataFrame:
         """Loads the requested data from disk.
 
@@ -994,6 +1093,8 @@ class DataLoader:
             ``evt``.
         tcm_level
             which TCM was used to create the ``entry_list``.
+        files
+            indices of the files to use instead of `self.file_list`.
 
         Returns
         -------
@@ -1005,7 +1106,7 @@ class DataLoader:
         # set save_output_columns=True to avoid wasting time
         if entry_list is None:
             entry_list = self.build_entry_list(
-                tcm_level=tcm_level, save_output_columns=True
+                tcm_level=tcm_level, save_output_columns=True, files=files
             )
 
         if not in_memory and output_file is None:
@@ -1015,7 +1116,9 @@ class DataLoader:
             raise ValueError("need to set output columns to load data")
 
         if orientation == "hit":
-            self.data = self.load_hits(entry_list, in_memory, output_file, tcm_level)
+            self.data = self.load_hits(
+                entry_list, in_memory, output_file, tcm_level, files
+            )
         elif orientation == "evt":
             if tcm_level is None:
                 if len(self.tcms) == 1:
@@ -1038,6 +1141,7 @@ class DataLoader:
         in_memory: bool = False,
         output_file: str = None,
         tcm_level: str = None,
+        files: list[int] = None,
     ) -> None | Table | Struct | pd.DataFrame:
         """Called by :meth:`.load` when orientation is ``hit``."""
         if tcm_level is None:
@@ -1067,7 +1171,7 @@ class DataLoader:
                 if col not in entry_list.columns:
                     field_mask.append(col)
 
-            col_tiers = self.get_tiers_for_col(field_mask)
+            col_tiers = self.get_tiers_for_col(field_mask, files=files)
             col_dict = entry_list.to_dict("list")
             attr_dict = {}
             for key in col_dict:
@@ -1176,7 +1280,7 @@ class DataLoader:
                     if col not in f_entries.columns:
                         field_mask.append(col)
 
-                col_tiers = self.get_tiers_for_col(field_mask)
+                col_tiers = self.get_tiers_for_col(field_mask, files=[file])
                 col_dict = f_entries.to_dict("list")
                 attr_dict = {}
                 for key in col_dict:
@@ -1259,83 +1363,188 @@ class DataLoader:
 
     def load_evts(
         self,
-        entry_list: pd.DataFrame = None,
+        entry_list: pd.DataFrame | dict[int, pd.DataFrame] = None,
         in_memory: bool = False,
         output_file: str = None,
         tcm_level: str = None,
+        buffer_len: int = 3200,
     ) -> None | Table | Struct | pd.DataFrame:
-        """Called by :meth:`load` when orientation is ``evt``."""
-        raise NotImplementedError
-
-        parent = self.tcms[tcm_level]["parent"]
-        child = self.tcms[tcm_level]["child"]
-        load_levels = [parent, child]
+        """Called by :meth:`load` when orientation is ``evt``.
+
+        The output has one row per event of `tcm_level`. Columns of the child
+        level have one value per event, while ``{parent}_table``,
+        ``{parent}_idx`` and the columns of the parent level are
+        :class:`~lgdo.types.vectorofvectors.VectorOfVectors` with the values
+        of the hits of the event. The tables are read in chunks of at most
+        `buffer_len` rows with :func:`.utils.read_entries`.
+        """
+        if self.merge_files:
+            f_table = self._load_evt_table(entry_list, tcm_level, buffer_len)
 
-        if self.merge_files:  # Try to load all information at once
-            raise NotImplementedError
-        else:  # Not merge_files
+            if output_file:
+                lh5.write(f_table, "merged_data", output_file, wo_mode="o")
+            if in_memory:
+                if self.output_format == "lgdo.Table":
+                    return f_table
+                elif self.output_format == "pd.DataFrame":
+                    return f_table.view_as("pd")
+                else:
+                    raise ValueError(
+                        f"'{self.output_format}' output format not supported"
+                    )
+        else:  # not merge_files
             if in_memory:
                 load_out = Struct(attrs={"int_keys": True})
+
             for file, f_entries in entry_list.items():
-                field_mask = []
-                f_table = None
-                # Pre-allocate memory for output columns
-                for col in self.output_columns:
-                    if col not in f_entries.columns:
-                        f_entries[col] = None
-                        field_mask.append(col)
-                col_tiers = self.get_tiers_for_col(field_mask)
-                col_dict = f_entries.to_dict("list")
-                for col in col_dict.keys():
-                    nda = np.array(col_dict[col])
-                    col_dict[col] = Array(nda=nda)
+                f_table = self._load_evt_table(
+                    f_entries.assign(file=file), tcm_level, buffer_len
+                )
 
-                # Loop through each table in entry list
-                for tb in f_entries[f"{parent}_table"].unique():
-                    tcm_idx = f_entries.query(f"{parent}_table == {tb}").index
-                    for level in load_levels:
-                        idx_mask = f_entries.loc[tcm_idx, f"{level}_idx"]
-
-                        for tier in self.tiers[level]:
-                            if tb in col_tiers["tables"][tier]:
-                                tier_path = os.path.join(
-                                    self.data_dir,
-                                    self.filedb.tier_dirs[tier].lstrip("/"),
-                                    self.filedb.df.iloc[file][f"{tier}_file"].lstrip(
-                                        "/"
-                                    ),
-                                )
-                                if os.path.exists(tier_path):
-                                    table_name = self.filedb.get_table_name(tier, tb)
-                                    tier_table = lh5.read(
-                                        table_name,
-                                        tier_path,
-                                        idx=idx_mask,
-                                        field_mask=field_mask,
-                                    )
-                                    for col in tier_table.keys():
-                                        f_table[col].nda[tcm_idx] = tier_table[
-                                            col
-                                        ].tolist()
-                    # end tb loop
                 if in_memory:
-                    load_out[file] = f_table
+                    load_out.add_field(name=str(file), obj=f_table)
                 if output_file:
-                    lh5.write(f_table, f"file{file}", output_file, wo_mode="o")
-                # end file loop
+                    lh5.write(f_table, f"{file}", output_file, wo_mode="o")
 
             if in_memory:
+                load_out.update_datatype()
                 if self.output_format == "lgdo.Table":
                     return load_out
                 elif self.output_format == "pd.DataFrame":
-                    for file in load_out.keys():
-                        load_out[file] = load_out[file].view_as("pd")
-                    return load_out
+                    return [tb.view_as("pd") for tb in load_out.values()]
                 else:
                     raise ValueError(
                         f"'{self.output_format}' output format not supported"
                     )
 
+    def _load_evt_table(
+        self, entries: pd.DataFrame, tcm_level: str, buffer_len: int
+    ) -> Table:
+        # the event-oriented table of the entries of a merged entry list
+        parent = self.tcms[tcm_level]["parent"]
+        child = self.tcms[tcm_level]["child"]
+
+        entries = entries.sort_values(["file", f"{child}_idx"], kind="stable")
+        files = entries["file"].to_numpy()
+        evt_idx = entries[f"{child}_idx"].to_numpy()
+        tables = entries[f"{parent}_table"].to_numpy()
+        hit_idx = entries[f"{parent}_idx"].to_numpy()
+
+        # hits of the same event are consecutive
+        first = np.ones(len(entries), dtype=bool)
+        first[1:] = (files[1:] != files[:-1]) | (evt_idx[1:] != evt_idx[:-1])
+        evt_of_hit = np.cumsum(first) - 1
+        n_evts = int(np.count_nonzero(first))
+        cumulative_length = np.cumsum(np.bincount(evt_of_hit, minlength=n_evts))
+
+        col_tiers = self.get_tiers_for_col(
+            self.output_columns, merge_files=False, files=np.unique(files).tolist()
+        )
+
+        hit_cols = {f"{parent}_table": tables, f"{parent}_idx": hit_idx}
+        hit_attrs = dict.fromkeys(hit_cols)
+        evt_cols, evt_attrs = {}, {}
+        for file in np.unique(files):
+            in_file = files == file
+
+            for tb in np.unique(tables[in_file]):
+                hits = np.flatnonzero(in_file & (tables == tb))
+                for pos, tier_table in self._read_entries(
+                    file, parent, tb, hit_idx[hits], col_tiers, buffer_len
+                ):
+                    utils.fill_col_dict(
+                        tier_table,
+                        hit_cols,
+                        hit_attrs,
+                        hits[pos],
+                        len(entries),
+                        self.aoesa_to_vov,
+                    )
+
+            child_tables = self.filedb.df.loc[file, f"{self.tiers[child][0]}_tables"]
+            if self.table_list is not None:
+                child_tables = self.table_list.get(child)
+            if child_tables is None:
+                continue
+
+            evts = np.flatnonzero(in_file & first)
+            for tb in child_tables:
+                for pos, tier_table in self._read_entries(
+                    file, child, tb, evt_idx[evts], col_tiers, buffer_len
+                ):
+                    utils.fill_col_dict(
+                        tier_table,
+                        evt_cols,
+                        evt_attrs,
+                        evt_of_hit[evts[pos]],
+                        n_evts,
+                        self.aoesa_to_vov,
+                    )
+
+        col_dict = {f"{child}_idx": Array(evt_idx[first])}
+        if self.merge_files:
+            col_dict["file"] = Array(files[first])
+        for col, obj in utils.dict_to_table(hit_cols, hit_attrs).items():
+            col_dict[col] = utils.group_rows(obj, cumulative_length)
+        if evt_cols:
+            col_dict.update(utils.dict_to_table(evt_cols, evt_attrs).items())
+
+        return Table(col_dict=col_dict)
+
+    def _read_entries(
+        self,
+        file: int,
+        level: str,
+        tb: int,
+        rows: np.ndarray,
+        col_tiers: dict,
+        buffer_len: int,
+    ) -> Iterator[tuple[np.ndarray, Table]]:
+        # reads the rows of table tb from the tiers of level that have columns
+        # in col_tiers, in chunks, joining the columns of the tiers
+        readers = []
+        for tier in self.tiers[level]:
+            if tb not in col_tiers[file]["tables"][tier]:
+                continue
+            tier_path = os.path.join(
+                self.data_dir,
+                self.filedb.tier_dirs[tier].lstrip("/"),
+                self.filedb.df.iloc[file][f"{tier}_file"].lstrip("/"),
+            )
+            # this should not happen
+            if not os.path.exists(tier_path):
+                raise FileNotFoundError(tier_path)
+
+            readers.append(
+                utils.read_entries(
+                    self.filedb.get_table_name(tier, tb),
+                    tier_path,
+                    rows,
+                    field_mask=[
+                        col
+                        for col, col_tier in col_tiers[file]["columns"].items()
+                        if col_tier == tier
+                    ],
+                    buffer_len=buffer_len,
+                )
+            )
+
+        # no tier holds any of the columns: the rows still get their (empty)
+        # chunks, in the order the readers would give them
+        if not readers:
+            order = np.argsort(rows, kind="stable")
+            for start in range(0, len(rows), buffer_len):
+                positions = order[start : start + buffer_len]
+                yield positions, Table(size=len(positions))
+            return
+
+        # the readers split the rows in the same chunks
+        for chunks in zip(*readers):
+            positions, tier_table = chunks[0]
+            for _, other in chunks[1:]:
+                tier_table.join(other)
+            yield positions, tier_table
+
     def load_iterator(
         self,
         entry_list: pd.DataFrame = None,
@@ -1363,11 +1572,43 @@ class DataLoader:
             LH5 Iterator, which yields (lh5 table, entry, n_entries) when
             iterated over.
         """
+        if not self.merge_files:
+            if entry_list is None:
+                entries = self._stream_entry_list(tcm_level)
+            else:
+                entries = iter(entry_list.items())
+            return self._file_iterators(entries, tcm_level, buffer_len)
+
         if entry_list is None:
             entry_list = self.build_entry_list(
                 tcm_level=tcm_level, save_output_columns=True
             )
+        return self._merged_iterator(entry_list, tcm_level, buffer_len)
 
+    def _file_iterators(
+        self,
+        entries: Iterator[tuple[int, pd.DataFrame]],
+        tcm_level: str,
+        buffer_len: int,
+    ) -> Iterator[tuple[int, Table]]:
+        # yields the chunks of each file in turn, with the file they are from
+        for file, f_entries in entries:
+            lh5_it = self._merged_iterator(
+                f_entries.assign(file=file), tcm_level, buffer_len, files=[file]
+            )
+            if lh5_it is None:
+                continue
+            for tbl in lh5_it:
+                yield file, tbl
+
+    def _merged_iterator(
+        self,
+        entry_list: pd.DataFrame,
+        tcm_level: str,
+        buffer_len: int,
+        files: list[int] = None,
+    ) -> LH5Iterator:
+        # the LH5Iterator over the entries of a merged entry list
         if tcm_level is None:
             parent = self.levels[0]
             child = None
@@ -1377,55 +1618,52 @@ class DataLoader:
             child = self.tcms[tcm_level]["child"]
             load_levels = [parent, child]
 
-        if self.merge_files:
-            tables = entry_list[f"{parent}_table"].unique()
-            field_mask = []
-            for col in self.output_columns:
-                if col not in entry_list.columns:
-                    field_mask.append(col)
+        tables = entry_list[f"{parent}_table"].unique()
+        field_mask = []
+        for col in self.output_columns:
+            if col not in entry_list.columns:
+                field_mask.append(col)
 
-            col_tiers = self.get_tiers_for_col(field_mask)
+        col_tiers = self.get_tiers_for_col(field_mask, merge_files=True, files=files)
 
-            lh5_it = None
-            for level in load_levels:
-                for tier in self.tiers[level]:
-                    # Build list of files/tables/entries
-                    lh5_files = []
-                    tb_names = []
-                    idx_list = []
-                    for tb in tables:
-                        if tb not in col_tiers[tier]:
-                            continue
-                        gb = entry_list.query(f"{parent}_table == {tb}").groupby("file")
-                        lh5_files += [
-                            os.path.join(
-                                self.filedb.tier_dirs[tier].lstrip("/"),
-                                self.filedb.df.iloc[file][f"{tier}_file"].lstrip("/"),
-                            )
-                            for file in gb.groups.keys()
-                        ]
-                        tb_names += [[self.filedb.get_table_name(tier, tb)]] * len(gb)
-                        idx_list += [
-                            list(entry_list.loc[i, f"{level}_idx"])
-                            for i in gb.groups.values()
-                        ]
-
-                    # Create iterator for this tier and friend to other tiers
-                    if len(lh5_files) > 0:
-                        lh5_it = LH5Iterator(
-                            lh5_files=lh5_files,
-                            groups=tb_names,
-                            base_path=self.data_dir,
-                            entry_list=idx_list,
-                            field_mask=field_mask,
-                            buffer_len=buffer_len,
-                            friend=lh5_it,
-                            safe_mode=False,
+        lh5_it = None
+        for level in load_levels:
+            for tier in self.tiers[level]:
+                # Build list of files/tables/entries
+                lh5_files = []
+                tb_names = []
+                idx_list = []
+                for tb in tables:
+                    if tb not in col_tiers[tier]:
+                        continue
+                    gb = entry_list.query(f"{parent}_table == {tb}").groupby("file")
+                    lh5_files += [
+                        os.path.join(
+                            self.filedb.tier_dirs[tier].lstrip("/"),
+                            self.filedb.df.iloc[file][f"{tier}_file"].lstrip("/"),
                         )
+                        for file in gb.groups.keys()
+                    ]
+                    tb_names += [[self.filedb.get_table_name(tier, tb)]] * len(gb)
+                    idx_list += [
+                        list(entry_list.loc[i, f"{level}_idx"])
+                        for i in gb.groups.values()
+                    ]
 
-            return lh5_it
-        else:  # not merge_files
-            raise NotImplementedError
+                # Create iterator for this tier and friend to other tiers
+                if len(lh5_files) > 0:
+                    lh5_it = LH5Iterator(
+                        lh5_files=lh5_files,
+                        groups=tb_names,
+                        base_path=self.data_dir,
+                        entry_list=idx_list,
+                        field_mask=field_mask,
+                        buffer_len=buffer_len,
+                        friend=lh5_it,
+                        safe_mode=False,
+                    )
+
+        return lh5_it
 
     def load_detector(self, det_id):
         """
@@ -1455,11 +1693,92 @@ class DataLoader:
         """
         raise NotImplementedError
 
-    def skim_waveforms(self, mode: str = "hit", hit_list=None, evt_list=None):
-        """
-        handle this one separately because waveforms can easily fill up memory.
+    def skim_waveforms(
+        self,
+        output_file: str,
+        entry_list: pd.DataFrame | dict[int, pd.DataFrame] = None,
+        tcm_level: str = None,
+        buffer_len: int = 3200,
+        wo_mode: str = "overwrite_file",
+    ) -> None:
+        """Copies the requested columns of the selected entries to a file.
+
+        Unlike :meth:`.load`, which holds all the loaded data in memory, this
+        reads and writes the entries in chunks of at most `buffer_len` rows,
+        and is meant to pick a few waveforms out of large files. For each
+        file and table, the selected rows are read in increasing order as
+        ranges of consecutive rows with :func:`.utils.read_entries`.
+
+        The entries are written to the table ``skim`` of `output_file`, with
+        the columns of the entry list followed by the output columns of the
+        parent level that are not already in the entry list. They are
+        ordered by file, table and row.
+
+        Parameters
+        ----------
+        output_file
+            the LH5 file to write the entries to.
+        entry_list
+            the output of :meth:`.build_entry_list`. If ``None``, builds it
+            one file at a time according to the current configuration.
+        tcm_level
+            which TCM was used to create the ``entry_list``.
+        buffer_len
+            the maximum number of entries to read at once.
+        wo_mode
+            the write mode of the first chunk, see :func:`lh5.write`. The
+            other chunks are appended to it.
+
+        Examples
+        --------
+        >>> dl.set_cuts({"hit": "trapEmax > 5000"})
+        >>> dl.set_output(columns=["waveform"])
+        >>> dl.skim_waveforms("skim.lh5")
         """
-        raise NotImplementedError
+        if self.output_columns is None or not self.output_columns:
+            raise ValueError("need to set output columns to load data")
+
+        if tcm_level is None:
+            parent = self.levels[0]
+        else:
+            parent = self.tcms[tcm_level]["parent"]
+
+        if entry_list is None:
+            entries = self._stream_entry_list(tcm_level)
+        elif isinstance(entry_list, dict):
+            entries = entry_list.items()
+        else:
+            entries = entry_list.groupby("file", sort=True)
+
+        with _AsyncWriter() as writer:
+            for file, f_entries in entries:
+                f_entries = f_entries.assign(file=file)
+                field_mask = [
+                    col for col in self.output_columns if col not in f_entries.columns
+                ]
+                col_tiers = self.get_tiers_for_col(
+                    field_mask, merge_files=False, files=[file]
+                )
+
+                tables = f_entries[f"{parent}_table"].to_numpy()
+                rows = f_entries[f"{parent}_idx"].to_numpy()
+                for tb in np.unique(tables):
+                    hits = np.flatnonzero(tables == tb)
+                    for pos, tier_table in self._read_entries(
+                        file, parent, tb, rows[hits], col_tiers, buffer_len
+                    ):
+                        sel = f_entries.iloc[hits[pos]]
+                        skim = Table(
+                            col_dict={
+                                col: Array(sel[col].to_numpy())
+                                for col in f_entries.columns
+                            }
+                        )
+                        skim.join(tier_table)
+                        writer.write(
+                            obj=skim, name="skim", lh5_file=output_file, wo_mode=wo_mode
+                        )
+                        wo_mode = "append"
 
     # TODO: automatically get the dsp_config/par_database used for
     #   processing when these are set to None
@@ -1523,7 +1842,10 @@ class DataLoader:
         return WaveformBrowser(lh5_it, buffer_len=buffer_len, **kwargs)
 
     def get_tiers_for_col(
-        self, columns: list | np.ndarray, merge_files: bool = None
+        self,
+        columns: list | np.ndarray,
+        merge_files: bool = None,
+        files: list[int] = None,
     ) -> dict:
         """For each column given, get the tiers and tables in that tier where
         that column can be found.
@@ -1532,6 +1854,8 @@ class DataLoader:
         ----------
         columns
             the columns to look for.
+        files
+            indices of the files to look in instead of `self.file_list`.
 
         Returns
         -------
@@ -1552,9 +1876,11 @@ class DataLoader:
 
         if merge_files is None:
             merge_files = self.merge_files
+        if files is None:
+            files = self.file_list
 
         if merge_files:
-            for file in self.file_list:
+            for file in files:
                 col_inds = set()
                 for i, col_list in enumerate(self.filedb.columns):
                     if not set(col_list).isdisjoint(columns):
@@ -1576,7 +1902,7 @@ class DataLoader:
                                     )
         else:
             # loop over selected files (db entries)
-            for file in self.file_list:
+            for file in files:
                 # this is the output object
                 col_tiers[file] = {"tables": {}, "columns": {}}
                 # Rows of FileDB.columns that include columns that we are interested in
@@ -1616,3 +1942,18 @@ class DataLoader:
             f"aoesa_to_vov={self.aoesa_to_vov}"
             ")"
         )
+
+
+def _prefetch(iterator: Iterator) -> Iterator:
+    """Iterates over `iterator`, computing the next item in a background
+    thread while the current one is being processed by the caller.
+    """
+    done = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, iterator, done)
+        while True:
+            item = future.result()
+            if item is done:
+                return
+            future = executor.submit(next, iterator, done)
+            yield item
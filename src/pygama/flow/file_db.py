@@ -8,6 +8,8 @@ import os
 import re
 import string
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 import h5py
 import lh5
@@ -122,6 +124,7 @@ class FileDB:
             `raw` files to fill its rows with file keys.
         """
         self.df = None
+        self.dir_mtimes = {}
 
         config_path = None
         if isinstance(config, str):
@@ -195,12 +198,18 @@ class FileDB:
             tier_dirs[k] = expand_vars(val, substitute=subst_vars)
         self.tier_dirs = tier_dirs
 
-    def scan_files(self, dirs: list[str] = None) -> None:
+    def scan_files(
+        self, dirs: list[str] = None, n_threads: int = None, update: bool = False
+    ) -> None:
         """Scan the directory containing files from the lowest tier and fill the dataframe.
 
         The lowest tier is defined as the first element of the `tiers` array.
         Only fills columns that can be populated with just these files.
 
+        Each directory is listed once with :func:`os.scandir`, and its
+        modification time is stored in `self.dir_mtimes` (and saved by
+        :meth:`.to_disk`).
+
         Parameters
         ----------
         dirs
@@ -209,6 +218,16 @@ class FileDB:
             directory of the lowest-tier files. If ``None``, the whole root
             lowest-tier directory is scanned. Useful to build a partial
             database.
+        n_threads
+            if not ``None``, list the directories with a pool of `n_threads`
+            threads. Useful on network file systems.
+        update
+            if ``True``, only list the directories whose modification time
+            changed since they were last scanned. Rows are added for their
+            new files and dropped for the files that are gone, the other rows
+            are kept as they are. The new rows have no tables and columns
+            until :meth:`.scan_tables_columns` is run with
+            ``missing_only=True``.
         """
         file_keys = []
         n_files = 0
@@ -226,6 +245,7 @@ class FileDB:
 
         log.info(f"scanning {scan_dirs} with template {template}")
 
+        abs_scan_dirs = []
         for scan_dir in scan_dirs:
             # some logic to guess where the scan directory is
             if not os.path.isabs(scan_dir):
@@ -237,103 +257,211 @@ class FileDB:
                     scan_dir = os.path.join(self.data_dir, scan_dir)
                 else:
                     scan_dir = os.path.join(os.getcwd(), scan_dir)
-
-            log.debug(f"scanning {scan_dir}")
-
-            for path, _, files in os.walk(scan_dir):
-                log.debug(f"scanning {path}")
-                n_files += len(files)
-
-                for f in files:
-                    # in some cases, we need information from the path name
-                    if "/" in template:
-                        f_tmp = path.replace(root_scan_dir, "") + "/" + f
-                    else:
-                        f_tmp = f
-
-                    finfo = parse(template, f_tmp)
-                    if finfo is not None:
-                        finfo = finfo.named
-                        for tier in self.tiers:
-                            finfo[f"{tier}_file"] = self.file_format[tier].format(
-                                **finfo
-                            )
-
-                        file_keys.append(finfo)
+            abs_scan_dirs.append(scan_dir)
+
+        def dir_key(path):
+            return os.path.relpath(path, root_scan_dir)
+
+        known = self.dir_mtimes if update else {}
+        # the known subdirectories of each known directory
+        subdirs_of = {}
+        for key in known:
+            if key != ".":
+                subdirs_of.setdefault(os.path.dirname(key) or ".", []).append(key)
+
+        def scan_dir(path):
+            mtime = os.stat(path).st_mtime_ns
+            if known.get(dir_key(path)) == mtime:
+                # unchanged, the rows of its files are already there
+                subdirs = [
+                    os.path.join(root_scan_dir, key)
+                    for key in subdirs_of.get(dir_key(path), [])
+                ]
+                return mtime, None, subdirs
+            return (mtime, *_list_dir(path))
+
+        with ExitStack() as stack:
+            mapper = map
+            if n_threads is not None:
+                mapper = stack.enter_context(ThreadPoolExecutor(n_threads)).map
+
+            # breadth-first walk, one level of directories at a time
+            dir_mtimes = {}
+            changed = set()
+            frontier = abs_scan_dirs
+            while frontier:
+                next_frontier = []
+                for path, (mtime, files, subdirs) in zip(
+                    frontier, mapper(scan_dir, frontier)
+                ):
+                    log.debug(f"scanning {path}")
+                    dir_mtimes[dir_key(path)] = mtime
+                    next_frontier += subdirs
+                    if files is None:
+                        continue
+
+                    changed.add(dir_key(path))
+                    n_files += len(files)
+                    for f in files:
+                        # in some cases, we need information from the path name
+                        if "/" in template:
+                            f_tmp = path.replace(root_scan_dir, "") + "/" + f
+                        else:
+                            f_tmp = f
+
+                        finfo = parse(template, f_tmp)
+                        if finfo is not None:
+                            finfo = finfo.named
+                            for tier in self.tiers:
+                                finfo[f"{tier}_file"] = self.file_format[tier].format(
+                                    **finfo
+                                )
+
+                            file_keys.append(finfo)
+                frontier = next_frontier
+
+        if update and len(self.df) > 0:
+            # drop the rows of the directories that changed or disappeared
+            row_dirs = self.df[f"{low_tier}_file"].map(
+                lambda f: dir_key(
+                    os.path.dirname(os.path.join(root_scan_dir, f.lstrip("/")))
+                )
+            )
+            scanned = [dir_key(d) for d in abs_scan_dirs]
+            gone = {
+                key
+                for key in set(known) - set(dir_mtimes)
+                if any(
+                    os.path.commonpath([key, root]) == root
+                    if root != "."
+                    else not key.startswith("..")
+                    for root in scanned
+                )
+            }
+            # in the directories that changed, keep the rows of the files that
+            # are still there, and only add the new files
+            listed = {finfo[f"{low_tier}_file"] for finfo in file_keys}
+            low_files = self.df[f"{low_tier}_file"]
+            self.df = self.df[
+                ~row_dirs.isin(gone) & (~row_dirs.isin(changed) | low_files.isin(listed))
+            ]
+            known_files = set(self.df[f"{low_tier}_file"])
+            file_keys = [
+                finfo
+                for finfo in file_keys
+                if finfo[f"{low_tier}_file"] not in known_files
+            ]
+            for key in gone:
+                self.dir_mtimes.pop(key)
+            n_files += len(self.df)
 
         if n_files == 0:
             raise FileNotFoundError(f"no {low_tier} files found")
 
-        if len(file_keys) == 0:
+        if len(file_keys) == 0 and not update:
             raise FileNotFoundError(f"no {low_tier} files matched pattern " + template)
 
-        temp_df = pd.DataFrame(file_keys)
+        self.dir_mtimes.update(dir_mtimes)
 
         # fill the main DataFrame
-        self.df = pd.concat([self.df, temp_df])
+        if len(file_keys) > 0:
+            temp_df = pd.DataFrame(file_keys)
+            self.df = pd.concat([self.df, temp_df])
 
         # convert cols to numeric dtypes where possible
         for col in self.df.columns:
             try:
                 self.df[col] = pd.to_numeric(self.df[col])
-            except ValueError:
+            except (ValueError, TypeError):
                 continue
 
         # sort rows according to timestamps
         utils.inplace_sort(self.df, self.sortby)
 
         # set file status and sizes
-        self.set_file_status()
-        self.set_file_sizes()
+        self._set_status_and_sizes(self._tier_file_sizes(n_threads))
 
-    def set_file_status(self) -> None:
+    def set_file_status(self, n_threads: int = None) -> None:
         """Add a column with a bit corresponding to whether each tier's file exists.
 
         For example, if we have tiers `raw`, `dsp`, and `hit`, but only the
         `raw` file has been produced, ``file_status`` would be 4 (``0b100`` in
         binary representation).
+
+        The directories of the files are listed once each, with `n_threads`
+        threads if not ``None``.
         """
+        self._set_status_and_sizes(self._tier_file_sizes(n_threads), sizes=False)
 
-        def check_status(row):
-            status = 0
-            for i, tier in enumerate(self.tiers):
-                path_name = os.path.join(
+    def set_file_sizes(self, n_threads: int = None) -> None:
+        """Add columns for each tier containing the corresponding file size in bytes.
+
+        As reported by :func:`os.stat`, 0 if the file does not exist. The
+        directories of the files are listed once each, with `n_threads`
+        threads if not ``None``.
+        """
+        self._set_status_and_sizes(self._tier_file_sizes(n_threads), status=False)
+
+    def _tier_file_sizes(self, n_threads: int = None) -> dict[str, np.ndarray]:
+        # size of the file of each row in each tier, -1 if it does not exist
+        paths = {
+            tier: [
+                os.path.join(
                     self.data_dir,
                     self.tier_dirs[tier].lstrip("/"),
-                    row[f"{tier}_file"].lstrip("/"),
+                    f.lstrip("/"),
                 )
-                if os.path.exists(path_name):
-                    status |= 1 << len(self.tiers) - i - 1
-
-            return status
-
-        self.df["file_status"] = self.df.apply(check_status, axis=1)
-
-    def set_file_sizes(self) -> None:
-        """Add columns for each tier containing the corresponding file size in bytes.
+                for f in self.df[f"{tier}_file"]
+            ]
+            for tier in self.tiers
+        }
+        dirs = list(
+            {os.path.dirname(p) for tier_paths in paths.values() for p in tier_paths}
+        )
 
-        As reported by :func:`os.path.getsize`.
-        """
+        def files_in(path):
+            try:
+                return _list_dir(path)[0]
+            except FileNotFoundError:
+                return {}
 
-        def get_size(row, tier):
-            size = 0
-            path_name = os.path.join(
-                self.data_dir,
-                self.tier_dirs[tier].lstrip("/"),
-                row[f"{tier}_file"].lstrip("/"),
+        if n_threads is None:
+            listings = dict(zip(dirs, map(files_in, dirs)))
+        else:
+            with ThreadPoolExecutor(n_threads) as executor:
+                listings = dict(zip(dirs, executor.map(files_in, dirs)))
+
+        return {
+            tier: np.array(
+                [
+                    listings[os.path.dirname(p)].get(os.path.basename(p), -1)
+                    for p in tier_paths
+                ],
+                dtype=np.int64,
             )
-            if os.path.exists(path_name):
-                size = os.path.getsize(path_name)
-            return size
+            for tier, tier_paths in paths.items()
+        }
 
-        for tier in self.tiers:
-            self.df[f"{tier}_size"] = self.df.apply(get_size, axis=1, tier=tier)
+    def _set_status_and_sizes(
+        self, tier_sizes: dict[str, np.ndarray], status: bool = True, sizes: bool = True
+    ) -> None:
+        # fill the file_status and {tier}_size columns from _tier_file_sizes()
+        if status:
+            file_status = np.zeros(len(self.df), dtype=np.int64)
+            for i, tier in enumerate(self.tiers):
+                file_status[tier_sizes[tier] >= 0] |= 1 << len(self.tiers) - i - 1
+            self.df["file_status"] = file_status
+
+        if sizes:
+            for tier in self.tiers:
+                self.df[f"{tier}_size"] = np.maximum(tier_sizes[tier], 0)
 
     def scan_tables_columns(
         self,
         to_file: str = None,
         override: bool = False,
         dir_files_conform: bool = False,
+        missing_only: bool = False,
     ) -> list[str]:
         """Open files to read (and store) available tables (and columns therein) names.
 
@@ -358,10 +486,14 @@ class FileDB:
             with the same columns (i.e. all file contents conform to the same
             format) and scan only the first file. Significantly reduces
             processing time.
+        missing_only
+            only open the files of the rows that have no tables yet, e.g. the
+            ones added by :meth:`.scan_files` with ``update=True``, and keep
+            the tables and columns of the other rows.
         """
         log.info("getting table column names")
 
-        if self.columns is not None:
+        if self.columns is not None and not missing_only:
             if not override:
                 log.warning(
                     "LH5 tables/columns names already set, if you want to perform the scan anyway, set override=True"
@@ -452,6 +584,8 @@ class FileDB:
             return series
 
         columns = []
+        if missing_only and self.columns is not None:
+            columns = list(self.columns)
 
         # set up a cache to provide a fast option if all files in each directory
         # are expected to all have the same cols
@@ -460,9 +594,23 @@ class FileDB:
             utc_cache = {}
 
         for tier in self.tiers:
-            self.df[[f"{tier}_tables", f"{tier}_col_idx"]] = self.df.apply(
+            tier_cols = [f"{tier}_tables", f"{tier}_col_idx"]
+            if not missing_only or tier_cols[0] not in self.df:
+                self.df[tier_cols] = self.df.apply(
+                    update_tables_cols, axis=1, tier=tier, utc_cache=utc_cache
+                )
+                continue
+
+            todo = self.df[tier_cols[0]].isna().to_numpy()
+            if not todo.any():
+                continue
+            scanned = self.df[todo].apply(
                 update_tables_cols, axis=1, tier=tier, utc_cache=utc_cache
             )
+            for col in tier_cols:
+                values = self.df[col].to_numpy(dtype=object, copy=True)
+                values[todo] = scanned[col].to_numpy(dtype=object)
+                self.df[col] = values
 
         self.columns = columns
 
@@ -512,6 +660,7 @@ class FileDB:
         _cfg = None
         _df = None
         _columns = None
+        _dir_mtimes = {}
 
         # function needed later in the loop
         def _replace_idx(row, trans, tier):
@@ -545,6 +694,12 @@ class FileDB:
             # Convert back from VoV of UTF-8 bytestrings to a list of lists of strings
             columns = [[v.decode("utf-8") for v in ov] for ov in list(vov)]
 
+            # read in directory modification times, if saved
+            if "dir_mtimes" in ls(p):
+                _dir_mtimes.update(
+                    json.loads(lh5.read("dir_mtimes", p).value.decode())
+                )
+
             # read in dataframe
             df = pd.read_hdf(p, key="dataframe")
 
@@ -589,6 +744,7 @@ class FileDB:
         self.set_config(_cfg)
         self.df = _df
         self.columns = _columns
+        self.dir_mtimes = _dir_mtimes
 
         utils.inplace_sort(self.df, self.sortby)
 
@@ -623,6 +779,14 @@ class FileDB:
             )
             lh5.write(col_vov, "columns", filename, wo_mode=wo_mode)
 
+        if self.dir_mtimes:
+            lh5.write(
+                Scalar(json.dumps(self.dir_mtimes)),
+                "dir_mtimes",
+                filename,
+                wo_mode=wo_mode,
+            )
+
         # FIXME: to_hdf() throws this:
         #
         #     pandas.errors.PerformanceWarning: your performance may suffer as
@@ -733,3 +897,20 @@ class FileDB:
             string += "columns=None"
 
         return string + ")"
+
+
+def _list_dir(path: str) -> tuple[dict[str, int], list[str]]:
+    """List a directory with :func:`os.scandir`.
+
+    Returns the size of each file in `path`, by name, and the paths of its
+    subdirectories.
+    """
+    files = {}
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.is_file():
+                files[entry.name] = entry.stat().st_size
+    return files, subdirs
@@ -2,8 +2,12 @@ from __future__ import annotations
 
 import logging
 import re
+from collections.abc import Iterator
 from datetime import datetime, timezone
 
+import awkward as ak
+import h5py
+import lh5
 import numpy as np
 import pandas as pd
 from lgdo import Array, ArrayOfEqualSizedArrays, Table, VectorOfVectors, WaveformTable
@@ -41,9 +45,175 @@ def inplace_sort(df: pd.DataFrame, by: str) -> None:
         df.sort_values(by, ignore_index=True, inplace=True)
 
 
+def explode_tcm(tcm: Table, child_idx: str, renaming: dict) -> dict:
+    """Flatten a TCM table into one entry per hit.
+
+    Returns a dictionary of arrays, with the index of the event of each hit in
+    `child_idx`, followed by the columns of `tcm`: the data of the
+    :class:`~lgdo.types.vectorofvectors.VectorOfVectors`, and the values of
+    the other columns repeated for each hit of their event. Columns are
+    renamed according to `renaming`. Events without hits have no entry.
+    """
+    cols = {}
+    counts = None
+    for name, col in tcm.items():
+        if isinstance(col, VectorOfVectors):
+            cumulative_length = col.cumulative_length.nda
+            counts = np.diff(cumulative_length, prepend=0)
+            cols[renaming.get(name, name)] = col.flattened_data.nda[
+                : cumulative_length[-1] if len(cumulative_length) > 0 else 0
+            ]
+
+    if counts is None:
+        raise ValueError("TCM table has no vector columns")
+
+    out = {child_idx: np.repeat(np.arange(len(counts)), counts)}
+    for name, col in tcm.items():
+        name = renaming.get(name, name)
+        if name in cols:
+            out[name] = cols[name]
+        elif isinstance(col, Array):
+            out[name] = np.repeat(col.nda, counts)
+    return out
+
+
+def read_entries(
+    name: str,
+    lh5_file: str,
+    rows: np.ndarray,
+    field_mask: list[str] = None,
+    buffer_len: int = 3200,
+) -> Iterator[tuple[np.ndarray, Table]]:
+    """Read the given rows of an LH5 table in chunks.
+
+    The rows are read in increasing order, at most `buffer_len` at a time,
+    as ranges of consecutive rows, so that only one chunk of the table is
+    in memory at once.
+
+    Yields
+    ------
+    (positions, table)
+        the rows of `table` are the rows ``rows[positions]`` of the table
+        on disk.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.argsort(rows, kind="stable")
+    sorted_rows = rows[order]
+    if np.any(np.diff(sorted_rows) == 0):
+        raise ValueError(f"rows of {name} in {lh5_file} are not unique")
+
+    with h5py.File(lh5_file, "r") as f:
+        for start in range(0, len(rows), buffer_len):
+            chunk = sorted_rows[start : start + buffer_len]
+            # ranges of consecutive rows in the chunk
+            breaks = np.flatnonzero(np.diff(chunk) != 1) + 1
+            ranges = np.stack(
+                (chunk[np.r_[0, breaks]], chunk[np.r_[breaks - 1, len(chunk) - 1]] + 1),
+                axis=1,
+            )
+            table = lh5.read(name, f, idx=ranges, field_mask=field_mask)
+            yield order[start : start + buffer_len], table
+
+
+def group_rows(obj: Table | Array, cumulative_length: np.ndarray):
+    """Group consecutive rows of `obj` into vectors.
+
+    Returns a :class:`~lgdo.types.vectorofvectors.VectorOfVectors` whose
+    vector ``i`` holds the rows of `obj` up to ``cumulative_length[i]``.
+    Tables are returned as tables of grouped columns.
+    """
+    if isinstance(obj, Table):
+        return Table(
+            col_dict={k: group_rows(v, cumulative_length) for k, v in obj.items()}
+        )
+    return VectorOfVectors(
+        flattened_data=obj,
+        cumulative_length=Array(np.asarray(cumulative_length, dtype=np.uint32)),
+    )
+
+
+class _VectorColumn:
+    """A :class:`~lgdo.types.vectorofvectors.VectorOfVectors` column filled
+    in parts by :func:`fill_col_dict`.
+
+    Each part gives the vectors of some of the rows of the column. They are
+    scattered into a single flattened data array when the column is built,
+    instead of going through a list of lists. Rows without a part are empty.
+    """
+
+    def __init__(self, table_length: int) -> None:
+        self.table_length = table_length
+        self.parts = []
+
+    def add(self, rows, vectors: VectorOfVectors | np.ndarray) -> None:
+        """Set the vectors of `rows`, from a vector of vectors or a 2D array."""
+        self.parts.append((np.asarray(rows, dtype=np.int64), vectors))
+
+    def to_lgdo(self, attrs: dict = None) -> VectorOfVectors:
+        # the parts may be arrays of equal-sized arrays
+        if attrs is not None:
+            attrs = {k: v for k, v in attrs.items() if k != "datatype"}
+
+        # nested vectors of vectors are assembled by awkward
+        if any(
+            isinstance(v, VectorOfVectors)
+            and isinstance(v.flattened_data, VectorOfVectors)
+            for _, v in self.parts
+        ):
+            return self._to_lgdo_ak(attrs)
+
+        lengths = np.zeros(self.table_length, dtype=np.uint32)
+        contents = []
+        for rows, vectors in self.parts:
+            if isinstance(vectors, VectorOfVectors):
+                cl = vectors.cumulative_length.nda
+                part_lengths = np.diff(cl, prepend=0)
+                content = vectors.flattened_data.nda[: cl[-1] if len(cl) > 0 else 0]
+            else:
+                part_lengths = np.full(len(vectors), vectors.shape[1])
+                content = vectors.reshape(-1)
+            lengths[rows] = part_lengths
+            contents.append((rows, part_lengths, content))
+
+        cumulative_length = np.cumsum(lengths, dtype=np.uint32)
+        dtype = np.result_type(*(c.dtype for _, _, c in contents))
+        flattened_data = np.empty(
+            cumulative_length[-1] if self.table_length > 0 else 0, dtype=dtype
+        )
+        for rows, part_lengths, content in contents:
+            # position in flattened_data of each element of the part
+            starts = cumulative_length[rows] - part_lengths
+            part_starts = np.cumsum(part_lengths) - part_lengths
+            dest = np.repeat(starts.astype(np.int64) - part_starts, part_lengths)
+            flattened_data[dest + np.arange(len(content))] = content
+
+        return VectorOfVectors(
+            flattened_data=Array(flattened_data),
+            cumulative_length=Array(cumulative_length),
+            attrs=attrs,
+        )
+
+    def _to_lgdo_ak(self, attrs: dict = None) -> VectorOfVectors:
+        parts = [ak.Array([[]])]
+        index = np.zeros(self.table_length, dtype=np.int64)
+        offset = 1
+        for rows, vectors in self.parts:
+            part = (
+                vectors.view_as("ak")
+                if isinstance(vectors, VectorOfVectors)
+                else ak.Array(vectors)
+            )
+            index[rows] = offset + np.arange(len(part))
+            offset += len(part)
+            parts.append(part)
+        return VectorOfVectors(ak.concatenate(parts)[index], attrs=attrs)
+
+
 def dict_to_table(col_dict: dict, attr_dict: dict):
     for col in col_dict.keys():
-        if isinstance(col_dict[col], list):
+        if isinstance(col_dict[col], _VectorColumn):
+            col_dict[col] = col_dict[col].to_lgdo(attrs=attr_dict[col])
+        elif isinstance(col_dict[col], list):
             if isinstance(col_dict[col][0], (list, np.ndarray, Array)):
                 # Convert to VectorOfVectors if there is array-like in a list
                 col_dict[col] = VectorOfVectors(
@@ -112,9 +282,8 @@ def fill_col_dict(
             # Allocate memory for column for all channels
             if aoesa_to_vov:  # convert to VectorOfVectors
                 if col not in col_dict.keys():
-                    col_dict[col] = [[]] * table_length
-                for i, idx in enumerate(tcm_idx):
-                    col_dict[col][idx] = tier_table[col].nda[i]
+                    col_dict[col] = _VectorColumn(table_length)
+                col_dict[col].add(tcm_idx, tier_table[col].nda)
             else:  # Try to make AoESA, raise error otherwise
                 if col not in col_dict.keys():
                     col_dict[col] = np.empty(
@@ -125,9 +294,8 @@ def fill_col_dict(
         elif isinstance(tier_table[col], VectorOfVectors):
             # Allocate memory for column for all channels
             if col not in col_dict.keys():
-                col_dict[col] = [[]] * table_length
-            for i, idx in enumerate(tcm_idx):
-                col_dict[col][idx] = tier_table[col][i]
+                col_dict[col] = _VectorColumn(table_length)
+            col_dict[col].add(tcm_idx, tier_table[col])
         elif isinstance(tier_table[col], Array):
             # Allocate memory for column for all channels
             if col not in col_dict.keys():
@@ -5,7 +5,7 @@ to produce the hit-tier from the dsp-tier.
 
 from __future__ import annotations
 
-from pygama.hit.aggregations import unpack_bitmask
-from pygama.hit.build_hit import build_hit
+from pygama.hit.aggregations import pack_bitmask, unpack_bitmask
+from pygama.hit.build_hit import build_hit, build_hit_batch
 
-__all__ = ["build_hit", "unpack_bitmask"]
+__all__ = ["build_hit", "build_hit_batch", "pack_bitmask", "unpack_bitmask"]
@@ -5,17 +5,79 @@ Utilities for working with bit-aggregation columns produced by
 
 from __future__ import annotations
 
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable, Sequence
 
 import awkward as ak
 import lgdo
+import numba as nb
 import numpy as np
 from numpy.typing import ArrayLike
 
 
+def pack_bitmask(
+    flags: Sequence[lgdo.LGDO | ArrayLike],
+    bit_names: Iterable[str] | None = None,
+) -> lgdo.Array | lgdo.VectorOfVectors:
+    """Pack boolean columns into a bit-aggregation column.
+
+    Bit ``i`` of the result is set where ``flags[i]`` is non-zero. The result
+    has the smallest unsigned integer type that holds all the bits, and the
+    ``bit_names`` attribute read by :func:`unpack_bitmask`.
+
+    Parameters
+    ----------
+    flags
+        the columns to pack, all with the same shape. Flat (e.g.
+        :class:`lgdo.Array`, NumPy arrays) or jagged (e.g.
+        :class:`lgdo.VectorOfVectors`, awkward arrays) columns give an
+        :class:`lgdo.Array` or an :class:`lgdo.VectorOfVectors` respectively.
+    bit_names
+        ordered names for each bit, stored as a comma-separated string.
+    """
+    flags = [_values(f) for f in flags]
+    if len(flags) == 0 or len(flags) > 64:
+        msg = f"can only pack between 1 and 64 flags, got {len(flags)}"
+        raise ValueError(msg)
+
+    if bit_names is not None:
+        bit_names = list(bit_names)
+        if len(bit_names) != len(flags):
+            msg = f"got {len(bit_names)} bit names for {len(flags)} flags"
+            raise ValueError(msg)
+
+    contents = [_flat_content(f) for f in flags]
+    if any(len(c) != len(contents[0]) for c in contents):
+        msg = "all flags must have the same shape"
+        raise ValueError(msg)
+
+    dtype = bitmask_dtype(len(flags))
+    packed = np.zeros(len(contents[0]), dtype=dtype)
+    for bit, content in enumerate(contents):
+        _pack_bit(content, dtype.type(1 << bit), packed)
+
+    if isinstance(flags[0], np.ndarray):
+        out = lgdo.Array(packed)
+    else:
+        out = lgdo.VectorOfVectors(_map_content(flags[0], lambda _: packed))
+
+    if bit_names is not None:
+        out.attrs["bit_names"] = ",".join(bit_names)
+    return out
+
+
+def bitmask_dtype(n_bits: int) -> np.dtype:
+    """The smallest unsigned integer type with at least `n_bits` bits."""
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if n_bits <= 8 * np.dtype(dtype).itemsize:
+            return np.dtype(dtype)
+    msg = f"cannot hold {n_bits} bits in an integer type"
+    raise ValueError(msg)
+
+
 def unpack_bitmask(
     aggregation: lgdo.LGDO | ArrayLike,
     bit_names: Iterable[str] | None = None,
+    fields: Iterable[str] | None = None,
 ) -> ak.Array:
     """Unpack a bit-aggregation column into an awkward record array.
 
@@ -38,9 +100,12 @@ def unpack_bitmask(
         ordered names for each bit. If ``None`` and `aggregation` is an
         :class:`lgdo.LGDO`, names are read from its ``bit_names`` attribute
         (a comma-separated string).
+    fields
+        names of the bits to unpack. If ``None``, unpack all of them. The
+        other bits are not computed.
     """
     if isinstance(aggregation, lgdo.LGDO):
-        values = aggregation.view_as("ak")
+        values = _values(aggregation)
         if bit_names is None:
             attr = aggregation.attrs.get("bit_names")
             if attr is None:
@@ -54,12 +119,75 @@ def unpack_bitmask(
         if bit_names is None:
             msg = "bit_names must be provided when aggregation is not an LGDO"
             raise ValueError(msg)
-        values = (
-            aggregation
-            if isinstance(aggregation, ak.Array)
-            else np.asarray(aggregation)
-        )
+        values = _values(aggregation)
 
     names = list(bit_names)
-    fields = {name: ((values >> i) & 1) == 1 for i, name in enumerate(names)}
-    return ak.zip(fields)
+    if fields is None:
+        fields = names
+    else:
+        fields = list(fields)
+        if unknown := [f for f in fields if f not in names]:
+            msg = f"no bits named {unknown} in {names}"
+            raise ValueError(msg)
+
+    return ak.zip(
+        {name: _map_content(values, _bit_getter(names.index(name))) for name in fields}
+    )
+
+
+def _bit_getter(bit: int) -> Callable[[np.ndarray], np.ndarray]:
+    # a function that returns bit `bit` of integers, as booleans
+    def get_bit(values):
+        out = np.empty(len(values), dtype=bool)
+        _unpack_bit(values, values.dtype.type(bit), out)
+        return out
+
+    return get_bit
+
+
+def _values(obj: lgdo.LGDO | ArrayLike) -> np.ndarray | ak.Array:
+    # a NumPy array for flat columns, an awkward array for jagged ones
+    if isinstance(obj, lgdo.Array):
+        return obj.nda
+    if isinstance(obj, lgdo.LGDO):
+        obj = obj.view_as("ak")
+    if isinstance(obj, ak.Array):
+        return ak.to_numpy(obj) if obj.ndim == 1 else obj
+    return np.asarray(obj)
+
+
+def _flat_content(values: np.ndarray | ak.Array) -> np.ndarray:
+    # all the values of `values`, with the structure of jagged arrays removed
+    if isinstance(values, np.ndarray):
+        return values.reshape(-1)
+    return ak.to_numpy(ak.flatten(values, axis=None))
+
+
+def _map_content(
+    values: np.ndarray | ak.Array, fun: Callable[[np.ndarray], np.ndarray]
+) -> np.ndarray | ak.Array:
+    # applies `fun` to the flat content of `values`, keeping its structure
+    if isinstance(values, np.ndarray):
+        return fun(values)
+
+    def action(layout, **_):
+        if isinstance(layout, ak.contents.NumpyArray):
+            return ak.contents.NumpyArray(fun(np.asarray(layout.data)))
+        return None
+
+    return ak.transform(action, values)
+
+
+@nb.njit(cache=True)
+def _pack_bit(flag: np.ndarray, mask, out: np.ndarray) -> None:
+    """Set the bits `mask` of `out` where `flag` is non-zero."""
+    for i in range(len(out)):
+        if flag[i]:
+            out[i] |= mask
+
+
+@nb.njit(cache=True)
+def _unpack_bit(values: np.ndarray, bit, out: np.ndarray) -> None:
+    """Whether bit number `bit` of `values` is set."""
+    for i in range(len(out)):
+        out[i] = (values[i] >> bit) & 1 == 1
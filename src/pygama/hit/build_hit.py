@@ -4,17 +4,26 @@ This module implements routines to evaluate expressions to columnar data.
 
 from __future__ import annotations
 
+import copy
 import logging
+import tempfile
 from collections import OrderedDict
 from collections.abc import Iterable, Mapping
+from concurrent.futures import Executor
+from contextlib import ExitStack
 from pathlib import Path
 
+import h5py
 import lgdo
 import lh5
 import numpy as np
 from lh5 import LH5Iterator, ls
+from numexpr import NumExpr
+from numexpr.necompiler import getContext, getExprNames, getType
 
 from .. import utils
+from ..datatools.utils import _setup_executor
+from .aggregations import pack_bitmask
 
 log = logging.getLogger(__name__)
 
@@ -28,6 +37,8 @@ def build_hit(
     n_max: int = np.inf,  # noqa: ARG001
     wo_mode: str = "write_safe",
     buffer_len: int = 3200,
+    processes: int | None = None,
+    executor: Executor | None = None,
 ) -> None:
     """
     Transform a :class:`~lgdo.types.table.Table` into a new
@@ -63,7 +74,8 @@ def build_hit(
 
         The ``outputs`` array lists columns that will be effectively written in
         the output LH5 file. Add here columns that will be simply forwarded as
-        they are from the DSP tier.
+        they are from the DSP tier. Operations that no output depends on are
+        skipped, and only the DSP columns the outputs need are read.
 
     lh5_tables
         tables to consider in the input file. if ``None``, tables with name
@@ -77,12 +89,121 @@ def build_hit(
         maximum number of rows to process
     wo_mode
         forwarded to :func:`lh5.io.core.write`.
+    buffer_len
+        number of rows to process at once.
+    processes
+        number of processes. If ``None``, use number equal to threads available
+        to `executor` (if provided), or else do not parallelize. In parallel,
+        each table is processed by a worker into a temporary file, and copied
+        into `outfile` by the calling process.
+    executor
+        :class:`concurrent.futures.Executor` object for managing parallelism.
+        If ``None``, create a :class:`concurrent.futures.ProcessPoolExecutor`
+        with number of processes equal to `processes`.
 
     See Also
     --------
     lgdo.types.table.Table.eval
+    build_hit_batch
     """
+    lh5_tables_config = _resolve_tables_config(
+        infile, hit_config, lh5_tables, lh5_tables_config
+    )
 
+    if outfile is None:
+        outfile = _default_outfile(infile)
+
+    with ExitStack() as stack:
+        processes, executor = _setup_executor(stack, processes, executor)
+
+        if executor is None:
+            # tables that share a configuration share its compiled operations
+            pipelines = {}
+            for i, (tbl, cfg) in enumerate(lh5_tables_config.items()):
+                if id(cfg) not in pipelines:
+                    pipelines[id(cfg)] = _HitPipeline(cfg["operations"])
+                _build_hit_table(
+                    infile,
+                    tbl,
+                    cfg,
+                    outfile,
+                    _table_wo_mode(wo_mode, i),
+                    buffer_len,
+                    pipelines[id(cfg)],
+                )
+        else:
+            _build_hit_parallel(
+                [(infile, outfile, lh5_tables_config)], wo_mode, buffer_len, executor
+            )
+
+
+def build_hit_batch(
+    jobs: Iterable[tuple[str, str | None]],
+    processes: int | None = None,
+    executor: Executor | None = None,
+    **kwargs,
+) -> None:
+    """Run :func:`build_hit` on many files, in parallel over all their tables.
+
+    Typically used to reprocess the hit tier of a whole run or period. The
+    tables of all the files are processed concurrently, each by a worker that
+    writes it to a temporary file next to its output file. The calling
+    process then copies them into the output files in order, without
+    decompressing them, since HDF5 files cannot be written in parallel.
+
+    Parameters
+    ----------
+    jobs
+        each entry is ``(infile, outfile)``, see :func:`build_hit`.
+    processes
+        number of processes. If ``None``, use number equal to threads available
+        to `executor` (if provided), or else do not parallelize.
+    executor
+        :class:`concurrent.futures.Executor` object for managing parallelism.
+        If ``None``, create a :class:`concurrent.futures.ProcessPoolExecutor`
+        with number of processes equal to `processes`.
+    kwargs
+        forwarded to :func:`build_hit`, for every job.
+    """
+    jobs = list(jobs)
+
+    with ExitStack() as stack:
+        processes, executor = _setup_executor(stack, processes, executor)
+
+        if executor is None:
+            for infile, outfile in jobs:
+                build_hit(infile, outfile, **kwargs)
+            return
+
+        files = [
+            (
+                infile,
+                outfile if outfile is not None else _default_outfile(infile),
+                _resolve_tables_config(
+                    infile,
+                    kwargs.get("hit_config"),
+                    kwargs.get("lh5_tables"),
+                    kwargs.get("lh5_tables_config"),
+                ),
+            )
+            for infile, outfile in jobs
+        ]
+        _build_hit_parallel(
+            files,
+            kwargs.get("wo_mode", "write_safe"),
+            kwargs.get("buffer_len", 3200),
+            executor,
+        )
+
+
+def _default_outfile(infile: str) -> str:
+    return Path(infile).stem.removesuffix("_dsp") + "_hit.lh5"
+
+
+def _resolve_tables_config(
+    infile, hit_config, lh5_tables, lh5_tables_config
+) -> dict[str, Mapping]:
+    """Map the tables of `infile` to process to their configuration."""
     if lh5_tables_config is None and hit_config is None:
         msg = "either lh5_tables_config or hit_config must be specified"
         raise ValueError(msg)
@@ -124,24 +245,79 @@ def build_hit(
             for tbl in lh5_tables:
                 lh5_tables_config[tbl] = hit_config
 
-    if outfile is None:
-        outfile = Path(infile).stem
-        outfile = outfile.removesuffix("_dsp") + "_hit.lh5"
-
-    # reorder blocks in "operations" based on dependency
+    # reorder blocks in "operations" based on dependency, and drop the ones
+    # that no output needs. Work on a copy, not to modify the caller's config
     log.debug("reordering operations based on mutual dependency")
+    lh5_tables_config = copy.deepcopy(lh5_tables_config)
     for cfg in lh5_tables_config.values():
         cfg["operations"] = _reorder_table_operations(cfg["operations"])
+        cfg["operations"], _ = _required_operations(cfg)
+
+    return lh5_tables_config
+
+
+def _required_operations(cfg: Mapping) -> tuple[dict, list[str] | None]:
+    """The operations of `cfg` needed for its ``outputs``, and their inputs.
+
+    The inputs are all the other names the outputs, operations and
+    aggregations refer to, which may be columns of the input table or
+    functions and modules known to :meth:`lgdo.Table.eval`. They are ``None``
+    if `cfg` has no list of ``outputs``, in which case all the operations are
+    needed.
+    """
+    operations = dict(cfg["operations"])
+    if not isinstance(cfg.get("outputs"), list):
+        return operations, None
+
+    aggregations = cfg.get("aggregations", {})
+    wanted = list(cfg["outputs"])
+    for flags in aggregations.values():
+        wanted += list(flags.values())
+    wanted = list(dict.fromkeys(p for p in wanted if p not in aggregations))
+
+    operations, inkeys = _remove_uneeded_operations(
+        operations, [p for p in wanted if p in operations]
+    )
+    inkeys += [p for p in wanted if p not in operations and p not in inkeys]
+    return operations, inkeys
+
 
+def _field_mask(infile: str, tbl: str, cfg: Mapping) -> list[str] | None:
+    """The columns of `tbl` to read for `cfg`, or ``None`` for all of them."""
+    _, inkeys = _required_operations(cfg)
+    if inkeys is None:
+        return None
+
+    columns = [name.rsplit("/", 1)[-1] for name in ls(infile, f"{tbl}/")]
+    field_mask = [name for name in columns if name in inkeys]
+    # a table must have at least one column to know its length
+    return field_mask or None
+
+
+def _table_wo_mode(wo_mode: str, i_table: int) -> str:
+    """Write mode for the first chunk of the `i_table`-th table of a file."""
+    if wo_mode in ("overwrite", "o"):
+        return "o"
+    # the first table sets up the file, the others are added to it
+    return wo_mode if i_table == 0 else "append"
+
+
+def _build_hit_table(
+    infile, tbl, cfg, outfile, wo_mode, buffer_len, pipeline=None
+) -> None:
+    """Process the table `tbl` of `infile` into `outfile`, chunk by chunk."""
+    if pipeline is None:
+        pipeline = _HitPipeline(cfg["operations"])
+
+    field_mask = _field_mask(infile, tbl, cfg)
+    log.debug("reading columns %s of table '%s'", field_mask, tbl)
+    lh5_it = LH5Iterator(infile, tbl, field_mask=field_mask, buffer_len=buffer_len)
+    write_offset = 0
     wo_current = wo_mode
-    for tbl, cfg in lh5_tables_config.items():
-        lh5_it = LH5Iterator(infile, tbl, buffer_len=buffer_len)
-        write_offset = 0
 
-        log.info("Processing table '%s' in file %s", tbl, infile)
-        if wo_mode in ("overwrite", "o"):
-            wo_current = "o"
+    log.info("Processing table '%s' in file %s", tbl, infile)
 
+    with utils._AsyncWriter() as writer:
         for tbl_obj in lh5_it:
             start_row = lh5_it.current_i_entry
 
@@ -149,41 +325,15 @@ def build_hit(
             # current table (i.e. no copy)
             outtbl_obj = lgdo.Table(col_dict=tbl_obj)
 
-            for outname, info in cfg["operations"].items():
-                outcol = outtbl_obj.eval(
-                    info["expression"], info.get("parameters", None)
-                )
-                if "lgdo_attrs" in info:
-                    outcol.attrs |= info["lgdo_attrs"]
-
-                if "description" in info:
-                    outcol.attrs["description"] = info["description"]
-
-                log.debug("made new column %r=%r", outname, outcol)
-                outtbl_obj.add_column(outname, outcol)
+            pipeline(outtbl_obj)
 
             # make high level flags
             if "aggregations" in cfg:
                 for high_lvl_flag, flags in cfg["aggregations"].items():
                     flags_list = list(flags.values())
-                    n_flags = len(flags_list)
-                    if n_flags <= 8:
-                        flag_dtype = np.uint8
-                    elif n_flags <= 16:
-                        flag_dtype = np.uint16
-                    elif n_flags <= 32:
-                        flag_dtype = np.uint32
-                    else:
-                        flag_dtype = np.uint64
-
-                    df_flags = outtbl_obj.view_as("pd", cols=flags_list)
-                    flag_values = df_flags.values.astype(flag_dtype)
-
-                    multiplier = 2 ** np.arange(n_flags, dtype=flag_values.dtype)
-                    flag_out = np.dot(flag_values, multiplier)
-
-                    aggr_col = lgdo.Array(flag_out)
-                    aggr_col.attrs["bit_names"] = ",".join(flags_list)
+                    aggr_col = pack_bitmask(
+                        [outtbl_obj[flag] for flag in flags_list], bit_names=flags_list
+                    )
                     outtbl_obj.add_field(high_lvl_flag, aggr_col)
 
             # remove or add columns according to "outputs" in the configuration
@@ -200,8 +350,12 @@ def build_hit(
                     if col not in cfg["outputs"]:
                         outtbl_obj.remove_column(col, delete=True)
 
-            lh5.write(
-                obj=outtbl_obj,
+            # the columns are written in the background while the next chunk is
+            # processed, into the same buffers as this one (the iterator's and
+            # the pipeline's): hand a copy of those to the writer
+            reused = [*_lgdo_buffers(tbl_obj), *pipeline.buffers()]
+            writer.write(
+                obj=_detach(outtbl_obj, reused),
                 name=tbl.replace("/dsp", "/hit"),
                 lh5_file=outfile,
                 n_rows=len(tbl_obj),
@@ -212,6 +366,229 @@ def build_hit(
             wo_current = "append"
 
 
+def _lgdo_buffers(obj: lgdo.LGDO) -> list[np.ndarray]:
+    """The NumPy arrays holding the data of `obj`."""
+    if isinstance(obj, lgdo.Struct):
+        return [buf for col in obj.values() for buf in _lgdo_buffers(col)]
+    if isinstance(obj, lgdo.VectorOfVectors):
+        return [
+            *_lgdo_buffers(obj.flattened_data),
+            *_lgdo_buffers(obj.cumulative_length),
+        ]
+    nda = getattr(obj, "nda", None)
+    return [] if nda is None else [nda]
+
+
+def _detach(tbl: lgdo.Table, reused: list[np.ndarray]) -> lgdo.Table:
+    """Shallow copy of `tbl`, with copies of the columns that may share memory
+    with the `reused` buffers."""
+    cols = {}
+    for name, col in tbl.items():
+        shared = any(
+            np.may_share_memory(buf, other)
+            for buf in _lgdo_buffers(col)
+            for other in reused
+        )
+        cols[name] = copy.deepcopy(col) if shared else col
+    return lgdo.Table(col_dict=cols, attrs=tbl.attrs)
+
+
+# what numexpr raises for expressions or types it does not support
+_NUMEXPR_ERRORS = (
+    SyntaxError,
+    TypeError,
+    ValueError,
+    KeyError,
+    AttributeError,
+    NotImplementedError,
+)
+
+
+class _HitPipeline:
+    """The ``operations`` of a hit configuration, compiled once.
+
+    Reused for all the chunks of all the tables that share a configuration.
+    Operations on flat columns run as numexpr kernels, compiled once per
+    combination of input types, which write into a buffer that is reused from
+    chunk to chunk: the columns they produce are only valid until the next
+    chunk. Anything else goes through :meth:`lgdo.Table.eval`.
+    """
+
+    def __init__(self, operations: Mapping[str, Mapping]):
+        self.operations = [
+            _HitOperation(name, info) for name, info in operations.items()
+        ]
+
+    def __call__(self, tbl: lgdo.Table) -> None:
+        """Evaluate all the operations on `tbl` and add the results to it."""
+        for op in self.operations:
+            outcol = op(tbl)
+            if "lgdo_attrs" in op.info:
+                outcol.attrs |= op.info["lgdo_attrs"]
+
+            if "description" in op.info:
+                outcol.attrs["description"] = op.info["description"]
+
+            log.debug("made new column %r=%r", op.name, outcol)
+            tbl.add_column(op.name, outcol)
+
+    def buffers(self) -> list[np.ndarray]:
+        """The buffers that the operations reuse from chunk to chunk."""
+        return [op._buffer for op in self.operations]
+
+
+class _HitOperation:
+    """One operation of a hit configuration, see :class:`_HitPipeline`."""
+
+    _context = getContext({})
+
+    def __init__(self, name: str, info: Mapping):
+        self.name = name
+        self.info = info
+        self.expression = info["expression"]
+        self.parameters = info.get("parameters", None)
+
+        try:
+            self.names, self.uses_vml = getExprNames(self.expression, self._context)
+        except _NUMEXPR_ERRORS:
+            # not numexpr syntax (e.g. awkward or NumPy calls)
+            self.names = None
+
+        self._kernels = {}
+        self._buffer = np.empty(0)
+
+    def __call__(self, tbl: lgdo.Table) -> lgdo.LGDO:
+        args = self._arguments(tbl) if self.names is not None else None
+        if args is not None:
+            res = self._run(args)
+            if res is not None:
+                return lgdo.Array(res)
+
+        return tbl.eval(self.expression, self.parameters)
+
+    def _arguments(self, tbl: lgdo.Table) -> list[np.ndarray] | None:
+        # the inputs of the kernel, or None if Table.eval() is needed.
+        # Parameters take precedence over columns, as in Table.eval()
+        parameters = self.parameters or {}
+        args = []
+        n_rows = None
+        for name in self.names:
+            if name in parameters:
+                value = parameters[name]
+                if not isinstance(value, bool | int | float | np.number):
+                    return None
+                args.append(np.asarray(value))
+                continue
+
+            col = tbl.get(name)
+            if not isinstance(col, lgdo.Array) or col.nda.ndim != 1:
+                return None
+            n_rows = len(col.nda)
+            args.append(col.nda)
+
+        return args if n_rows is not None else None
+
+    def _run(self, args: list[np.ndarray]) -> np.ndarray | None:
+        key = tuple((a.dtype, a.ndim) for a in args)
+        n_rows = max(len(a) for a in args if a.ndim == 1)
+
+        if key not in self._kernels:
+            # compile, and find out the result type with a first evaluation
+            try:
+                signature = [
+                    (n, getType(a)) for n, a in zip(self.names, args, strict=True)
+                ]
+                kernel = NumExpr(self.expression, signature, **self._context)
+                res = kernel(*args, ex_uses_vml=self.uses_vml)
+            except _NUMEXPR_ERRORS:
+                self._kernels[key] = None
+                return None
+
+            # e.g. reductions, which Table.eval() turns into scalars
+            if res.shape != (n_rows,):
+                self._kernels[key] = None
+                return None
+            self._kernels[key] = (kernel, res.dtype)
+            return res
+
+        if self._kernels[key] is None:
+            return None
+        kernel, dtype = self._kernels[key]
+
+        if len(self._buffer) < n_rows or self._buffer.dtype != dtype:
+            self._buffer = np.empty(n_rows, dtype=dtype)
+        return kernel(*args, out=self._buffer[:n_rows], ex_uses_vml=self.uses_vml)
+
+
+def _build_hit_parallel(files, wo_mode, buffer_len, executor) -> None:
+    # processes every table of `files`, a list of (infile, outfile,
+    # tables_config), on `executor` into a temporary file each, and copies
+    # them into the output files in order as they are done
+    with ExitStack() as stack:
+        pending = []
+        for infile, outfile, tables_config in files:
+            tmp_dir = stack.enter_context(
+                tempfile.TemporaryDirectory(
+                    prefix=".build_hit-", dir=Path(outfile).resolve().parent
+                )
+            )
+            for i, (tbl, cfg) in enumerate(tables_config.items()):
+                tmp_file = str(Path(tmp_dir) / f"{i}.lh5")
+                future = executor.submit(
+                    _build_hit_table, infile, tbl, cfg, tmp_file, "of", buffer_len
+                )
+                pending.append((future, tmp_file, tbl, outfile, i))
+
+        try:
+            for future, tmp_file, tbl, outfile, i in pending:
+                future.result()
+                _merge_table(
+                    tmp_file,
+                    tbl.replace("/dsp", "/hit"),
+                    outfile,
+                    _table_wo_mode(wo_mode, i),
+                    buffer_len,
+                )
+                Path(tmp_file).unlink()
+        finally:
+            for future, *_ in pending:
+                future.cancel()
+
+
+def _merge_table(tmp_file, name, outfile, wo_mode, buffer_len) -> None:
+    """Move table `name` from `tmp_file` into `outfile` with `wo_mode`."""
+    if wo_mode in ("of", "overwrite_file"):
+        Path(outfile).unlink(missing_ok=True)
+
+    with h5py.File(outfile, "a") as dst:
+        exists = name in dst
+        if not exists:
+            # copy the datasets as they are, still compressed, and register
+            # the table in the LH5 structs that hold it
+            with h5py.File(tmp_file, "r") as src:
+                parent = dst
+                for level in name.split("/")[:-1]:
+                    _add_struct_field(parent, level)
+                    parent = parent.require_group(level)
+                _add_struct_field(parent, name.split("/")[-1])
+                src.copy(src[name], parent, name=name.split("/")[-1])
+
+    # the table is already in the output file: let LH5 overwrite it, append to
+    # it or refuse, according to `wo_mode`
+    if exists:
+        wo_current = wo_mode
+        for chunk in LH5Iterator(tmp_file, name, buffer_len=buffer_len):
+            lh5.write(chunk, name, outfile, wo_mode=wo_current)
+            wo_current = "append"
+
+
+def _add_struct_field(group: h5py.Group, field: str) -> None:
+    # LH5 stores the fields of a struct in its datatype attribute, sorted
+    datatype = group.attrs.get("datatype", "struct{}")
+    fields = set(filter(None, datatype[len("struct{") : -1].split(",")))
+    group.attrs["datatype"] = "struct{" + ",".join(sorted(fields | {field})) + "}"
+
+
 def _reorder_table_operations(
     config: Mapping[str, Mapping],
 ) -> OrderedDict[str, Mapping]:
@@ -276,7 +653,7 @@ def _get_dependencies(config, par, pars=None):
     par_op = config[par]
     c = compile(par_op["expression"], "gcc -O3 -ffast-math build_hit.py", "eval")
     for p in c.co_names:
-        if p in par_op["parameters"]:
+        if p in par_op.get("parameters", {}):
             pass
         else:
             pars.append(p)
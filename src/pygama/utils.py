@@ -3,10 +3,13 @@ from __future__ import annotations
 import json
 import logging
 import os
+import queue
+import threading
 from collections.abc import Iterator, MutableMapping
 from pathlib import Path
 from typing import Any
 
+import lh5
 import yaml
 
 log = logging.getLogger(__name__)
@@ -105,3 +108,74 @@ def load_dict(fname: str, ftype: str | None = None) -> dict:
 
         msg = f"unsupported file format {ftype}"
         raise NotImplementedError(msg)
+
+
+class _AsyncWriter:
+    """Write LGDOs to LH5 files in a background thread.
+
+    Used as a context manager by the tier builders, so that a chunk is
+    compressed and written while the next one is computed. Writes happen in
+    the order of the calls to :meth:`write`, and at most `max_pending` chunks
+    wait in the queue: the caller blocks beyond that, which bounds the memory
+    held by the writer. An error raised by a write is raised again by the next
+    call to :meth:`write`, or on exit. On exit, all pending chunks are written.
+
+    The objects passed to :meth:`write` must not be modified afterwards, as
+    they are written later.
+
+    Examples
+    --------
+    >>> with _AsyncWriter() as writer:
+    ...     for tbl in chunks:
+    ...         writer.write(obj=tbl, name="hit", lh5_file="out.lh5", wo_mode="a")
+    """
+
+    def __init__(self, max_pending: int = 1) -> None:
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._failed = False
+        self._thread = threading.Thread(
+            target=self._run, name="pygama-lh5-writer", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, **kwargs) -> None:
+        """Queue a call to :func:`lh5.write` with keyword arguments `kwargs`."""
+        self._raise_error()
+        self._queue.put(kwargs)
+
+    def close(self) -> None:
+        """Write the pending chunks and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        # do not hide the exception of the caller
+        try:
+            self.close()
+        except Exception:
+            log.exception("could not write the pending chunks")
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        while (kwargs := self._queue.get()) is not None:
+            # after an error, the following chunks are dropped
+            if self._failed:
+                continue
+            try:
+                lh5.write(**kwargs)
+            except Exception as e:  # noqa: BLE001
+                self._error = e
+                self._failed = True
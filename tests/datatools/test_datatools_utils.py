@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+import lh5
+import numpy as np
 import pytest
+from lgdo import Array, Table
 
-from pygama.datatools.utils import parse_query_paths
+from pygama.datatools.utils import _setup_executor, parse_query_paths
 
 
 def test_parse_query_paths():
@@ -46,3 +52,23 @@ def test_parse_query_paths():
     # full match can't have multiple variables
     with pytest.raises(NameError):
         parse_query_paths("abc + def", fullmatch=True)
+
+
+def test_setup_executor(tmp_path):
+    with ExitStack() as stack:
+        assert _setup_executor(stack, None, None, "threads") == (None, None)
+        _, executor = _setup_executor(stack, 2, None)
+        assert isinstance(executor, ProcessPoolExecutor)
+        with pytest.raises(ValueError):
+            _setup_executor(stack, 2, None, "greenlets")
+
+        # iterator maps in threads do not share their aggregation
+        processes, executor = _setup_executor(stack, 2, None, "threads")
+        assert processes == 2
+        files = []
+        for i in range(4):
+            files.append(str(tmp_path / f"f{i}.lh5"))
+            lh5.write(Table({"x": Array(np.arange(10) + 10 * i)}), "t", files[-1])
+        it = lh5.LH5Iterator(files, "t", buffer_len=4)
+        res = it.query("x % 3 == 0", executor=executor, library="ak", progress=False)
+        assert res.x.tolist() == list(range(0, 40, 3))
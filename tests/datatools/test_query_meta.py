@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import pickle
+
+import yaml
+from dbetto import TextDB
+
+from pygama.datatools.query_meta import _MetaCache, _query_loop
+
+
+class _Meta(TextDB):
+    def channelmap(self, on):
+        return self.hardware.configuration.channelmaps.on(on)
+
+
+def _write_db(path, entries):
+    path.mkdir(parents=True)
+    validity = []
+    for i, (valid_from, content) in enumerate(entries):
+        (path / f"entry{i}.yaml").write_text(yaml.dump(content))
+        validity.append({"valid_from": valid_from, "apply": [f"entry{i}.yaml"]})
+    (path / "validity.yaml").write_text(yaml.dump(validity))
+
+
+def test_meta_cache(tmp_path, monkeypatch):
+    _write_db(
+        tmp_path / "meta/hardware/configuration/channelmaps",
+        [
+            ("20230101T000000Z", {"V01": {"name": "V01", "usability": "on"}}),
+            ("20230103T000000Z", {"V01": {"name": "V01", "usability": "off"}}),
+        ],
+    )
+    _write_db(
+        tmp_path / "par",
+        [
+            ("20230101T000000Z", {"V01": {"cut": 1}}),
+            ("20230102T000000Z", {"V01": {"cut": 2}}),
+        ],
+    )
+    meta = _Meta(tmp_path / "meta", lazy=True)
+    db_list = {
+        "@par": {"channel_entry": "{@chan.name}", "db": TextDB(tmp_path / "par")}
+    }
+    cache = _MetaCache(meta, None, db_list)
+
+    calls = []
+    channelmap = meta.channelmap
+    monkeypatch.setattr(
+        meta, "channelmap", lambda on: calls.append(on) or channelmap(on)
+    )
+
+    times = ["20230101T000000Z", "20230101T120000Z", "20230102T000000Z"]
+    times += ["20230103T000000Z", "20230104T000000Z"]
+    chmaps = [cache.channelmap({}, t) for t in times]
+    assert calls == ["20230101T000000Z", "20230103T000000Z"]
+    assert chmaps[0] is chmaps[2]
+    assert chmaps[3] is chmaps[4]
+    assert chmaps[4].V01.usability == "off"
+
+    pars = [cache.cycle_db("@par", {}, t) for t in times]
+    assert pars[0] is pars[1]
+    assert pars[2] is pars[4]
+    assert pars[2].V01.cut == 2
+
+    # workers receive the databases without their contents
+    meta.hardware.configuration.channelmaps.on(times[0])
+    worker = pickle.loads(pickle.dumps(cache))
+    assert len(worker.meta.keys()) == 0
+    assert len(worker.db_list["@par"]["db"].keys()) == 0
+    assert worker._entries == {}
+
+    col_name_map = {"@chan.name": "chan_name", "@par.cut": "par_cut"}
+    records, eval_success, path_hits = _query_loop(
+        [{"starttime": t} for t in times],
+        {"chan_name", "par_cut", "starttime"},
+        "chan_usability == 'on'",
+        worker,
+        col_name_map | {"@chan.usability": "chan_usability"},
+        False,
+    )
+    assert eval_success
+    assert path_hits["@par.cut"] == len(times)
+    assert [r["par_cut"] for r in records] == [1, 1, 2]
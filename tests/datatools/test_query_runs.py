@@ -1,6 +1,10 @@
 from __future__ import annotations
 
-from pygama.datatools import list_run_fields
+import os
+from pathlib import Path
+
+from pygama.datatools import RunIndex, list_run_fields, query_runs
+from pygama.datatools.query_runs import _is_columnar
 
 
 def test_list_run_fields():
@@ -37,3 +41,127 @@ def test_list_run_fields():
         "run",
         "tier_raw",
     }
+
+
+def test_query_runs_index(tmp_path):
+    def touch(tier, relpath, cycle):
+        path = tmp_path / tier / relpath
+        path.mkdir(parents=True, exist_ok=True)
+        (path / f"{cycle}-tier_{tier}.lh5").touch()
+
+    touch("raw", "cal/p01/r001", "l200-p01-r001-cal-20230101T000000Z")
+    touch("raw", "cal/p01/r001", "l200-p01-r001-cal-20230101T010000Z")
+    touch("dsp", "cal/p01/r001", "l200-p01-r001-cal-20230101T000000Z")
+    touch("raw", "phy/p01/r002", "l200-p01-r002-phy-20230102T000000Z")
+
+    dataflow_config = {
+        "paths": {"tier_raw": str(tmp_path / "raw"), "tier_dsp": str(tmp_path / "dsp")},
+        "query": {
+            "cycle_def": "experiment-period-run-datatype-starttime",
+            "tiers": ["raw", "dsp"],
+            "run_index": str(tmp_path / "index.sqlite"),
+        },
+    }
+
+    runs = query_runs(dataflow_config=dataflow_config, progress=False)
+    assert runs.cycle.to_list() == ["l200-p01-r001-cal-20230101T000000Z"]
+    assert (tmp_path / "index.sqlite").exists()
+
+    # new and removed files are found from the index
+    touch("dsp", "cal/p01/r001", "l200-p01-r001-cal-20230101T010000Z")
+    (
+        tmp_path
+        / "raw"
+        / "cal/p01/r001/l200-p01-r001-cal-20230101T000000Z-tier_raw.lh5"
+    ).unlink()
+    runs = query_runs(dataflow_config=dataflow_config, progress=False)
+    assert runs.cycle.to_list() == ["l200-p01-r001-cal-20230101T010000Z"]
+
+    runs = query_runs(
+        "datatype == 'phy'", dataflow_config=dataflow_config, join="raw", progress=False
+    )
+    assert runs.run.to_list() == ["r002"]
+    assert runs.tier_dsp.to_list() == [None]
+
+
+def test_run_index(tmp_path, monkeypatch):
+    (tmp_path / "a" / "b").mkdir(parents=True)
+    (tmp_path / "a" / "b" / "f1").touch()
+    (tmp_path / "c").mkdir()
+
+    with RunIndex(tmp_path / "index.sqlite") as index:
+        assert index.list_tree(tmp_path / "a") == {".": [], "b": ["f1"]}
+
+    # unchanged directories are not listed again
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda p: listed.append(p) or scandir(p))
+    (tmp_path / "a" / "b" / "f2").touch()
+    with RunIndex(tmp_path / "index.sqlite") as index:
+        tree = index.list_tree(tmp_path / "a")
+    assert sorted(tree["b"]) == ["f1", "f2"]
+    assert [Path(p).name for p in listed] == ["b"]
+    assert RunIndex().list_tree(tmp_path / "missing") == {}
+
+
+def test_query_runs_selection(tmp_path):
+    for run in ("r001", "r002", "r003"):
+        for dt in ("cal", "phy"):
+            path = tmp_path / "raw" / dt / run
+            path.mkdir(parents=True)
+            for ts in ("20230101T000000Z", "20230102T000000Z"):
+                (path / f"l200-p01-{run}-{dt}-{ts}-tier_raw.lh5").touch()
+            # not a cycle
+            (path / f"l200-{run}-{dt}-tier_raw.lh5").touch()
+    (tmp_path / "dsp" / "cal" / "r001").mkdir(parents=True)
+    (tmp_path / "dsp/cal/r001/l200-p01-r001-cal-20230102T000000Z-tier_dsp.lh5").touch()
+
+    dataflow_config = {
+        "paths": {"tier_raw": str(tmp_path / "raw"), "tier_dsp": str(tmp_path / "dsp")},
+        "query": {"cycle_def": "experiment-period-run-datatype-starttime"},
+    }
+    kwargs = {"dataflow_config": dataflow_config, "run_index": False, "progress": False}
+
+    runs = query_runs("run in ['r001', 'r003'] and datatype == 'cal'", **kwargs)
+    assert runs.run.to_list() == ["r001", "r001", "r003", "r003"]
+    assert runs.starttime.to_list() == ["20230101T000000Z", "20230102T000000Z"] * 2
+
+    # python expressions that pandas cannot evaluate
+    runs = query_runs("run.endswith('2') and starttime < '20230102'", **kwargs)
+    assert runs.cycle.to_list() == [
+        "l200-p01-r002-cal-20230101T000000Z",
+        "l200-p01-r002-phy-20230101T000000Z",
+    ]
+
+    # substring tests, which pandas would evaluate as something else
+    assert len(query_runs("'0' in run", **kwargs)) == 12
+    runs = query_runs("run in 'r001 r002' and datatype == 'phy'", **kwargs)
+    assert runs.run.to_list() == ["r001", "r001", "r002", "r002"]
+    runs = query_runs("run not in ['r001', 'r002'] and not datatype == 'cal'", **kwargs)
+    assert runs.run.to_list() == ["r003", "r003"]
+
+    runs = query_runs(
+        "datatype == 'cal'",
+        tiers=["raw", "dsp"],
+        join="outer",
+        sort_by="cycle",
+        **kwargs,
+    )
+    assert len(runs) == 6
+    assert runs.tier_dsp.to_list()[:2] == [
+        None,
+        f"{tmp_path}/dsp/cal/r001/l200-p01-r001-cal-20230102T000000Z-tier_dsp.lh5",
+    ]
+
+
+def test_is_columnar():
+    assert _is_columnar("run == 'r001' and not (datatype != 'cal' or period < 'p02')")
+    assert _is_columnar("run in ['r001', 'r002']")
+    assert _is_columnar("'r001' <= run < 'r003'")
+    assert not _is_columnar("'0' in run")
+    assert not _is_columnar("run in 'r001 r002'")
+    assert not _is_columnar("run in [period]")
+    assert not _is_columnar("run.endswith('2')")
+    assert not _is_columnar("run[1:] == '001'")
+    assert not _is_columnar("int(run[1:]) > 1")
+    assert not _is_columnar("run ==")
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import sys
+
+import awkward as ak
+import hist
+import lh5
+import numpy as np
+from lgdo import Array, Table
+
+from pygama.datatools import QueryCache, query_evt, result_cache
+
+
+def _write_run(tmp_path, run, energy):
+    cycle = f"l200-p01-{run}-phy-20230101T000000Z"
+    path = tmp_path / "evt/phy/p01" / run
+    path.mkdir(parents=True, exist_ok=True)
+    lh5.write(
+        Table({"energy": Array(np.asarray(energy, dtype=float))}),
+        "evt",
+        str(path / f"{cycle}-tier_evt.lh5"),
+        wo_mode="of",
+    )
+
+
+def test_query_cache(tmp_path, monkeypatch):
+    dataflow_config = {
+        "paths": {"tier_evt": str(tmp_path / "evt")},
+        "query": {
+            "cycle_def": "experiment-period-run-datatype-starttime",
+            "tiers": ["evt"],
+            "evt_tiers": ["evt"],
+            "tables": {"evt": "evt"},
+            "evt_tables": {"evt": "evt"},
+        },
+    }
+    _write_run(tmp_path, "r001", [10, 200, 300])
+    _write_run(tmp_path, "r002", [400, 50])
+
+    # number of runs read by each query
+    calls = []
+    query_evt_module = sys.modules["pygama.datatools.query_evt"]
+    iterator = query_evt_module.LH5Iterator
+    monkeypatch.setattr(
+        query_evt_module,
+        "LH5Iterator",
+        lambda files, *a, **k: calls.append(len(files)) or iterator(files, *a, **k),
+    )
+
+    def run(cache):
+        return query_evt(
+            ["energy", "run"],
+            "datatype == 'phy'",
+            "energy > 100",
+            dataflow_config=dataflow_config,
+            library="ak",
+            progress=False,
+            run_index=False,
+            cache=cache,
+        )
+
+    with QueryCache(tmp_path / "cache") as cache:
+        first = run(cache)
+        assert first.energy.tolist() == [200, 300, 400]
+        assert calls == [2]
+
+        # repeated query is answered from the cache
+        assert run(cache).tolist() == first.tolist()
+        assert calls == [2]
+
+        # only the new run is queried
+        _write_run(tmp_path, "r003", [150, 20])
+        calls.clear()
+        updated = run(cache)
+        assert updated.tolist() == run(None).tolist()
+        assert calls == [1, 3]
+
+        # changed input files invalidate the result
+        _write_run(tmp_path, "r001", [500])
+        assert run(tmp_path / "cache").energy.tolist() == [500, 400, 150]
+
+        # least recently used results are evicted over the size budget
+        cache.max_size = 0
+        run(cache)
+        assert len(list((tmp_path / "cache").glob("*.npz"))) == 1
+
+
+def test_merge_results():
+    ax = hist.axis.StrCategory([], growth=True)
+    h1 = hist.Hist(ax).fill(["a", "b"])
+    h2 = hist.Hist(ax).fill(["b", "c"])
+    merged = result_cache._merge_results(h1, h2)
+    assert [merged[c] for c in ["a", "b", "c"]] == [1, 2, 1]
+
+    old = {"x": np.arange(2), "y": {"z": np.arange(1)}}
+    new = {"x": np.arange(3), "y": {"z": np.arange(2)}}
+    merged = result_cache._merge_results(old, new)
+    assert merged["x"].tolist() == [0, 1, 0, 1, 2]
+    assert merged["y"]["z"].tolist() == [0, 0, 1]
+
+    tb = result_cache._merge_results(
+        Table({"a": Array(np.arange(2))}), Table({"a": Array(np.arange(1))})
+    )
+    assert tb.a.nda.tolist() == [0, 1, 0]
+    arr = ak.Array({"a": [[1], []], "s": ["x", "y"]})
+    assert (
+        ak.concatenate([arr, arr]).tolist()
+        == result_cache._merge_results(arr, arr).tolist()
+    )
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import awkward as ak
+import lh5
+import numpy as np
+import pytest
+from lgdo import Array, Table, VectorOfVectors
+
+from pygama.evt import aggregators, utils
+
+CHANNELS = ["ch1000000", "ch1000001", "ch1000002", "ch1000003"]
+
+
+@pytest.fixture(scope="module")
+def tcm_files(tmp_path_factory):
+    """Random events over four channels, which can fire twice in an event."""
+    d = tmp_path_factory.mktemp("aggregators")
+    rng = np.random.default_rng(42)
+    n_events = 300
+
+    keys, rows, dup_keys, dup_rows = [], [], [], []
+    n_rows = dict.fromkeys(CHANNELS, 0)
+    for _ in range(n_events):
+        chs = list(rng.choice(len(CHANNELS), rng.integers(0, 4), replace=False))
+        # about one event in ten has a second hit of the same channel
+        if chs and rng.random() < 0.1:
+            chs.append(chs[0])
+        k, r = [], []
+        for c in chs:
+            k.append(1000000 + int(c))
+            r.append(n_rows[CHANNELS[c]])
+            n_rows[CHANNELS[c]] += 1
+        (dup_keys if len(set(k)) < len(k) else keys).append(k)
+        (dup_rows if len(set(k)) < len(k) else rows).append(r)
+
+    hit_file, tcm_file = str(d / "hit.lh5"), str(d / "tcm.lh5")
+    for i, ch in enumerate(CHANNELS):
+        n = n_rows[ch]
+        energy = rng.normal(100, 50, n)
+        energy[rng.random(n) < 0.05] = np.nan
+        lh5.write(
+            Table(
+                {
+                    "energy": Array(energy),
+                    "t0": Array(rng.integers(0, 5, n).astype(float)),
+                    "flag": Array(rng.random(n) < 0.7),
+                    "n": Array(rng.integers(-3, 10, n)),
+                    "wf": VectorOfVectors(
+                        ak.unflatten(rng.random(2 * n), np.full(n, 2))
+                    ),
+                }
+            ),
+            f"{ch}/hit",
+            hit_file,
+            wo_mode="of" if i == 0 else "a",
+        )
+
+    # events without repeated channels first, then the others
+    n_single = len(keys)
+    lh5.write(
+        Table(
+            {
+                "table_key": VectorOfVectors(ak.Array(keys + dup_keys)),
+                "row_in_table": VectorOfVectors(ak.Array(rows + dup_rows)),
+            }
+        ),
+        "hardware_tcm_1",
+        tcm_file,
+        wo_mode="of",
+    )
+    datainfo = utils.make_files_config(
+        {"tcm": (tcm_file, "hardware_tcm_1"), "hit": (hit_file, "hit", "ch{}")}
+    )
+    return datainfo, n_single
+
+
+def _tcm(datainfo, n_rows=None):
+    kwargs = {} if n_rows is None else {"n_rows": n_rows}
+    tcm_lh5 = lh5.read(datainfo.tcm.group, datainfo.tcm.file, **kwargs)
+    table_key = tcm_lh5.table_key.view_as("ak")
+    row_in_table = tcm_lh5.row_in_table.view_as("ak")
+    tcm = utils.TCMData(
+        table_key=table_key,
+        row_in_table=row_in_table,
+        cache=utils.EvtCache(),
+        index=utils.TCMIndex(table_key, row_in_table),
+    )
+    return tcm, len(tcm_lh5)
+
+
+def _both_engines(monkeypatch, fun, **kwargs):
+    # the result of the vectorised engine, and of the channel loop
+    with monkeypatch.context() as m:
+        flat_hits = aggregators._flat_hits
+        used = []
+        m.setattr(
+            aggregators,
+            "_flat_hits",
+            lambda *a, **k: used.append(r := flat_hits(*a, **k)) or r,
+        )
+        flat = fun(**kwargs)
+        assert used
+        assert used[0] is not None
+
+    with monkeypatch.context() as m:
+        m.setattr(aggregators, "_flat_hits", lambda *_, **__: None)
+        loop = fun(**kwargs)
+
+    return flat.view_as("ak"), loop.view_as("ak")
+
+
+def _assert_same(a, b):
+    assert ak.all(ak.num(a, axis=-1) == ak.num(b, axis=-1)) if a.ndim > 1 else True
+    a = ak.to_numpy(ak.flatten(a, axis=None))
+    b = ak.to_numpy(ak.flatten(b, axis=None))
+    assert a.dtype == b.dtype
+    assert np.array_equal(a, b, equal_nan=a.dtype.kind == "f")
+
+
+@pytest.mark.parametrize(
+    ("mode", "expr", "query", "initial"),
+    [
+        ("sum", "hit.energy > 100", None, 0),
+        ("sum", "hit.energy", "hit.flag", 0.0),
+        ("any", "hit.flag", None, False),
+        ("any", "hit.n > k", "hit.energy > 50", False),
+        ("all", "~hit.flag", None, True),
+        ("all", "hit.n >= 0", "hit.energy > 0", True),
+    ],
+)
+def test_scalar(tcm_files, monkeypatch, mode, expr, query, initial):
+    datainfo, _ = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+
+    flat, loop = _both_engines(
+        monkeypatch,
+        aggregators.evaluate_to_scalar,
+        datainfo=datainfo,
+        tcm=tcm,
+        mode=mode,
+        channels=CHANNELS,
+        channels_skip=["ch1000002"],
+        expr=expr,
+        field_list=[("hit", f) for f in ("energy", "flag", "n")],
+        query=query,
+        n_rows=n_rows,
+        pars_dict={"k": 2},
+        default_value=initial,
+    )
+    _assert_same(flat, loop)
+
+
+@pytest.mark.parametrize("is_first", [True, False])
+@pytest.mark.parametrize("query", [None, "hit.flag"])
+def test_first_or_last(tcm_files, monkeypatch, is_first, query):
+    datainfo, _ = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+
+    flat, loop = _both_engines(
+        monkeypatch,
+        aggregators.evaluate_to_first_or_last,
+        datainfo=datainfo,
+        tcm=tcm,
+        channels=CHANNELS,
+        channels_skip=["ch1000001"],
+        expr="hit.energy * 2",
+        field_list=[("hit", "energy")],
+        query=query,
+        n_rows=n_rows,
+        sorter=("hit", "t0"),
+        default_value=np.nan,
+        is_first=is_first,
+    )
+    _assert_same(flat, loop)
+
+
+@pytest.mark.parametrize(
+    ("expr", "sorter"),
+    [
+        ("tcm.table_key", None),
+        ("hit.energy", "ascend_by:hit.t0"),
+        ("hit.n", "descend_by:hit.energy"),
+    ],
+)
+def test_vector(tcm_files, monkeypatch, expr, sorter):
+    datainfo, _ = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+
+    flat, loop = _both_engines(
+        monkeypatch,
+        aggregators.evaluate_to_vector,
+        datainfo=datainfo,
+        tcm=tcm,
+        channels=CHANNELS,
+        channels_skip=["ch1000003"],
+        expr=expr,
+        field_list=[("hit", "energy"), ("hit", "n")],
+        query="hit.energy > 80",
+        n_rows=n_rows,
+        default_value=-1,
+        sorter=sorter,
+    )
+    _assert_same(flat, loop)
+
+
+def test_at_channel(tcm_files, monkeypatch):
+    datainfo, _ = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+
+    rng = np.random.default_rng(1)
+    ch_comp = Array(rng.choice([1000000, 1000001, 1000003, 999], n_rows))
+    flat, loop = _both_engines(
+        monkeypatch,
+        aggregators.evaluate_at_channel,
+        datainfo=datainfo,
+        tcm=tcm,
+        channels=CHANNELS[:3],
+        channels_skip=["ch1000001"],
+        expr="hit.n + 1",
+        field_list=[("hit", "n")],
+        ch_comp=ch_comp,
+        default_value=np.nan,
+    )
+    _assert_same(flat, loop)
+
+
+def test_fallback(tcm_files):
+    datainfo, _ = tcm_files
+    tcm, _ = _tcm(datainfo)
+    args = {"datainfo": datainfo, "tcm": tcm, "channels": CHANNELS}
+
+    # not element-wise, or reading a jagged field
+    expr = "ak.sum(hit.wf, axis=-1)"
+    assert aggregators._flat_hits(**args, expr=expr, field_list=[("hit", "wf")]) is None
+    expr = "hit.wf * 2"
+    assert aggregators._flat_hits(**args, expr=expr, field_list=[("hit", "wf")]) is None
+
+    # the loop still evaluates them
+    out = aggregators.evaluate_to_scalar(
+        **args,
+        mode="sum",
+        channels_skip=[],
+        expr="ak.sum(hit.wf, axis=-1)",
+        field_list=[("hit", "wf")],
+        query=None,
+        n_rows=len(tcm.table_key),
+        pars_dict={"ak": ak},
+        default_value=0,
+    )
+    assert len(out) == len(tcm.table_key)
+
+
+def test_sum_counts_every_hit(tcm_files):
+    datainfo, _ = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+
+    out = aggregators.evaluate_to_scalar(
+        datainfo=datainfo,
+        tcm=tcm,
+        mode="sum",
+        channels=CHANNELS,
+        channels_skip=[],
+        expr="hit.n == hit.n",
+        field_list=[("hit", "n")],
+        query=None,
+        n_rows=n_rows,
+        default_value=0,
+    )
+    assert np.array_equal(out.nda, ak.num(tcm.table_key))
+
+
+@pytest.mark.parametrize(
+    ("mode", "initial"), [("sum", 0), ("any", False), ("all", True)]
+)
+def test_scalar_repeated_hits(tcm_files, monkeypatch, mode, initial):
+    datainfo, n_single = tcm_files
+    tcm, n_rows = _tcm(datainfo)
+    assert n_rows > n_single
+
+    flat, loop = _both_engines(
+        monkeypatch,
+        aggregators.evaluate_to_scalar,
+        datainfo=datainfo,
+        tcm=tcm,
+        mode=mode,
+        channels=CHANNELS,
+        channels_skip=[],
+        expr="hit.flag",
+        field_list=[("hit", "flag")],
+        query=None,
+        n_rows=n_rows,
+        default_value=initial,
+    )
+    _assert_same(flat, loop)
+
+    # only the events with a channel repeated
+    flat, loop = flat[n_single:], loop[n_single:]
+    if mode == "sum":
+        flags = {}
+        for ch in CHANNELS:
+            flags[int(ch[2:])] = lh5.read(f"{ch}/hit/flag", datainfo.hit.file).nda
+        expected = [
+            sum(flags[k][r] for k, r in zip(keys, rows, strict=True))
+            for keys, rows in zip(
+                ak.to_list(tcm.table_key[n_single:]),
+                ak.to_list(tcm.row_in_table[n_single:]),
+                strict=True,
+            )
+        ]
+        assert ak.to_list(loop) == expected
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import awkward as ak
@@ -12,6 +14,11 @@ from lgdo import Array, Table, VectorOfVectors
 from lh5 import read_as
 
 from pygama.evt import build_evt
+from pygama.evt.build_evt import (
+    _drop_schedule,
+    _operation_dependencies,
+    _prune_operations,
+)
 
 config_dir = Path(__file__).parent / "configs"
 
@@ -647,3 +654,155 @@ def test_first_last_at_uses_sparse_channel(sparse_channel_config, mode, buffer_l
     got = build_evt(files_config, config=config, buffer_len=buffer_len).t.view_as("np")
     assert not np.isnan(got).any()
     assert np.array_equal(got, expected)
+
+
+def test_planned_reads(sparse_channel_config, monkeypatch):
+    """Each (tier, channel) table is read once per chunk, for all operations."""
+    files_config, expected = sparse_channel_config
+
+    reads = []
+    read_as = lh5.read_as
+
+    def counting_read_as(name, *args, **kwargs):
+        reads.append(name)
+        return read_as(name, *args, **kwargs)
+
+    monkeypatch.setattr(lh5, "read_as", counting_read_as)
+
+    config = {
+        "channels": {"geds_on": ["ch1000000", "ch1000001"]},
+        "outputs": ["t", "e_sum", "t_sorted"],
+        "operations": {
+            "t": {
+                "channels": "geds_on",
+                "aggregation_mode": "first_at:dsp.tp_0_est",
+                "expression": "dsp.timestamp",
+                "initial": -1,
+            },
+            "e_sum": {
+                "channels": "geds_on",
+                "aggregation_mode": "sum",
+                "expression": "hit.e",
+                "query": "dsp.timestamp >= 0",
+                "initial": 0,
+            },
+            "t_sorted": {
+                "channels": "geds_on",
+                "aggregation_mode": "gather",
+                "expression": "dsp.timestamp",
+                "sort": "descend_by:dsp.neg_tp_0_est",
+            },
+        },
+    }
+    evt = build_evt(files_config, config=config)
+
+    # one read per (tier, channel) table, however many operations use it
+    assert sorted(reads) == sorted(
+        f"{ch}/{tier}/" for ch in ("ch1000000", "ch1000001") for tier in ("dsp", "hit")
+    )
+    assert np.array_equal(evt.t.view_as("np"), expected)
+    assert np.array_equal(evt.e_sum.view_as("np"), np.r_[np.ones(40), np.full(10, 2)])
+    t_sorted = evt.t_sorted.view_as("ak")
+    assert ak.all(ak.num(t_sorted) == np.r_[np.ones(40), np.full(10, 2)])
+    assert ak.all(t_sorted[40:, 0] == 999.0)
+
+
+def test_build_evt_parallel(sparse_channel_config, tmp_path, monkeypatch):
+    """Chunks built by worker processes are written out in TCM order."""
+    files_config, expected = sparse_channel_config
+    config = {
+        "channels": {"geds_on": ["ch1000000", "ch1000001"]},
+        "outputs": ["t", "e_sum"],
+        "operations": {
+            "t": {
+                "channels": "geds_on",
+                "aggregation_mode": "first_at:dsp.tp_0_est",
+                "expression": "dsp.timestamp",
+                "initial": -1,
+            },
+            "e_sum": {
+                "channels": "geds_on",
+                "aggregation_mode": "sum",
+                "expression": "hit.e",
+                "initial": 0,
+            },
+        },
+    }
+    serial = build_evt(files_config, config=config, buffer_len=7)
+
+    parallel = build_evt(files_config, config=config, buffer_len=7, processes=2)
+    assert np.array_equal(parallel.t.view_as("np"), expected)
+    for field in ("t", "e_sum"):
+        assert np.array_equal(parallel[field].nda, serial[field].nda)
+
+    outfile = str(tmp_path / "evt.lh5")
+    build_evt(
+        files_config | {"evt": (outfile, "evt")},
+        config=config,
+        buffer_len=7,
+        processes=2,
+        wo_mode="of",
+    )
+    assert np.array_equal(read_as("evt/t", outfile, "np"), expected)
+
+    # the read plan and the attrs are prepared once, not in every job
+    module = sys.modules["pygama.evt.build_evt"]
+    prepared = []
+    prepare = module._prepare_evt_cache
+    monkeypatch.setattr(
+        module,
+        "_prepare_evt_cache",
+        lambda *a, **k: prepared.append(a) or prepare(*a, **k),
+    )
+    with ThreadPoolExecutor(2) as executor:
+        threaded = build_evt(
+            files_config, config=config, buffer_len=7, executor=executor
+        )
+    assert len(prepared) == 1
+    assert np.array_equal(threaded.t.view_as("np"), expected)
+
+
+def test_unused_operations_pruned(sparse_channel_config):
+    files_config, expected = sparse_channel_config
+
+    config = {
+        "channels": {"geds_on": ["ch1000000", "ch1000001"]},
+        "outputs": ["t_shifted"],
+        "operations": {
+            "_t": {
+                "channels": "geds_on",
+                "aggregation_mode": "first_at:dsp.tp_0_est",
+                "expression": "dsp.timestamp",
+                "initial": -1,
+            },
+            # would raise if it were evaluated
+            "debug": {
+                "channels": "geds_on",
+                "aggregation_mode": "not-a-mode",
+                "expression": "hit.e",
+            },
+            "t_shifted": {"expression": "evt._t + 1"},
+        },
+    }
+    assert list(_prune_operations(config)["operations"]) == [
+        "_t",
+        "t_shifted",
+    ]
+    # _t is dropped from the table as soon as t_shifted has been computed
+    assert _drop_schedule(config) == {2: ["_t"]}
+
+    evt = build_evt(files_config, config=config)
+    assert list(evt.keys()) == ["t_shifted"]
+    assert np.array_equal(evt.t_shifted.view_as("np"), expected + 1)
+
+
+def test_operation_dependencies():
+    deps = _operation_dependencies(
+        {
+            "aggregation_mode": "keep_at_ch:evt.energy_id",
+            "expression": "hit.e > threshold",
+            "query": "evt.multiplicity == 1",
+        }
+    )
+    assert {"energy_id", "threshold", "multiplicity"} <= deps
+    assert "e" not in deps
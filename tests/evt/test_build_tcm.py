@@ -407,3 +407,233 @@ def test_build_tcm_buffer_reuse_copy_regression(lgnd_test_data):
 
     assert tcm_small.fields == tcm_large.fields
     assert all(ak.all(tcm_small[f] == tcm_large[f]) for f in tcm_small.fields)
+
+
+def _brute_force_tcm(
+    timestamps: dict[int, np.ndarray], window: float, window_ref: str = "last"
+):
+    """Cluster all hits at once: sort by (timestamp, table_key, row), then
+    grow each cluster hit by hit, comparing against the window reference."""
+    ts = np.concatenate(list(timestamps.values()))
+    keys = np.concatenate([np.full(len(v), k) for k, v in timestamps.items()])
+    rows = np.concatenate([np.arange(len(v)) for v in timestamps.values()])
+    order = np.lexsort((rows, keys, ts))
+    ts, keys, rows = ts[order], keys[order], rows[order]
+
+    clusters = []
+    for t in ts:
+        if clusters:
+            cluster = clusters[-1]
+            ref = {
+                "last": cluster[-1],
+                "first": cluster[0],
+                "center": (cluster[0] + cluster[-1]) / 2,
+            }[window_ref]
+            if t - ref <= window:
+                cluster.append(t)
+                continue
+        clusters.append([t])
+    cumulative_length = np.cumsum([len(c) for c in clusters])
+    return cumulative_length, keys, rows
+
+
+@pytest.fixture(scope="module")
+def synthetic_raw(tmp_path_factory):
+    rng = np.random.default_rng(42)
+    f_raw = str(tmp_path_factory.mktemp("tcm") / "raw.lh5")
+    timestamps = {}
+    for i, n in enumerate([150, 0, 80, 300, 1, 120]):
+        # rounding makes for plenty of exact coincidences between channels
+        ts = np.sort(rng.uniform(0, 100, n)).round(1)
+        timestamps[1000 + i] = ts
+        lh5.write(
+            Table({"timestamp": lgdo.Array(ts)}),
+            f"ch{1000 + i}/raw",
+            f_raw,
+            wo_mode="of" if i == 0 else "a",
+        )
+    return f_raw, timestamps
+
+
+@pytest.mark.parametrize("buffer_len", [1, 7, 64, 10**6])
+@pytest.mark.parametrize("window", [0, 0.15, 1])
+@pytest.mark.parametrize("window_ref", ["last", "first", "center"])
+def test_build_tcm_matches_brute_force(synthetic_raw, buffer_len, window, window_ref):
+    f_raw, timestamps = synthetic_raw
+    tcm = evt.build_tcm(
+        [(f_raw, [f"ch{k}/raw" for k in timestamps])],
+        "timestamp",
+        coin_windows=window,
+        window_refs=window_ref,
+        buffer_len=buffer_len,
+        out_fields="timestamp",
+    )
+    cumulative_length, keys, rows = _brute_force_tcm(timestamps, window, window_ref)
+
+    assert np.array_equal(tcm.table_key.cumulative_length.nda, cumulative_length)
+    assert np.array_equal(tcm.table_key.flattened_data.nda, keys)
+    assert np.array_equal(tcm.row_in_table.flattened_data.nda, rows)
+    assert np.all(np.diff(tcm.timestamp.flattened_data.nda) >= 0)
+
+
+def test_cluster_boundaries_multiple_columns():
+    from pygama.evt.tcm import _cluster_boundaries
+
+    # first column: rigid window of 1, second column: growing window of 0.5
+    keys = np.array([[0, 0], [0.5, 0.4], [1, 0.8], [1.5, 1.2], [1.6, 2], [2.4, 2.1]])
+    mask = _cluster_boundaries(keys, np.array([1, 0.5]), np.array([1, 0]))
+    assert np.array_equal(mask, [False, False, True, True, False])
+
+
+def test_kway_merge():
+    from pygama.evt.tcm import _kway_merge
+
+    rng = np.random.default_rng(0)
+    runs = [np.sort(rng.integers(0, 20, n)) for n in (5, 0, 17, 1, 9)]
+    keys = np.concatenate(runs)[:, None]
+    bounds = np.cumsum([0] + [len(r) for r in runs])
+
+    order = _kway_merge(keys, bounds)
+    # stable: equal keys keep the order of the runs they came from
+    assert np.array_equal(order, np.argsort(keys[:, 0], kind="stable"))
+
+
+def test_build_tcm_read_ahead(synthetic_raw):
+    f_raw, timestamps = synthetic_raw
+    tables = [(f_raw, [f"ch{k}/raw" for k in timestamps])]
+
+    ref = evt.build_tcm(tables, "timestamp", coin_windows=0.15, buffer_len=7)
+    tcm = evt.build_tcm(tables, "timestamp", coin_windows=0.15, buffer_len=7, threads=3)
+    for field in ("table_key", "row_in_table"):
+        assert tcm[field] == ref[field]
+
+
+def test_build_tcm_batch(synthetic_raw, tmp_path):
+    f_raw, timestamps = synthetic_raw
+    jobs = [
+        ([(f_raw, [f"ch{k}/raw" for k in list(timestamps)[:i]])], None)
+        for i in (2, 4, 6)
+    ]
+    jobs.append((jobs[-1][0], str(tmp_path / "tcm.lh5")))
+
+    results = evt.build_tcm_batch(
+        jobs, "timestamp", processes=2, coin_windows=0.15, buffer_len=16
+    )
+
+    assert results[-1] is None
+    assert lh5.read("tcm", jobs[-1][1]).table_key == results[-2].table_key
+    for (tables, _), tcm in zip(jobs[:-1], results[:-1], strict=True):
+        ref = evt.build_tcm(tables, "timestamp", coin_windows=0.15, buffer_len=16)
+        assert tcm.table_key == ref.table_key
+        assert tcm.row_in_table == ref.row_in_table
+
+
+@pytest.mark.parametrize("window_ref", ["last", "first"])
+def test_build_tcm_incremental(synthetic_raw, tmp_path, window_ref):
+    _, timestamps = synthetic_raw
+
+    # split the data into three consecutive "cycles", so that some events
+    # straddle the file boundaries
+    edges = [0, 33, 66, 101]
+    files = []
+    for i in range(3):
+        f_raw = str(tmp_path / f"raw{i}.lh5")
+        for j, (key, ts) in enumerate(timestamps.items()):
+            lh5.write(
+                Table(
+                    {
+                        "timestamp": lgdo.Array(
+                            ts[(ts >= edges[i]) & (ts < edges[i + 1])]
+                        )
+                    }
+                ),
+                f"ch{key}/raw",
+                f_raw,
+                wo_mode="of" if j == 0 else "a",
+            )
+        files.append(f_raw)
+
+    kwargs = {"coin_windows": 0.5, "window_refs": window_ref, "buffer_len": 16}
+    f_tcm = str(tmp_path / "tcm.lh5")
+    for i, f_raw in enumerate(files):
+        evt.build_tcm(
+            [(f_raw, "ch*/raw")],
+            "timestamp",
+            out_file=f_tcm,
+            wo_mode="of" if i == 0 else "a",
+            incremental=True,
+            **kwargs,
+        )
+        assert "tcm_state" in lh5.ls(f_tcm)
+
+    # going back in time is refused
+    with pytest.raises(ValueError):
+        evt.build_tcm([(files[0], "ch*/raw")], "timestamp", out_file=f_tcm, **kwargs)
+
+    # a final non-incremental call flushes the last events
+    evt.build_tcm([], "timestamp", out_file=f_tcm, **kwargs)
+    assert lh5.ls(f_tcm) == ["tcm"]
+
+    cumulative_length, keys, rows = _brute_force_tcm(timestamps, 0.5, window_ref)
+    # row_in_table counts from the start of each file, given by file_idx
+    file_idx = np.zeros_like(rows)
+    for key, ts in timestamps.items():
+        sel = keys == key
+        file_idx[sel] = np.searchsorted(edges, ts[rows[sel]], "right") - 1
+        rows[sel] -= np.searchsorted(ts, np.take(edges, file_idx[sel]))
+
+    tcm = lh5.read("tcm", f_tcm)
+    assert np.array_equal(tcm.table_key.cumulative_length.nda, cumulative_length)
+    assert np.array_equal(tcm.table_key.flattened_data.nda, keys)
+    assert np.array_equal(tcm.row_in_table.flattened_data.nda, rows)
+    assert np.array_equal(tcm.file_idx.flattened_data.nda, file_idx)
+
+
+@pytest.mark.parametrize("buffer_len", [16, 1000])
+def test_build_tcm_incremental_quiet_channel(tmp_path, buffer_len):
+    # ch1 fires every second, ch2 only once in the first file
+    files = []
+    for i in range(3):
+        f_raw = str(tmp_path / f"raw{i}.lh5")
+        ts = {1: np.arange(100 * i, 100 * (i + 1), dtype=float)}
+        ts[2] = np.array([10.2]) if i == 0 else np.zeros(0)
+        for key, t in ts.items():
+            lh5.write(
+                Table({"timestamp": lgdo.Array(t)}),
+                f"ch{key}/raw",
+                f_raw,
+                wo_mode="of" if key == 1 else "a",
+            )
+        files.append(f_raw)
+
+    kwargs = {"coin_windows": 0.5, "buffer_len": buffer_len}
+    f_tcm = str(tmp_path / "tcm.lh5")
+    for i, f_raw in enumerate(files):
+        evt.build_tcm(
+            [(f_raw, "ch*/raw")],
+            "timestamp",
+            out_file=f_tcm,
+            wo_mode="of" if i == 0 else "a",
+            incremental=True,
+            **kwargs,
+        )
+        # only the last event is held back
+        assert len(lh5.read("tcm_state/pending", f_tcm)) == 1
+        assert len(lh5.read("tcm", f_tcm)) == 100 * (i + 1) - 1
+
+    # a later file may not start before the event held back
+    f_late = str(tmp_path / "late.lh5")
+    lh5.write(Table({"timestamp": lgdo.Array([250.0])}), "ch2/raw", f_late)
+    with pytest.raises(ValueError):
+        evt.build_tcm([(f_late, "ch*/raw")], "timestamp", out_file=f_tcm, **kwargs)
+
+    evt.build_tcm([], "timestamp", out_file=f_tcm, **kwargs)
+    tcm = lh5.read("tcm", f_tcm)
+    assert len(tcm) == 300
+    assert ak.to_list(tcm.table_key.view_as("ak")[10]) == [1, 2]
+    assert ak.to_list(tcm.file_idx.view_as("ak")[[10, 150, 299]]) == [
+        [0, 0],
+        [1],
+        [2],
+    ]
+    assert tcm.row_in_table.flattened_data.nda[-1] == 99
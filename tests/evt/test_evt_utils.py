@@ -6,7 +6,7 @@ import awkward as ak
 import lh5
 import numpy as np
 import pytest
-from lgdo import Array
+from lgdo import Array, Table
 
 from pygama.evt import utils
 
@@ -110,3 +110,46 @@ def test_channel_indices_rejects_an_unresolved_table_id():
     # a resolvable id still works
     assert utils.get_tcm_id_by_pattern("ch{}", "ch3") == 3
     assert utils.get_tcm_id_by_pattern("ch{}", "not-a-channel") is None
+
+
+def test_tcm_index():
+    table_key = ak.Array([[3, 1], [], [1, 1, 7], [3]])
+    row_in_table = ak.Array([[0, 0], [], [1, 2, 0], [1]])
+    index = utils.TCMIndex(table_key, row_in_table)
+
+    assert index.table_keys.tolist() == [1, 3, 7]
+    flat_key = ak.to_numpy(ak.flatten(table_key))
+    flat_row = ak.to_numpy(ak.flatten(row_in_table))
+    evt_of_hit = np.array([0, 0, 2, 2, 2, 3])
+    for table_id in (1, 3, 7):
+        hit_idx, rows, evt_ids = index.channel(table_id)
+        mask = flat_key == table_id
+        assert hit_idx.tolist() == np.flatnonzero(mask).tolist()
+        assert rows.tolist() == flat_row[mask].tolist()
+        assert evt_ids.tolist() == evt_of_hit[mask].tolist()
+
+    # absent table keys give empty slices
+    assert all(len(a) == 0 for a in index.channel(5))
+    assert all(len(a) == 0 for a in index.channel(100))
+    assert index.hit_mask([3, 7]).tolist() == [True, False, False, False, True, True]
+
+    # channel_indices is served from the index attached to the TCM data
+    tcm = utils.TCMData(table_key, row_in_table, index=index)
+    assert utils.tcm_index(tcm) is index
+    assert utils.channel_indices(tcm, 1)[2].tolist() == [0, 2, 2]
+
+
+def test_read_rows(tmp_path):
+    path = str(tmp_path / "hit.lh5")
+    lh5.write(
+        Table({"a": Array(np.arange(100)), "b": Array(np.arange(100) * 2.0)}),
+        "ch1/hit",
+        path,
+    )
+
+    # nearly monotonic rows are read as one range, sparse ones point by point
+    for rows in ([3, 5, 4, 6, 9], [0, 50, 99], []):
+        idx = np.array(rows, dtype=int)
+        got = utils.read_rows("ch1/hit/", path, ["b"], idx)
+        assert ak.fields(got) == ["b"]
+        assert np.array_equal(ak.to_numpy(got.b), idx * 2.0)
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import itertools
+
+import awkward as ak
+import numpy as np
+import pytest
+
+from pygama.evt.expressions import EvtExpression, compile_expression
+
+VARIABLES = {
+    "hit_flag": ak.Array([True, False, True, True]),
+    "hit_n": ak.Array(np.array([1, -2, 3, 0])),
+    "dsp_e": ak.Array([1.5, -2.0, 0.0, 30.0]),
+    "b": np.array([0, 1, 1, 0], dtype=np.int16),
+    "k": 2,
+    "x": 2.5,
+}
+
+
+def _eval(expr):
+    # what the expression used to be evaluated with
+    with np.errstate(all="ignore"):
+        res = eval(expr, dict(VARIABLES))
+    if isinstance(res, ak.Array):
+        return ak.to_numpy(res, allow_missing=False)
+    return np.asarray(res)
+
+
+def test_prefixes():
+    expr = EvtExpression("hit.a * evt.b > xhit.c + dsp.d", ["hit", "dsp", "evt"])
+    assert expr.source == "hit_a * b > xhit.c + dsp_d"
+    assert expr.names == ["b", "dsp_d", "hit_a", "xhit"]
+
+
+@pytest.mark.parametrize(
+    ("x", "op", "y"),
+    list(
+        itertools.product(
+            ["hit.flag", "hit.n", "dsp.e", "b", "k", "x", "2", "True"],
+            ["+", "-", "*", "/", "**", "&", "|", ">", "=="],
+            ["hit.flag", "hit.n", "dsp.e", "k", "x", "3"],
+        )
+    ),
+)
+def test_same_as_eval(x, op, y):
+    expr = EvtExpression(f"{x} {op} {y}", ["hit", "dsp"])
+    try:
+        expected = _eval(expr.source)
+    except (TypeError, ValueError) as exc:
+        with pytest.raises(type(exc)):
+            expr(VARIABLES)
+        return
+
+    with np.errstate(all="ignore"):
+        got = np.asarray(expr(VARIABLES))
+    assert got.dtype == expected.dtype
+    assert np.array_equal(got, expected, equal_nan=True)
+
+
+def test_numexpr_kernels():
+    expr = compile_expression("~(hit.e > k) & hit.flag", ("hit",))
+    assert expr is compile_expression("~(hit.e > k) & hit.flag", ("hit",))
+    assert expr.numexpr
+
+    variables = {
+        "hit_e": ak.Array([1.0, 5.0, 0.5]),
+        "hit_flag": ak.Array([True, True, False]),
+        "k": 2,
+    }
+    assert np.array_equal(expr(variables), [True, False, False])
+    # one kernel per input signature, reused after that
+    expr(variables)
+    assert len(expr._kernels) == 1
+    assert next(iter(expr._kernels.values())) is not None
+
+    expr(variables | {"hit_e": ak.Array([1, 5, 0])})
+    assert len(expr._kernels) == 2
+
+
+def test_fallback():
+    # jagged input, subscripts and module calls go through eval()
+    expr = EvtExpression("ak.sum(hit.v, axis=-1) > 2", ["hit"])
+    assert not expr.numexpr
+    got = expr({"hit_v": ak.Array([[1, 2], [], [3]]), "ak": ak})
+    assert ak.to_list(got) == [True, False, True]
+
+    expr = EvtExpression("hit.e * 2", ["hit"])
+    assert expr.numexpr
+    got = expr({"hit_e": ak.Array([[1.0], [2.0, 3.0]])})
+    assert ak.to_list(got) == [[2.0], [4.0, 6.0]]
+
+    # a bare field is returned as is
+    field = ak.Array([1.0, 2.0])
+    assert EvtExpression("hit.e", ["hit"])({"hit_e": field}) is field
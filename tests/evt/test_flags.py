@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+import awkward as ak
+import numpy as np
+from lgdo import types
+
+from pygama.evt.modules import flags
+
+
+def test_pack_and_get_flag():
+    is_a = types.Array(np.array([True, False, True]))
+    is_b = types.Array(np.array([False, False, True]))
+
+    packed = flags.pack_flags(
+        None, None, [], {}, flags=[is_a, is_b], bit_names=["is_a", "is_b"]
+    )
+    assert packed.attrs["bit_names"] == "is_a,is_b"
+    assert packed.nda.tolist() == [1, 0, 3]
+
+    out = flags.get_flag(None, None, [], {}, aggregation=packed, name="is_b")
+    assert isinstance(out, types.Array)
+    assert out.nda.tolist() == [False, False, True]
+
+
+def test_get_flag_jagged():
+    aggregation = types.VectorOfVectors([[0b10, 0b01], [], [0b11]])
+    aggregation.attrs["bit_names"] = "low,high"
+
+    out = flags.get_flag(None, None, [], {}, aggregation=aggregation, name="high")
+    assert isinstance(out, types.VectorOfVectors)
+    assert ak.to_list(out.view_as("ak")) == [[True, False], [], [True]]
@@ -3,7 +3,10 @@ from __future__ import annotations
 import json
 from pathlib import Path
 
+import lh5
+import numpy as np
 import pytest
+from lgdo import Array, Table, VectorOfVectors
 
 from pygama.flow import FileDB
 
@@ -31,3 +34,82 @@ def test_filedb_full(lgnd_test_data):
     db.scan_files(["cal/p03/r001", "phy/p03/r001"])
     db.scan_tables_columns()
     return db
+
+
+def make_synthetic_tiers(tmp_path, runs=("r001",)):
+    """Three events over two channels in each run, with a hit and an evt tier."""
+    ts = "20230101T000000Z"
+    fmt = "/{type}/{period}/{run}/{exp}-{period}-{run}-{type}-{timestamp}-tier_%s.lh5"
+    for run in runs:
+        for tier in ("hit", "tcm", "evt"):
+            (tmp_path / tier / "phy" / "p01" / run).mkdir(parents=True)
+
+        def path(tier, run=run):
+            return str(
+                tmp_path
+                / tier
+                / f"phy/p01/{run}"
+                / f"l200-p01-{run}-phy-{ts}-tier_{tier}.lh5"
+            )
+
+        # event 0: ch1 row 0, ch2 row 0; event 1: ch2 row 1; event 2: ch1 row 1, ch2 row 2
+        lh5.write(
+            Table(
+                {
+                    "table_key": VectorOfVectors([[1, 2], [2], [1, 2]]),
+                    "row_in_table": VectorOfVectors([[0, 0], [1], [1, 2]]),
+                }
+            ),
+            "hardware_tcm_1",
+            path("tcm"),
+        )
+        energies = {1: [10.0, 30.0], 2: [20.0, 40.0, 5.0]}
+        for i, (ch, energy) in enumerate(energies.items()):
+            lh5.write(
+                Table(
+                    {
+                        "energy": Array(np.array(energy)),
+                        "pulses": VectorOfVectors([[e] * int(e // 10) for e in energy]),
+                    }
+                ),
+                f"ch{ch:07d}/hit",
+                path("hit"),
+                wo_mode="a" if i else "w",
+            )
+        lh5.write(
+            Table({"multiplicity": Array(np.array([2, 1, 2]))}),
+            "all/evt",
+            path("evt"),
+        )
+
+    filedb = FileDB(
+        {
+            "data_dir": str(tmp_path),
+            "tier_dirs": {t: f"/{t}" for t in ("hit", "tcm", "evt")},
+            "file_format": {t: fmt % t for t in ("hit", "tcm", "evt")},
+            "table_format": {
+                "hit": "ch{ch:07d}/hit",
+                "evt": "{grp}/evt",
+                "tcm": "hardware_tcm_1",
+            },
+        },
+        scan=False,
+    )
+    filedb.scan_files()
+    filedb.scan_tables_columns()
+
+    with (config_dir / "data-loader-config.json").open() as f:
+        config = json.load(f)
+    config.pop("filedb")
+    config["levels"]["hit"]["tiers"] = ["hit"]
+    return config, filedb
+
+
+@pytest.fixture
+def synthetic_tiers(tmp_path):
+    return make_synthetic_tiers(tmp_path)
+
+
+@pytest.fixture
+def synthetic_tiers_two_runs(tmp_path):
+    return make_synthetic_tiers(tmp_path, runs=("r001", "r002"))
@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+from itertools import chain
 from pathlib import Path
 
 import lgdo
+import lh5
 import numpy as np
 import pandas as pd
 import pytest
@@ -179,3 +181,150 @@ def test_browse(test_dl):
     wb = test_dl.browse()
 
     wb.draw_next()
+
+
+def test_entry_list_synthetic(synthetic_tiers):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_output(columns=["energy"])
+
+    el = dl.build_entry_list(tcm_level="tcm")
+    assert list(el.columns) == ["evt_idx", "hit_idx", "hit_table", "file"]
+    assert el.evt_idx.tolist() == [0, 0, 1, 2, 2]
+    assert el.hit_table.tolist() == [1, 2, 2, 1, 2]
+    assert el.hit_idx.tolist() == [0, 0, 1, 1, 2]
+
+    dl.set_cuts({"hit": "energy > 15"})
+    el = dl.build_entry_list(tcm_level="tcm", mode="only", save_output_columns=True)
+    assert el.evt_idx.tolist() == [0, 1, 2]
+    assert el.energy.tolist() == [20.0, 40.0, 30.0]
+
+    el = dl.build_entry_list(tcm_level="tcm", mode="any")
+    assert el.evt_idx.tolist() == [0, 0, 1, 2, 2]
+
+    # cuts on both levels, and only on some channels
+    dl.set_cuts({"evt": "multiplicity > 1", "hit": "energy > 15"})
+    dl.set_datastreams([1], "ch")
+    el = dl.build_entry_list(tcm_level="tcm", mode="only")
+    assert el.evt_idx.tolist() == [2]
+    assert el.hit_table.tolist() == [1]
+
+
+def test_load_vectors_synthetic(synthetic_tiers):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_cuts({"hit": "energy > 15"})
+    dl.set_output(columns=["pulses"])
+
+    data = dl.load(tcm_level="tcm")
+    assert isinstance(data.pulses, lgdo.VectorOfVectors)
+    assert data.pulses.view_as("ak").to_list() == [
+        [20.0, 20.0],
+        [40.0] * 4,
+        [30.0] * 3,
+    ]
+
+
+def test_next_synthetic(synthetic_tiers):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_output(columns=["energy", "pulses"])
+
+    full = dl.load(tcm_level="tcm")
+    chunks = list(dl.next(chunk_size=2, tcm_level="tcm"))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert np.concatenate([c.energy.nda for c in chunks]).tolist() == (
+        full.energy.nda.tolist()
+    )
+    assert list(
+        chain.from_iterable(c.pulses.view_as("ak").to_list() for c in chunks)
+    ) == (full.pulses.view_as("ak").to_list())
+    assert dl.file_list == [0]
+
+    dl.merge_files = False
+    chunks = list(dl.next(chunk_size=3, tcm_level="tcm"))
+    assert [len(c["0"]) for c in chunks] == [3, 2]
+
+
+def test_next_keeps_file_list(synthetic_tiers_two_runs):
+    dl = DataLoader(*synthetic_tiers_two_runs)
+    dl.set_files("all")
+    dl.set_output(columns=["energy"])
+
+    # the file list of the loader is left alone while chunks are consumed,
+    # and when the iteration is abandoned
+    chunks = dl.next(chunk_size=4, tcm_level="tcm")
+    first = next(chunks)
+    assert dl.file_list == [0, 1]
+    assert sorted(set(first.file.nda)) == [0]
+    del chunks
+    assert dl.file_list == [0, 1]
+    assert len(dl.load(tcm_level="tcm")) == 10
+
+
+def test_load_iterator_synthetic(synthetic_tiers):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_output(columns=["energy"], merge_files=False)
+
+    energy = []
+    for file, tbl in dl.load_iterator(tcm_level="tcm", buffer_len=2):
+        assert file == 0
+        energy += tbl.energy.nda.tolist()
+    assert sorted(energy) == [5.0, 10.0, 20.0, 30.0, 40.0]
+
+
+def test_load_evts_synthetic(synthetic_tiers):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_cuts({"hit": "energy > 15"})
+    dl.set_output(columns=["energy", "pulses", "multiplicity"])
+
+    data = dl.load(tcm_level="tcm", orientation="evt")
+    assert data.evt_idx.nda.tolist() == [0, 1, 2]
+    assert data.multiplicity.nda.tolist() == [2, 1, 2]
+    assert data.hit_table.view_as("ak").to_list() == [[2], [2], [1]]
+    assert data.energy.view_as("ak").to_list() == [[20.0], [40.0], [30.0]]
+    assert data.pulses.view_as("ak").to_list() == [
+        [[20.0, 20.0]],
+        [[40.0] * 4],
+        [[30.0] * 3],
+    ]
+
+    dl.set_cuts({"hit": "energy > 0"})
+    dl.set_output(merge_files=False)
+    el = dl.build_entry_list(tcm_level="tcm")
+    data = dl.load_evts(el, in_memory=True, tcm_level="tcm", buffer_len=1)
+    assert data["0"].energy.view_as("ak").to_list() == [
+        [10.0, 20.0],
+        [40.0],
+        [30.0, 5.0],
+    ]
+
+
+def test_skim_waveforms_synthetic(synthetic_tiers, tmp_path):
+    dl = DataLoader(*synthetic_tiers)
+    dl.set_files("all")
+    dl.set_cuts({"hit": "energy > 15"})
+    dl.set_output(columns=["pulses"])
+
+    dl.skim_waveforms(str(tmp_path / "skim.lh5"), tcm_level="tcm", buffer_len=1)
+    skim = lh5.read("skim", str(tmp_path / "skim.lh5"))
+    assert skim.hit_table.nda.tolist() == [1, 2, 2]
+    assert skim.hit_idx.nda.tolist() == [1, 0, 1]
+    assert skim.pulses.view_as("ak").to_list() == [
+        [30.0] * 3,
+        [20.0, 20.0],
+        [40.0] * 4,
+    ]
+
+    # the output columns are all in the entry list: the entries are still
+    # written, in chunks of buffer_len
+    dl.set_output(columns=["energy"])
+    el = dl.build_entry_list(tcm_level="tcm", save_output_columns=True)
+    assert "energy" in el
+    dl.skim_waveforms(str(tmp_path / "skim.lh5"), el, tcm_level="tcm", buffer_len=2)
+    skim = lh5.read("skim", str(tmp_path / "skim.lh5"))
+    assert skim.hit_idx.nda.tolist() == [1, 0, 1]
+    el = el.sort_values(["file", "hit_table", "hit_idx"])
+    assert skim.energy.nda.tolist() == el.energy.tolist()
@@ -3,11 +3,14 @@ from __future__ import annotations
 import json
 from pathlib import Path
 
+import lh5
+import numpy as np
 import pytest
+from lgdo import Array, Table
 from lh5.io.exceptions import LH5EncodeError
 from pandas.testing import assert_frame_equal
 
-from pygama.flow import FileDB
+from pygama.flow import FileDB, file_db
 
 config_dir = Path(__file__).parent / "configs"
 
@@ -364,3 +367,82 @@ def test_get_table_columns(test_filedb_full):
         db.get_table_columns(1084803, "blah")
     with pytest.raises(ValueError):
         db.get_table_columns(9999, "raw")
+
+
+def test_scan_files_update(tmp_path, monkeypatch):
+    fmt = "/{type}/{run}/l200-{run}-{type}-{timestamp}-tier_%s.lh5"
+    config = {
+        "data_dir": str(tmp_path),
+        "tier_dirs": {"raw": "/raw", "hit": "/hit"},
+        "file_format": {t: fmt % t for t in ("raw", "hit")},
+        "table_format": {"raw": "ch{ch}/raw", "hit": "ch{ch}/hit"},
+    }
+
+    def touch(tier, run, ts):
+        path = tmp_path / tier / "phy" / run
+        path.mkdir(parents=True, exist_ok=True)
+        path /= f"l200-{run}-phy-{ts}-tier_{tier}.lh5"
+        lh5.write(Table({"a": Array(np.arange(3))}), "ch1/" + tier, str(path))
+        return path.stat().st_size
+
+    raw_size = touch("raw", "r001", "20230101T000000Z")
+    touch("raw", "r001", "20230101T010000Z")
+    touch("raw", "r002", "20230102T000000Z")
+    hit_size = touch("hit", "r001", "20230101T000000Z")
+
+    db = FileDB(config, scan=False)
+    db.scan_files(n_threads=2)
+    assert db.df.timestamp.tolist() == [
+        "20230101T000000Z",
+        "20230101T010000Z",
+        "20230102T000000Z",
+    ]
+    assert db.df.file_status.tolist() == [0b11, 0b10, 0b10]
+    assert db.df.raw_size.tolist() == [raw_size] * 3
+    assert db.df.hit_size.tolist() == [hit_size, 0, 0]
+    assert set(db.dir_mtimes) == {".", "phy", "phy/r001", "phy/r002"}
+
+    db.scan_tables_columns()
+    db.to_disk(str(tmp_path / "db.lh5"))
+    db = FileDB(str(tmp_path / "db.lh5"))
+
+    # only phy/r002 changes, the rows of phy/r001 are kept
+    touch("raw", "r002", "20230102T010000Z")
+    touch("hit", "r002", "20230102T010000Z")
+    db.scan_files(update=True)
+    assert db.df.timestamp.tolist() == [
+        "20230101T000000Z",
+        "20230101T010000Z",
+        "20230102T000000Z",
+        "20230102T010000Z",
+    ]
+    assert db.df.file_status.tolist() == [0b11, 0b10, 0b10, 0b11]
+    assert db.df.hit_size.tolist() == [hit_size, 0, 0, hit_size]
+    # the rows of the files that were there keep their tables
+    assert db.df.raw_tables.tolist()[:3] == [["1"]] * 3
+    assert db.df.raw_tables.isna().tolist() == [False, False, False, True]
+
+    # only the new row is filled in
+    opened = []
+    h5py_file = file_db.h5py.File
+    monkeypatch.setattr(
+        file_db.h5py, "File", lambda p: opened.append(p) or h5py_file(p)
+    )
+    db.scan_tables_columns(missing_only=True)
+    assert [Path(p).name for p in opened] == [
+        "l200-r002-phy-20230102T010000Z-tier_raw.lh5",
+        "l200-r002-phy-20230102T010000Z-tier_hit.lh5",
+    ]
+    monkeypatch.undo()
+    assert db.df.raw_tables.tolist() == [["1"]] * 4
+    assert db.df.hit_tables.tolist()[3] == ["1"]
+    assert db.df.raw_col_idx.tolist() == [[0]] * 4
+    assert db.columns == [["a"]]
+
+    # a removed directory drops its rows
+    for f in (tmp_path / "raw" / "phy" / "r001").iterdir():
+        f.unlink()
+    (tmp_path / "raw" / "phy" / "r001").rmdir()
+    db.scan_files(update=True)
+    assert db.df.run.tolist() == ["r002", "r002"]
+    assert "phy/r001" not in db.dir_mtimes
@@ -5,7 +5,7 @@ import lgdo
 import numpy as np
 import pytest
 
-from pygama.hit import unpack_bitmask
+from pygama.hit import pack_bitmask, unpack_bitmask
 
 
 def test_from_lgdo_array_uses_attr():
@@ -76,3 +76,61 @@ def test_lgdo_array_without_attr_raises():
 def test_numpy_without_names_raises():
     with pytest.raises(ValueError, match="bit_names"):
         unpack_bitmask(np.array([1, 2, 3]))
+
+
+def test_pack_roundtrip():
+    flags = [
+        lgdo.Array(np.array([True, False, True, False])),
+        np.array([0, 1, 1, 0]),
+        ak.Array([False, False, True, True]),
+    ]
+    packed = pack_bitmask(flags, bit_names=["a", "b", "c"])
+
+    assert isinstance(packed, lgdo.Array)
+    assert packed.nda.dtype == np.uint8
+    assert packed.attrs["bit_names"] == "a,b,c"
+    assert packed.nda.tolist() == [0b001, 0b010, 0b111, 0b100]
+
+    rec = unpack_bitmask(packed)
+    assert ak.to_list(rec["a"]) == [True, False, True, False]
+    assert ak.to_list(rec["c"]) == [False, False, True, True]
+
+
+def test_pack_dtype():
+    assert pack_bitmask([np.ones(2, dtype=bool)] * 9).nda.dtype == np.uint16
+    packed = pack_bitmask([np.ones(2, dtype=bool)] * 64)
+    assert packed.nda.dtype == np.uint64
+    assert packed.nda.tolist() == [2**64 - 1] * 2
+
+    with pytest.raises(ValueError, match="64"):
+        pack_bitmask([np.ones(2, dtype=bool)] * 65)
+
+
+def test_pack_vector_of_vectors():
+    packed = pack_bitmask(
+        [lgdo.VectorOfVectors([[True], [False, True]]), ak.Array([[1], [1, 0]])],
+        bit_names=["low", "high"],
+    )
+
+    assert isinstance(packed, lgdo.VectorOfVectors)
+    assert ak.to_list(packed.view_as("ak")) == [[3], [2, 1]]
+    assert ak.to_list(unpack_bitmask(packed)["low"]) == [[True], [False, True]]
+
+
+def test_pack_mismatch_raises():
+    with pytest.raises(ValueError, match="shape"):
+        pack_bitmask([np.ones(2, dtype=bool), np.ones(3, dtype=bool)])
+    with pytest.raises(ValueError, match="bit names"):
+        pack_bitmask([np.ones(2, dtype=bool)], bit_names=["a", "b"])
+
+
+def test_unpack_selected_fields():
+    arr = lgdo.Array(np.array([0b01, 0b10, 0b11], dtype=np.uint8))
+    arr.attrs["bit_names"] = "low,high"
+
+    rec = unpack_bitmask(arr, fields=["high"])
+    assert rec.fields == ["high"]
+    assert ak.to_list(rec["high"]) == [False, True, True]
+
+    with pytest.raises(ValueError, match="mid"):
+        unpack_bitmask(arr, fields=["mid"])
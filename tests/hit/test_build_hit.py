@@ -1,15 +1,23 @@
 from __future__ import annotations
 
+import copy
 import json
+import sys
 from pathlib import Path
 
 import awkward as ak
+import lgdo
 import lh5
 import numpy as np
 import pytest
 
-from pygama.hit import build_hit
-from pygama.hit.build_hit import _reorder_table_operations
+from pygama.hit import build_hit, build_hit_batch
+from pygama.hit.build_hit import (
+    _detach,
+    _HitPipeline,
+    _lgdo_buffers,
+    _reorder_table_operations,
+)
 
 config_dir = Path(__file__).parent / "configs"
 
@@ -265,3 +273,193 @@ def test_vov_input(lgnd_test_data, tmp_dir):
     orig = lh5.read_as("ch1067205/dsp/energies", infile, "ak")
     data = lh5.read_as("ch1067205/hit/a", outfile, "ak")
     assert ak.all(data == orig)
+
+
+@pytest.fixture
+def synthetic_dsp_files(tmp_path):
+    rng = np.random.default_rng(0)
+    files = []
+    for i_file in range(2):
+        dsp_file = str(tmp_path / f"file{i_file}_dsp.lh5")
+        for i_ch, ch in enumerate(("ch1000000", "ch1000001", "ch1000002")):
+            lh5.write(
+                lgdo.Table(
+                    {
+                        "trapEmax": lgdo.Array(rng.normal(1000, 10, 50 + i_ch)),
+                        "A_max": lgdo.Array(rng.normal(10, 1, 50 + i_ch)),
+                    }
+                ),
+                f"{ch}/dsp",
+                dsp_file,
+                wo_mode="of" if i_ch == 0 else "a",
+            )
+        files.append(dsp_file)
+    return files
+
+
+def test_build_hit_parallel(synthetic_dsp_files, tmp_path):
+    config = {
+        "outputs": ["calE", "AoE"],
+        "operations": {
+            "calE": {
+                "expression": "a + b * trapEmax",
+                "parameters": {"a": 1, "b": 2},
+                "lgdo_attrs": {"units": "keV"},
+            },
+            "AoE": {"expression": "A_max / calE"},
+        },
+    }
+
+    serial = [str(tmp_path / f"serial{i}_hit.lh5") for i in range(2)]
+    for dsp_file, outfile in zip(synthetic_dsp_files, serial, strict=True):
+        build_hit(dsp_file, outfile, hit_config=config, buffer_len=20)
+
+    parallel = [str(tmp_path / f"parallel{i}_hit.lh5") for i in range(2)]
+    build_hit_batch(
+        zip(synthetic_dsp_files, parallel, strict=True),
+        processes=2,
+        hit_config=config,
+        buffer_len=20,
+    )
+
+    for ref, out in zip(serial, parallel, strict=True):
+        assert lh5.ls(out) == lh5.ls(ref)
+        for ch in lh5.ls(ref):
+            tbl_ref = lh5.read(f"{ch}/hit", ref)
+            tbl = lh5.read(f"{ch}/hit", out)
+            assert tbl.calE.attrs == tbl_ref.calE.attrs
+            assert tbl.view_as("pd").equals(tbl_ref.view_as("pd"))
+        # whole-file reads go through the LH5 struct attributes
+        assert sorted(lh5.read("/", out).keys()) == lh5.ls(ref)
+    # no temporary files are left behind
+    assert sorted(p.name for p in tmp_path.iterdir() if p.name.startswith(".")) == []
+
+    # tables that already exist are overwritten in place
+    build_hit(
+        synthetic_dsp_files[1], parallel[0], hit_config=config, wo_mode="o", processes=2
+    )
+    assert (
+        lh5.read("ch1000001/hit", parallel[0])
+        .view_as("pd")
+        .equals(lh5.read("ch1000001/hit", serial[1]).view_as("pd"))
+    )
+
+
+def test_hit_pipeline(synthetic_dsp_files, monkeypatch):
+    operations = {
+        "calE": {
+            "expression": "a + b * trapEmax",
+            "parameters": {"a": 1, "b": 2.5},
+            "lgdo_attrs": {"units": "keV"},
+        },
+        "AoE": {"expression": "A_max / calE", "description": "A over E"},
+        "is_valid": {"expression": "(AoE > c) & (calE > 0)", "parameters": {"c": 0}},
+        "E_sum": {
+            "expression": "ak.sum(ak.concatenate([calE[:, None]] * 2, axis=1), axis=1)"
+        },
+    }
+    pipeline = _HitPipeline(operations)
+    assert [op.names is not None for op in pipeline.operations] == [
+        True,
+        True,
+        True,
+        False,
+    ]
+
+    # the module is shadowed by the function in pygama.hit
+    module = sys.modules["pygama.hit.build_hit"]
+    compiled = []
+    numexpr_kernel = module.NumExpr
+    monkeypatch.setattr(
+        module,
+        "NumExpr",
+        lambda *a, **k: compiled.append(a[0]) or numexpr_kernel(*a, **k),
+    )
+
+    # the last chunk is shorter than the others
+    for chunk in lh5.LH5Iterator(
+        synthetic_dsp_files[0], "ch1000001/dsp", buffer_len=20
+    ):
+        tbl = lgdo.Table(col_dict=chunk)
+        pipeline(tbl)
+
+        ref = lgdo.Table(col_dict=chunk)
+        for name, info in operations.items():
+            ref.add_column(name, ref.eval(info["expression"], info.get("parameters")))
+
+        for name in operations:
+            assert np.array_equal(tbl[name].view_as("np"), ref[name].view_as("np"))
+            assert tbl[name].view_as("np").dtype == ref[name].view_as("np").dtype
+        assert tbl.calE.attrs["units"] == "keV"
+        assert tbl.AoE.attrs["description"] == "A over E"
+
+    # each kernel is compiled on the first chunk only
+    assert sorted(compiled) == sorted(
+        info["expression"] for name, info in operations.items() if name != "E_sum"
+    )
+
+
+def test_detach(synthetic_dsp_files):
+    pipeline = _HitPipeline(
+        {
+            "calE": {"expression": "2 * trapEmax"},
+            "E_sum": {"expression": "ak.sum(calE[:, None], axis=1)"},
+        }
+    )
+    it = lh5.LH5Iterator(synthetic_dsp_files[0], "ch1000001/dsp", buffer_len=20)
+    for chunk, _ in zip(it, range(2), strict=False):
+        tbl = lgdo.Table(col_dict=chunk)
+        pipeline(tbl)
+        out = _detach(tbl, [*_lgdo_buffers(chunk), *pipeline.buffers()])
+
+        # the input columns, and the kernel's output from the second chunk on,
+        # are copied, the rest is handed over as is
+        assert out.trapEmax is not tbl.trapEmax
+        assert out.E_sum is tbl.E_sum
+        assert (out.calE is tbl.calE) == (len(pipeline.operations[0]._buffer) == 0)
+        for name in tbl:
+            assert np.array_equal(out[name].nda, tbl[name].nda)
+            assert not np.may_share_memory(out[name].nda, chunk.trapEmax.nda)
+
+
+def test_build_hit_field_mask(synthetic_dsp_files, tmp_path, monkeypatch):
+    config = {
+        "outputs": ["calE", "flags"],
+        "operations": {
+            "calE": {"expression": "a * trapEmax", "parameters": {"a": 2}},
+            "AoE": {"expression": "A_max / calE"},
+            "is_high": {"expression": "calE > 2000"},
+        },
+        "aggregations": {"flags": {"bit0": "is_high"}},
+    }
+
+    # the module is shadowed by the function in pygama.hit
+    module = sys.modules["pygama.hit.build_hit"]
+    masks = []
+    lh5_iterator = module.LH5Iterator
+    monkeypatch.setattr(
+        module,
+        "LH5Iterator",
+        lambda *a, **k: masks.append(k["field_mask"]) or lh5_iterator(*a, **k),
+    )
+
+    outfile = str(tmp_path / "hit.lh5")
+    config_before = copy.deepcopy(config)
+    build_hit(synthetic_dsp_files[0], outfile, hit_config=config, buffer_len=20)
+    assert masks == [["trapEmax"]] * 3
+    # the caller's config is left alone
+    assert config == config_before
+
+    tbl = lh5.read("ch1000000/hit", outfile)
+    dsp = lh5.read("ch1000000/dsp", synthetic_dsp_files[0])
+    assert sorted(tbl.keys()) == ["calE", "flags"]
+    assert np.array_equal(tbl.calE.nda, 2 * dsp.trapEmax.nda)
+    assert np.array_equal(tbl.flags.nda, 2 * dsp.trapEmax.nda > 2000)
+
+    # without a list of outputs, everything is read and computed
+    del config["outputs"]
+    masks.clear()
+    build_hit(
+        synthetic_dsp_files[0], outfile, hit_config=config, wo_mode="of", buffer_len=20
+    )
+    assert masks == [None] * 3
@@ -1,5 +1,10 @@
 from __future__ import annotations
 
+import lh5
+import numpy as np
+import pytest
+from lgdo import Array, Table
+
 import pygama.utils as pgu
 
 
@@ -9,3 +14,38 @@ def test_math_numba_defaults():
 
     pgu.numba_math_defaults.fastmath = False
     assert not pgu.numba_math_defaults.fastmath
+
+
+def test_async_writer(tmp_path, monkeypatch):
+    outfile = str(tmp_path / "out.lh5")
+    with pgu._AsyncWriter() as writer:
+        for i in range(5):
+            writer.write(
+                obj=Table({"x": Array(np.arange(3) + 3 * i)}),
+                name="tbl",
+                lh5_file=outfile,
+                wo_mode="of" if i == 0 else "append",
+            )
+    # everything is written, in order, on exit
+    assert lh5.read("tbl/x", outfile).nda.tolist() == list(range(15))
+
+    # write errors are raised in the caller
+    calls = []
+
+    def fail(**kwargs):
+        calls.append(kwargs)
+        msg = "disk full"
+        raise OSError(msg)
+
+    monkeypatch.setattr(pgu.lh5, "write", fail)
+    with pytest.raises(OSError, match="disk full"):  # noqa: PT012, SIM117
+        with pgu._AsyncWriter() as writer:
+            for i in range(5):
+                writer.write(i=i)
+    # the chunks after the error are not written
+    assert len(calls) == 1
+
+    # errors of the caller are not hidden by the ones of the writer
+    with pytest.raises(KeyError), pgu._AsyncWriter() as writer:  # noqa: PT012
+        writer.write(i=0)
+        raise KeyError